@@ -6,6 +6,8 @@ export const NOTIFICATION_TYPES = {
   PUMP_STOP: 'pump_stop',
   DEVICE_ONLINE: 'device_online',
   DEVICE_OFFLINE: 'device_offline',
+  DEVICE_STABILIZED: 'device_stabilized',
+  NOTIFICATIONS_LIMITED: 'notifications_limited',
 };
 
 /**
@@ -36,4 +38,12 @@ export const NOTIFICATION_MESSAGES = {
     title: 'Device Offline',
     body: 'Your device has disconnected',
   },
+  [NOTIFICATION_TYPES.DEVICE_STABILIZED]: {
+    title: 'Device Connection Stabilized',
+    body: 'Your device connection was unstable and has now settled',
+  },
+  [NOTIFICATION_TYPES.NOTIFICATIONS_LIMITED]: {
+    title: 'Notifications Limited',
+    body: 'Your device reported changes too often; some notifications were skipped',
+  },
 };
@@ -9,12 +9,17 @@ Usage:
     python -m test_server.notifications.mqtt_handler
 """
 
-from .fcm_service import send_to_topic, send_to_device
+from .fcm_service import send_to_topic, send_to_device, register_notification_type
 from .config import NOTIFICATION_TYPES
 from .payload_parser import (
+    ParsedMessage,
+    parse_message,
     parse_payload,
     parse_payload_with_timestamp,
     parse_timestamp,
+    State,
+    classify,
+    register_state_tokens,
     is_truthy,
     is_falsy,
     is_message_recent,
@@ -24,10 +29,16 @@ from .payload_parser import (
 __all__ = [
     'send_to_topic',
     'send_to_device',
+    'register_notification_type',
     'NOTIFICATION_TYPES',
+    'ParsedMessage',
+    'parse_message',
     'parse_payload',
     'parse_payload_with_timestamp',
     'parse_timestamp',
+    'State',
+    'classify',
+    'register_state_tokens',
     'is_truthy',
     'is_falsy',
     'is_message_recent',
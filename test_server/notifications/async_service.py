@@ -0,0 +1,517 @@
+"""
+Async Service - asyncio entry point for the notification service.
+
+The default service (mqtt_handler.start) runs paho's blocking network loop
+and sends through firebase_admin's blocking messaging.send, one HTTP request
+per sender thread. This module runs the same pipeline on one event loop:
+
+- MQTT: consumed with aiomqtt when it is installed, otherwise paho's network
+  thread feeds an asyncio queue
+- Pipeline: every message goes through mqtt_handler.handle_message, so
+  parsing, transition, flap and coalescing behave exactly as in the sync service
+- FCM: an AsyncDispatcher sends through the FCM HTTP v1 API with httpx over
+  HTTP/2, multiplexing up to NOTIFY_ASYNC_MAX_IN_FLIGHT requests on a few
+  connections. A device's notifications are still sent one at a time, in order.
+- Delivery: retries with backoff behind a circuit breaker (NOTIFY_RETRY), the
+  outbox (NOTIFY_OUTBOX) and the notify_notifications_* metrics work as with
+  the Dispatcher. Priority lanes do not apply: every device is drained by its
+  own task, so a device_offline only waits for its own device's earlier
+  notifications and a free in-flight slot, never behind other devices.
+  Parked sends are not paced by NOTIFY_RETRY_DRAIN_RATE; they resume with
+  jitter once the breaker lets them through.
+- Capture (NOTIFY_CAPTURE) and the metrics endpoint (NOTIFY_METRICS) start
+  and stop with the service, as in mqtt_handler.start().
+
+mqtt_handler.start() remains the synchronous fallback.
+
+Requires httpx with HTTP/2 support (pip install 'httpx[http2]') and
+google-auth (installed with firebase-admin); aiomqtt is optional.
+
+Usage:
+    python -m test_server.notifications.async_service
+
+Environment variables (in addition to mqtt_handler's):
+    NOTIFY_ASYNC_MAX_IN_FLIGHT - Max concurrent FCM requests (default: 1000)
+    NOTIFY_ASYNC_CONNECTIONS - Max HTTP/2 connections to FCM (default: 4)
+    FCM_ENDPOINT - FCM API base URL (default: https://fcm.googleapis.com)
+"""
+import asyncio
+import random
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Awaitable, Callable
+
+from . import fcm_service, metrics, mqtt_handler
+from .config import (
+    ASYNC_CONFIG,
+    CAPTURE_CONFIG,
+    DISPATCH_CONFIG,
+    FIREBASE_CREDENTIALS_PATH,
+    METRICS_CONFIG,
+    MQTT_CONFIG,
+    OUTBOX_CONFIG,
+    RETRY_CONFIG,
+)
+from .dispatcher import DROPPED, FAILED, NOTIFICATION_LATENCY, SENT, Dispatcher, LatencyStats, NotificationEvent
+from .outbox import Outbox
+from .retry import CircuitBreaker, backoff_delay, is_retryable, retry_after
+from .sharding import adopt_orphaned_outboxes
+from .transport import FCM_SCOPES, FcmSendError, encode_message
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - optional dependency
+    httpx = None
+
+try:
+    import aiomqtt
+except ImportError:  # pragma: no cover - optional dependency
+    aiomqtt = None
+
+
+def build_v1_message(event: NotificationEvent) -> dict:
+    """Build the FCM HTTP v1 request body for an event: the message fcm_service.send_to_topic sends."""
+    message = fcm_service.build_message(event.notification_type, data=event.data,
+                                        device_id=event.device_id, body=event.body)
+    return {'message': encode_message(message)}
+
+
+class FcmV1Sender:
+    """
+    Sends notification events through the FCM HTTP v1 API over HTTP/2.
+
+    One httpx.AsyncClient is shared by all sends; the OAuth2 access token is
+    refreshed in a worker thread when it expires.
+    """
+
+    def __init__(self, credentials=None, project_id: str = None, endpoint: str = None,
+                 client=None, connections: int = None, timeout: float = None):
+        self._credentials = credentials
+        self.project_id = project_id
+        self.endpoint = (endpoint or ASYNC_CONFIG['fcm_endpoint']).rstrip('/')
+        self.connections = connections if connections is not None else ASYNC_CONFIG['connections']
+        self.timeout = timeout if timeout is not None else ASYNC_CONFIG['timeout']
+        self._client = client
+        self._owns_client = client is None
+        self._token_lock = None
+        self._url = None
+
+    async def open(self):
+        """Load credentials and open the HTTP/2 client."""
+        if self._credentials is None:
+            from google.oauth2 import service_account
+            self._credentials = service_account.Credentials.from_service_account_file(
+                FIREBASE_CREDENTIALS_PATH, scopes=FCM_SCOPES)
+        if self.project_id is None:
+            self.project_id = self._credentials.project_id
+        if self._client is None:
+            if httpx is None:
+                raise ImportError("The async service needs httpx: pip install 'httpx[http2]'")
+            self._client = httpx.AsyncClient(
+                http2=True,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.connections),
+            )
+        self._token_lock = asyncio.Lock()
+        self._url = f"{self.endpoint}/v1/projects/{self.project_id}/messages:send"
+        print(f"FCM v1 sender ready for project: {self.project_id} ({self.endpoint})")
+
+    async def close(self):
+        """Close the HTTP client (if this sender created it)."""
+        if self._client is not None and self._owns_client:
+            await self._client.aclose()
+        self._client = None
+
+    async def send(self, event: NotificationEvent) -> str:
+        """
+        Send an event to its FCM topic.
+
+        Returns:
+            str: Message name from FCM, e.g. 'projects/<id>/messages/<n>'
+
+        Raises:
+            FcmSendError: FCM answered with a non-2xx status
+        """
+        token = await self._access_token()
+        response = await self._client.post(
+            self._url,
+            json=build_v1_message(event),
+            headers={'Authorization': f'Bearer {token}'},
+        )
+        if response.status_code >= 300:
+            retry_after = response.headers.get('Retry-After')
+            raise FcmSendError(
+                response.status_code,
+                response.text[:200],
+                float(retry_after) if retry_after and retry_after.isdigit() else None,
+            )
+        return response.json().get('name')
+
+    async def _access_token(self) -> str:
+        credentials = self._credentials
+        if not credentials.valid:
+            async with self._token_lock:
+                if not credentials.valid:
+                    from google.auth.transport.requests import Request
+                    await asyncio.to_thread(credentials.refresh, Request())
+        return credentials.token
+
+
+class AsyncDispatcher:
+    """
+    Drop-in Dispatcher for the event loop: per-device queues drained by tasks.
+
+    submit() may be called from the loop or from other threads (the
+    housekeeper); queues are guarded by a lock and drain tasks are always
+    created on the loop. Each device with pending events has one drain task,
+    so its events are sent in order, and a semaphore bounds requests in flight.
+
+    With retry, a transient failure is retried after a backoff by the
+    device's drain task, so the device's later events wait behind it; the
+    wait does not hold an in-flight slot.
+    """
+
+    STAGES = Dispatcher.STAGES
+
+    def __init__(self, send: Callable[[NotificationEvent], Awaitable[object]],
+                 max_in_flight: int = None, queue_size: int = None, device_queue_size: int = None,
+                 outbox: Outbox = None, retry: bool = None, breaker: CircuitBreaker = None):
+        self._send = send
+        self._outbox = outbox
+        self.retry = retry if retry is not None else RETRY_CONFIG['enabled']
+        self.max_attempts = RETRY_CONFIG['max_attempts'] if self.retry else 1
+        self.base_delay = RETRY_CONFIG['base_delay']
+        self.max_delay = RETRY_CONFIG['max_delay']
+        self.breaker = (breaker or CircuitBreaker()) if self.retry else None
+        self.max_in_flight = max_in_flight if max_in_flight is not None else ASYNC_CONFIG['max_in_flight']
+        self.queue_size = queue_size if queue_size is not None else DISPATCH_CONFIG['queue_size']
+        self.device_queue_size = (device_queue_size if device_queue_size is not None
+                                  else DISPATCH_CONFIG['device_queue_size'])
+        self._queues = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._tasks = set()
+        self._loop = None
+        self._loop_thread = None
+        self._semaphore = None
+        self.submitted = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retried = 0
+        self.in_flight = 0
+        self.latency = {stage: LatencyStats() for stage in self.STAGES}
+
+    def start(self):
+        """Bind to the running event loop. Call from a coroutine."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        print(f"Async dispatcher started: up to {self.max_in_flight} sends in flight")
+
+    async def stop(self, timeout: float = 30.0):
+        """
+        Wait (up to timeout seconds) until every queued event has been sent.
+
+        Events still queued or waiting for a retry after that are given up;
+        with an outbox they are sent again on the next start.
+        """
+        deadline = time.monotonic() + timeout
+        # Let drains scheduled from other threads start
+        await asyncio.sleep(0)
+        while self._tasks and time.monotonic() < deadline:
+            await asyncio.wait(set(self._tasks), timeout=deadline - time.monotonic())
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+    def submit(self, notification_type: str, device_id: str = None, data: dict = None,
+               body: str = None, received_at: float = None) -> bool:
+        """
+        Queue a notification behind earlier ones of the same device. Never blocks.
+
+        Returns:
+            True if queued, False if the dispatcher or the device's queue was
+            full and the event was dropped (with an outbox, until the next start)
+        """
+        event = NotificationEvent(notification_type, device_id, data, body, received_at)
+        if self._outbox is not None:
+            self._outbox.append(event)
+        return self._enqueue(event)
+
+    def replay(self) -> int:
+        """
+        Queue the events an earlier run left in the outbox. Call once after start().
+
+        Returns:
+            Number of events queued
+        """
+        if self._outbox is None:
+            return 0
+        events = self._outbox.pending()
+        queued = sum(1 for event in events if self._enqueue(event))
+        if events:
+            print(f"Replaying {queued} undelivered notification(s) from the outbox")
+        return queued
+
+    def _enqueue(self, event: NotificationEvent) -> bool:
+        device_id = event.device_id
+        with self._lock:
+            items = self._queues.get(device_id)
+            if self._pending >= self.queue_size or (items is not None and len(items) >= self.device_queue_size):
+                self.dropped += 1
+                full = True
+            else:
+                full = False
+                new_key = items is None
+                if new_key:
+                    items = self._queues[device_id] = deque()
+                items.append(event)
+                self._pending += 1
+                self.submitted += 1
+        if full:
+            DROPPED.labels(event.notification_type).inc()
+            print(f"!!! Dispatch queue full ({self.queue_size} total, "
+                  f"{self.device_queue_size} per device), dropped {event}")
+            return False
+        if new_key:
+            if threading.get_ident() == self._loop_thread:
+                self._start_drain(device_id)
+            else:
+                self._loop.call_soon_threadsafe(self._start_drain, device_id)
+        return True
+
+    def record_latency(self, stage: str, seconds: float):
+        """Record a latency sample for one of STAGES."""
+        self.latency[stage].record(seconds)
+
+    def queue_depth(self) -> int:
+        """Number of events waiting to be sent."""
+        return self._pending
+
+    def get_stats(self) -> dict:
+        """Snapshot of queue depth, in-flight sends, counters and per-stage latency."""
+        with self._lock:
+            stats = {
+                'queue_depth': self._pending,
+                'queue_size': self.queue_size,
+                'active_devices': len(self._queues),
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'submitted': self.submitted,
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'retried': self.retried,
+            }
+        if self.breaker is not None:
+            stats['breaker'] = self.breaker.get_stats()
+        stats['latency'] = {stage: s.snapshot() for stage, s in self.latency.items()}
+        return stats
+
+    def _start_drain(self, device_id: str):
+        task = self._loop.create_task(self._drain(device_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, device_id: str):
+        while True:
+            with self._lock:
+                items = self._queues[device_id]
+                if not items:
+                    del self._queues[device_id]
+                    return
+                event = items.popleft()
+                self._pending -= 1
+            await self._deliver(event)
+
+    async def _deliver(self, event: NotificationEvent):
+        started = time.monotonic()
+        self.latency['queue'].record(started - event.enqueued_at)
+        if event.outbox_id is not None:
+            # Usually committed long ago; only a fresh event waits for the next group commit
+            await asyncio.to_thread(self._outbox.wait_durable, event.outbox_id)
+        try:
+            result = await self._send_with_retry(event)
+        except Exception as e:
+            self.failed += 1
+            FAILED.labels(event.notification_type).inc()
+            print(f"!!! ERROR sending notification {event}: {type(e).__name__}: {e}")
+            traceback.print_exc()
+        else:
+            self.sent += 1
+            SENT.labels(event.notification_type).inc()
+            if event.outbox_id is not None:
+                self._outbox.ack(event.outbox_id)
+            print(f">>> FCM Response: {result}")
+        finished = time.monotonic()
+        self.latency['send'].record(finished - started)
+        self.latency['total'].record(finished - event.received_at)
+        NOTIFICATION_LATENCY.observe(finished - event.received_at)
+
+    async def _send_with_retry(self, event: NotificationEvent):
+        # Same policy as retry.RetryScheduler: backoff with full jitter (or the
+        # server's Retry-After), permanent errors fail at once, and while the
+        # breaker is open the send is parked until it may probe again
+        attempts = 0
+        while True:
+            if self.breaker is not None and not self.breaker.allow():
+                await asyncio.sleep(self.breaker.retry_in() + random.uniform(0, self.base_delay))
+                continue
+            attempts += 1
+            try:
+                async with self._semaphore:
+                    self.in_flight += 1
+                    try:
+                        result = await self._send(event)
+                    finally:
+                        self.in_flight -= 1
+            except Exception as e:
+                if self.breaker is None:
+                    raise
+                if not is_retryable(e):
+                    # FCM answered, so it is reachable; this also ends a half-open probe
+                    self.breaker.record_success()
+                    raise
+                wait = retry_after(e)
+                self.breaker.record_failure(wait)
+                if attempts >= self.max_attempts:
+                    raise
+                delay = max(backoff_delay(attempts - 1, self.base_delay, self.max_delay), wait or 0.0)
+                print(f">>> Retrying {event} in {delay:.1f}s (attempt {attempts} failed: "
+                      f"{type(e).__name__}: {e})")
+                self.retried += 1
+                await asyncio.sleep(delay)
+                continue
+            if self.breaker is not None:
+                self.breaker.record_success()
+            return result
+
+
+async def _aiomqtt_messages():
+    shared_group = MQTT_CONFIG['shared_group']
+    tls_context = None
+    if MQTT_CONFIG.get('use_tls', False):
+        import ssl
+        tls_context = ssl.create_default_context()
+    while True:
+        try:
+            async with aiomqtt.Client(
+                hostname=MQTT_CONFIG['broker'],
+                port=MQTT_CONFIG['port'],
+                username=MQTT_CONFIG['username'] or None,
+                password=MQTT_CONFIG['password'] or None,
+                identifier=mqtt_handler.get_client_id(shared_group),
+                protocol=aiomqtt.ProtocolVersion.V5 if shared_group else None,
+                tls_context=tls_context,
+            ) as client:
+                print(f"Connected to MQTT broker: {MQTT_CONFIG['broker']}:{MQTT_CONFIG['port']} (aiomqtt)")
+                for topic_pattern in mqtt_handler.get_subscriptions(shared_group):
+                    await client.subscribe(topic_pattern)
+                    print(f"Subscribed to: {topic_pattern}")
+                async for message in client.messages:
+                    yield message.topic.value, message.payload, time.monotonic()
+        except aiomqtt.MqttError as e:
+            print(f"Disconnected from MQTT broker: {e}. Reconnecting in 5s...")
+            await asyncio.sleep(5)
+
+
+async def _paho_messages():
+    # paho's network thread hands each message to the event loop
+    loop = asyncio.get_running_loop()
+    inbox = asyncio.Queue()
+
+    def on_message(client, userdata, msg):
+        loop.call_soon_threadsafe(inbox.put_nowait, (msg.topic, msg.payload, time.monotonic()))
+
+    client = mqtt_handler.create_client()
+    client.on_message = on_message
+    client.connect_async(MQTT_CONFIG['broker'], MQTT_CONFIG['port'], keepalive=60)
+    client.loop_start()
+    try:
+        while True:
+            yield await inbox.get()
+    finally:
+        client.disconnect()
+        client.loop_stop()
+
+
+def mqtt_messages():
+    """
+    Async iterator over received MQTT messages.
+
+    Yields:
+        (topic, payload bytes, time.monotonic() at receipt)
+    """
+    if aiomqtt is not None:
+        return _aiomqtt_messages()
+    return _paho_messages()
+
+
+async def run(send: Callable[[NotificationEvent], Awaitable[object]] = None, messages=None):
+    """
+    Run the notification service on the current event loop until cancelled.
+
+    Args:
+        send: Coroutine function sending one event (default: FcmV1Sender.send)
+        messages: Async iterator of (topic, payload, received_at) (default: mqtt_messages())
+    """
+    sender = None
+    if send is None:
+        sender = FcmV1Sender()
+        await sender.open()
+        send = sender.send
+    outbox = None
+    if OUTBOX_CONFIG['enabled']:
+        # The async service is unsharded: take over events left in shard files
+        adopt_orphaned_outboxes(OUTBOX_CONFIG['path'], 0)
+        outbox = Outbox()
+        outbox.open()
+    dispatcher = AsyncDispatcher(send=send, outbox=outbox)
+    dispatcher.start()
+    dispatcher.replay()
+    mqtt_handler.set_dispatcher(dispatcher)
+    capture = mqtt_handler.start_capture() if CAPTURE_CONFIG['path'] else None
+    if METRICS_CONFIG['enabled']:
+        try:
+            metrics.start_server()
+        except OSError as e:
+            # Not worth refusing to start over
+            print(f"Metrics endpoint unavailable on port {METRICS_CONFIG['port']}: {e}")
+    mqtt_handler.housekeeper.start()
+    try:
+        async for topic, payload, received_at in (messages if messages is not None else mqtt_messages()):
+            if capture is not None:
+                capture.record(topic, payload, received_at)
+            mqtt_handler.handle_message(topic, payload, received_at)
+    except asyncio.CancelledError:
+        print("\nShutting down...")
+        raise
+    finally:
+        mqtt_handler.stop_capture()
+        metrics.stop_server()
+        mqtt_handler.housekeeper.stop()
+        mqtt_handler.flush_coalesced(flush_all=True)
+        await dispatcher.stop()
+        if outbox is not None:
+            outbox.close()
+        if sender is not None:
+            await sender.close()
+        mqtt_handler.print_pipeline_stats()
+
+
+def start():
+    """Start the asyncio notification service."""
+    print("Starting BeeGreen Notification Service (asyncio)...")
+    print(f"Connecting to MQTT broker: {MQTT_CONFIG['broker']}:{MQTT_CONFIG['port']}")
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    start()
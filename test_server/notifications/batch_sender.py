@@ -0,0 +1,219 @@
+"""
+Batch Sender - Micro-batches FCM messages into messaging.send_each calls.
+
+fcm_service.send_to_topic makes one HTTP request per notification. The batch
+sender instead collects messages for up to max_delay seconds, or until
+max_size (the FCM limit of 500) are waiting, and sends them with a single
+messaging.send_each call; each per-message response is handed back to the
+event that produced it.
+
+It plugs into the Dispatcher as its send function: send() returns a Future
+right away, so the sender thread is free for other devices while the
+dispatcher keeps the device busy until its message has been sent. A batch
+therefore never holds two messages of one device, and a device's
+notifications still go out in order.
+
+Usage:
+    from .batch_sender import BatchSender
+
+    batch_sender = BatchSender(max_size=500, max_delay=0.05)
+    batch_sender.start()
+    dispatcher = Dispatcher(send=batch_sender.send)
+    ...
+    dispatcher.stop()
+    batch_sender.stop()
+    print(batch_sender.get_stats())
+"""
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from typing import Callable, List
+
+from . import fcm_service
+from .config import BATCH_CONFIG
+from .dispatcher import LatencyStats, NotificationEvent
+
+# messaging.send_each accepts at most this many messages
+FCM_BATCH_LIMIT = 500
+
+
+class _Batch:
+    """Messages waiting to be sent together, with the futures of their events."""
+
+    __slots__ = ('messages', 'futures', 'device_ids', 'opened_at')
+
+    def __init__(self, opened_at: float):
+        self.messages = []
+        self.futures = []
+        self.device_ids = set()
+        self.opened_at = opened_at
+
+
+class BatchSender:
+    """
+    Collects messages into batches flushed by background threads.
+
+    send() runs on the dispatcher's sender threads; flusher threads wait for
+    a batch to fill up or to reach max_delay, then send it. A condition
+    variable guards the open batches.
+    """
+
+    def __init__(self, max_size: int = None, max_delay: float = None, flushers: int = None,
+                 send_each: Callable[[list], object] = None, build: Callable = None):
+        max_size = max_size if max_size is not None else BATCH_CONFIG['max_size']
+        self.max_size = min(max_size, FCM_BATCH_LIMIT)
+        self.max_delay = max_delay if max_delay is not None else BATCH_CONFIG['max_delay']
+        self.flushers = flushers if flushers is not None else BATCH_CONFIG['flushers']
+        self._send_each = send_each or fcm_service.send_batch
+        self._build = build or _build_message
+        self._batches = []
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self.batches = 0
+        self.messages = 0
+        self.max_batch = 0
+        self.failed_messages = 0
+        self.partial_failures = 0
+        self.failed_batches = 0
+        self.flush_latency = LatencyStats()
+        self.batch_wait = LatencyStats()
+
+    def start(self):
+        """Start the flusher threads. Safe to call more than once."""
+        if self._threads:
+            return
+        self._stopping = False
+        for i in range(self.flushers):
+            thread = threading.Thread(target=self._run, name=f'fcm-batch-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"Batch sender started: up to {self.max_size} messages or "
+              f"{self.max_delay * 1000:.0f} ms per batch, {self.flushers} flusher(s)")
+
+    def stop(self, timeout: float = 10.0):
+        """Send every waiting message, then stop the flusher threads."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def send(self, event: NotificationEvent) -> Future:
+        """
+        Add an event's message to the open batch.
+
+        Returns:
+            Future resolving to the FCM message ID, or failing with the FCM error
+        """
+        future = Future()
+        message = self._build(event)
+        device_id = event.device_id
+        with self._cond:
+            batch = self._batches[-1] if self._batches else None
+            # Device IDs repeat only if the caller sends a device's next event
+            # before the previous one completed; keep those in separate batches
+            if (batch is None or len(batch.messages) >= self.max_size
+                    or (device_id is not None and device_id in batch.device_ids)):
+                batch = _Batch(time.monotonic())
+                self._batches.append(batch)
+            batch.messages.append(message)
+            batch.futures.append(future)
+            if device_id is not None:
+                batch.device_ids.add(device_id)
+            if len(batch.messages) >= self.max_size or len(self._batches) == 1:
+                self._cond.notify()
+        return future
+
+    def get_stats(self) -> dict:
+        """Snapshot of batches and messages sent, batch sizes, failures and flush latency."""
+        with self._cond:
+            stats = {
+                'open_batches': len(self._batches),
+                'batches': self.batches,
+                'messages': self.messages,
+                'avg_batch': round(self.messages / self.batches, 1) if self.batches else 0.0,
+                'max_batch': self.max_batch,
+                'failed_messages': self.failed_messages,
+                'partial_failures': self.partial_failures,
+                'failed_batches': self.failed_batches,
+            }
+        stats['flush_latency'] = self.flush_latency.snapshot()
+        stats['batch_wait'] = self.batch_wait.snapshot()
+        return stats
+
+    def _next_batch(self) -> _Batch:
+        # Wait for a batch that is full, old enough, or due because we are stopping
+        with self._cond:
+            while True:
+                if self._batches:
+                    batch = self._batches[0]
+                    wait = batch.opened_at + self.max_delay - time.monotonic()
+                    if len(batch.messages) >= self.max_size or wait <= 0 or self._stopping:
+                        return self._batches.pop(0)
+                    self._cond.wait(wait)
+                elif self._stopping:
+                    return None
+                else:
+                    self._cond.wait()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._flush(batch)
+
+    def _flush(self, batch: _Batch):
+        started = time.monotonic()
+        self.batch_wait.record(started - batch.opened_at)
+        try:
+            response = self._send_each(batch.messages)
+        except Exception as e:
+            # The whole request failed (auth, network...): fail every event
+            print(f"!!! ERROR sending batch of {len(batch.messages)}: {type(e).__name__}: {e}")
+            traceback.print_exc()
+            with self._cond:
+                self.batches += 1
+                self.messages += len(batch.messages)
+                self.failed_batches += 1
+                self.failed_messages += len(batch.messages)
+            for future in batch.futures:
+                future.set_exception(e)
+            self.flush_latency.record(time.monotonic() - started)
+            return
+
+        self.flush_latency.record(time.monotonic() - started)
+        failures = _resolve(batch.futures, response.responses)
+        with self._cond:
+            self.batches += 1
+            self.messages += len(batch.messages)
+            self.max_batch = max(self.max_batch, len(batch.messages))
+            self.failed_messages += failures
+            if failures:
+                self.partial_failures += 1
+        print(f"Batch sent: {len(batch.messages)} messages, {failures} failed "
+              f"({(time.monotonic() - started) * 1000:.0f} ms)")
+
+
+def _build_message(event: NotificationEvent):
+    return fcm_service.build_message(
+        event.notification_type,
+        data=event.data,
+        device_id=event.device_id,
+        body=event.body,
+    )
+
+
+def _resolve(futures: List[Future], responses: list) -> int:
+    """Complete each event's future from its SendResponse; returns the number of failures."""
+    failures = 0
+    for future, response in zip(futures, responses):
+        if response.success:
+            future.set_result(response.message_id)
+        else:
+            failures += 1
+            future.set_exception(response.exception)
+    return failures
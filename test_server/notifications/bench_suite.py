@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite - Hot-path timings checked against a baseline kept in the repo.
+
+benchmark.py compares an optimization with the code it replaced; this suite
+guards what we have. It times every hot path of the notification service:
+
+- parse_payload on plain and JSON payloads, parse_message with timestamps
+- timestamp parsing in each layout of TIMESTAMP_FORMATS (and unix time)
+- classify on parsed values
+- on_message dispatch on a workload of state changes (dispatcher stubbed out)
+- each filter of the pipeline: state cache, flap damper, coalescer, rate limiter
+- FCM message construction in fcm_service (topic, token and multicast)
+
+Stateful cases (on_message and the filters) start every timed pass from
+fresh filters, so each pass sees the same transitions instead of repeats
+that the filters would stop early; the reset is not timed.
+
+Machines differ in speed, so each case is timed in alternation with a fixed
+pure-Python calibration loop and reported relative to it. Regressions are
+judged on that relative cost: a case fails when it is more than --threshold
+(default 25%, or NOTIFY_BENCH_THRESHOLD) slower than in bench_baseline.json,
+and the script exits with status 1. Results can be written as JSON (--json)
+for tracking over time.
+
+Usage:
+    python -m test_server.notifications.bench_suite                  # run and check
+    python -m test_server.notifications.bench_suite --json results.json
+    python -m test_server.notifications.bench_suite --threshold 0.1 timestamp
+    python -m test_server.notifications.bench_suite --update-baseline  # after an intended change
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import timeit
+from datetime import datetime
+from types import SimpleNamespace
+
+from . import benchmark, payload_parser
+from .payload_parser import State
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'bench_baseline.json')
+
+# Allowed slowdown of a case's relative cost before it counts as a regression
+DEFAULT_THRESHOLD = float(os.environ.get('NOTIFY_BENCH_THRESHOLD', '0.25'))
+
+# Timestamp every TIMESTAMP_FORMATS sample is rendered from
+SAMPLE_TIME = datetime(2025, 12, 23, 18, 13, 31, 123000)
+
+CASES = {}
+
+
+def case(name: str):
+    """
+    Register a case: a function returning (callable, inputs) to time, or
+    (callable, inputs, setup) where setup() runs untimed before every pass.
+    """
+    def register(func):
+        CASES[name] = func
+        return func
+    return register
+
+
+CALIBRATION_SIZE = 200
+
+
+def _calibration(n: int):
+    # Fixed mix of string, dict and arithmetic work, the kind the hot paths do
+    table = {'on': 1, 'off': 0}
+    total = 0
+    for i in range(n):
+        text = str(i)
+        total += table.get(text[-1:] == '1' and 'on' or 'off') + len(text.lower())
+    return total
+
+
+class _PassTimer:
+    """timeit.Timer look-alike calling setup() before each pass, outside the timing."""
+
+    def __init__(self, one_pass, setup):
+        self.one_pass = one_pass
+        self.setup = setup
+
+    def timeit(self, number: int) -> float:
+        total = 0.0
+        for _ in range(number):
+            self.setup()
+            started = time.perf_counter()
+            self.one_pass()
+            total += time.perf_counter() - started
+        return total
+
+    def autorange(self) -> tuple:
+        for number in itertools.count():
+            number = 2 ** number
+            elapsed = self.timeit(number)
+            if elapsed >= 0.2:
+                return number, elapsed
+
+
+def _timer(func, inputs: list, setup=None) -> tuple:
+    # (timer over one pass of inputs, loops per ~20 ms sample)
+    def one_pass():
+        for item in inputs:
+            func(item)
+    timer = timeit.Timer(one_pass) if setup is None else _PassTimer(one_pass, setup)
+    number, _ = timer.autorange()
+    return timer, max(1, number // 10)
+
+
+def measure(func, inputs: list, rounds: int = 15, setup=None) -> tuple:
+    """
+    Time func against the calibration loop in alternating short samples.
+
+    Shared machines drift in speed from one second to the next; comparing
+    each sample with a calibration sample taken right before it cancels
+    most of that out.
+
+    Args:
+        func: Called with each item of inputs
+        inputs: One pass
+        rounds: Samples taken
+        setup: Called before every pass, untimed (optional)
+
+    Returns:
+        (best microseconds per call, median cost relative to the calibration loop)
+    """
+    reference, reference_loops = _timer(_calibration, [CALIBRATION_SIZE])
+    timer, loops = _timer(func, inputs, setup)
+    best = float('inf')
+    ratios = []
+    for _ in range(rounds):
+        calibration = reference.timeit(reference_loops) / reference_loops
+        elapsed = timer.timeit(loops) / loops / len(inputs)
+        best = min(best, elapsed)
+        ratios.append(elapsed / calibration)
+    return best * 1e6, statistics.median(ratios)
+
+
+@case('parse_payload.plain')
+def case_parse_payload_plain():
+    return payload_parser.parse_payload, benchmark.PLAIN_PAYLOADS
+
+
+@case('parse_payload.json')
+def case_parse_payload_json():
+    return payload_parser.parse_payload, benchmark.JSON_PAYLOADS
+
+
+@case('parse_message.json')
+def case_parse_message_json():
+    return payload_parser.parse_message, benchmark.JSON_PAYLOADS
+
+
+def _timestamp_case(fmt: str):
+    sample = SAMPLE_TIME.strftime(fmt)
+    return lambda: (payload_parser._parse_timestamp_string, [sample])
+
+
+for _fmt in payload_parser.TIMESTAMP_FORMATS:
+    CASES[f'timestamp.{_fmt}'] = _timestamp_case(_fmt)
+
+
+@case('timestamp.unix')
+def case_timestamp_unix():
+    return payload_parser._parse_timestamp_value, [int(SAMPLE_TIME.timestamp())]
+
+
+@case('classify')
+def case_classify():
+    return payload_parser.classify, benchmark.CLASSIFY_VALUES
+
+
+# Devices of the stateful cases; each reports one change per kind and pass
+TRANSITION_DEVICES = 250
+
+
+def transition_workload(devices: int = TRANSITION_DEVICES) -> list:
+    """
+    MQTT-like messages in which every device turns its pump on and off and
+    goes online and offline once: four state changes, none of them a repeat,
+    flapping or over a rate limit with the default filter settings. Mostly
+    plain payloads, every fifth JSON with a current timestamp.
+    """
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    messages = []
+    for step, (suffix, value) in enumerate((('pump_status', '1'), ('status', 'online'),
+                                            ('pump_status', '0'), ('status', 'offline'))):
+        for i in range(devices):
+            payload = value
+            if (i + step) % 5 == 0:
+                payload = f'{{"payload": "{value}", "timestamp": "{timestamp}"}}'
+            messages.append(SimpleNamespace(topic=f'device{i}/{suffix}', payload=payload.encode('utf-8')))
+    return messages
+
+
+def _filter_events(devices: int = TRANSITION_DEVICES) -> list:
+    # (device_id, state, now) in the order of transition_workload's status messages
+    events = []
+    clock = itertools.count()
+    for state in (State.ON, State.OFF):
+        for i in range(devices):
+            events.append((f'device{i}', state, next(clock) * 0.001))
+    return events
+
+
+@case('on_message.transitions')
+def case_on_message():
+    from . import mqtt_handler
+
+    def on_message(msg):
+        mqtt_handler.on_message(None, None, msg)
+    # Every pass starts from fresh filters, as configured; run() resets them once more at the end
+    return on_message, transition_workload(), mqtt_handler.reset_filters
+
+
+def _fresh(factory):
+    # (holder, setup): setup() puts a new factory() in holder[0] before each pass
+    holder = [None]
+
+    def setup():
+        holder[0] = factory()
+    return holder, setup
+
+
+@case('filter.state_cache')
+def case_state_cache():
+    from .state_cache import DeviceStateCache
+    cache, setup = _fresh(DeviceStateCache)
+    return (lambda event: cache[0].is_transition(event[0], 'status', event[1], event[2]),
+            _filter_events(), setup)
+
+
+@case('filter.flap_damper')
+def case_flap_damper():
+    from .flap_damper import FlapDamper
+    damper, setup = _fresh(FlapDamper)
+    return lambda event: damper[0].allow(*event), _filter_events(), setup
+
+
+@case('filter.coalescer')
+def case_coalescer():
+    from .coalescer import Coalescer
+    coalescer, setup = _fresh(lambda: Coalescer(window_seconds=5, types=['device_online']))
+    types = {State.ON: 'device_online', State.OFF: 'device_offline'}
+    # Online is buffered, the device's offline cancels it
+    return (lambda event: coalescer[0].add(types[event[1]], event[0], event[2], event[2]),
+            _filter_events(), setup)
+
+
+@case('filter.rate_limiter')
+def case_rate_limiter():
+    from .rate_limiter import RateLimiter
+    limiter, setup = _fresh(RateLimiter)
+    types = {State.ON: 'device_online', State.OFF: 'device_offline'}
+    return lambda event: limiter[0].allow(types[event[1]], event[0], event[2]), _filter_events(), setup
+
+
+def _fcm_events():
+    return [(t, f'device{i}') for i, t in enumerate(('pump_start', 'pump_stop', 'device_online', 'device_offline'))]
+
+
+@case('fcm.build_message')
+def case_fcm_topic():
+    from . import fcm_service
+    return lambda event: fcm_service.build_message(event[0], device_id=event[1]), _fcm_events()
+
+
+@case('fcm.build_message.token')
+def case_fcm_token():
+    from . import fcm_service
+    return (lambda event: fcm_service.build_message(event[0], device_id=event[1], token='bench-token'),
+            _fcm_events())
+
+
+@case('fcm.build_multicast')
+def case_fcm_multicast():
+    from . import fcm_service
+    tokens = [f'token{i}' for i in range(10)]
+    return (lambda event: fcm_service.get_template(event[0]).build_multicast(tokens, device_id=event[1]),
+            _fcm_events())
+
+
+def run(names: list = None, rounds: int = 15) -> dict:
+    """
+    Time the given cases (default: all).
+
+    Returns:
+        {'environment': ..., 'timestamp': ..., 'results': {name: {'us_per_call', 'relative'}}}
+    """
+    from . import mqtt_handler
+
+    names = names or list(CASES)
+    results = {}
+    previous = mqtt_handler._dispatcher
+    mqtt_handler.set_dispatcher(benchmark._NullDispatcher())
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for name in names:
+                func, inputs, *setup = CASES[name]()
+                usec, relative = measure(func, inputs, rounds, *setup)
+                results[name] = {'us_per_call': round(usec, 4), 'relative': round(relative, 5)}
+    finally:
+        mqtt_handler.set_dispatcher(previous)
+        mqtt_handler.reset_filters()
+        payload_parser.format_cache.clear()
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'system': platform.system(),
+        },
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'results': results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """
+    Cases whose relative cost grew more than threshold over the baseline.
+
+    Returns:
+        List of {'name', 'baseline', 'current', 'change'} (change 0.3 = 30% slower)
+    """
+    regressions = []
+    for name, result in current['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            continue
+        change = result['relative'] / before['relative'] - 1
+        result['change'] = round(change, 4)
+        if change > threshold:
+            regressions.append({'name': name, 'baseline': before['relative'],
+                                'current': result['relative'], 'change': round(change, 4)})
+    return regressions
+
+
+def load_baseline(path: str = BASELINE_PATH) -> dict:
+    """The stored baseline, or an empty one if there is none yet."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def print_results(current: dict, threshold: float):
+    for name, result in current['results'].items():
+        change = result.get('change')
+        verdict = ''
+        if change is not None:
+            verdict = f"{change:+7.1%}" + ('  REGRESSION' if change > threshold else '')
+        print(f"  {name:<40} {result['us_per_call']:9.3f} us/call  {result['relative']:9.4f}x cal  {verdict}")
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('cases', nargs='*', help='Case names or prefixes (default: all)')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Allowed slowdown vs the baseline, e.g. 0.25 for 25%%')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline JSON file')
+    parser.add_argument('--json', metavar='PATH', help="Write results as JSON ('-' for stdout)")
+    parser.add_argument('--update-baseline', action='store_true', help='Store these results as the baseline')
+    parser.add_argument('--rounds', type=int, default=15, help='Timing samples per case (median is kept)')
+    args = parser.parse_args(argv)
+
+    names = [name for name in CASES if not args.cases or any(name.startswith(c) for c in args.cases)]
+    if not names:
+        print(f"No case matches {args.cases} (available: {', '.join(CASES)})")
+        return 2
+
+    started = time.monotonic()
+    current = run(names, rounds=args.rounds)
+    baseline = load_baseline(args.baseline)
+    regressions = compare(current, baseline, args.threshold)
+    current['threshold'] = args.threshold
+    current['regressions'] = regressions
+
+    if args.json == '-':
+        json.dump(current, sys.stdout, indent=2)
+        print()
+    else:
+        print_results(current, args.threshold)
+        print(f"{len(names)} case(s) in {time.monotonic() - started:.1f}s, "
+              f"{len(regressions)} regression(s) over {args.threshold:.0%}"
+              f"{'' if baseline else ' (no baseline yet)'}")
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(current, f, indent=2)
+
+    if args.update_baseline:
+        merged = baseline or {}
+        merged.update({key: current[key] for key in ('environment', 'timestamp')})
+        merged.setdefault('results', {}).update(
+            {name: {k: v for k, v in result.items() if k != 'change'}
+             for name, result in current['results'].items()})
+        with open(args.baseline, 'w') as f:
+            json.dump(merged, f, indent=2, sort_keys=True)
+            f.write('\n')
+        # stdout may be carrying the --json - results
+        print(f"Baseline updated: {args.baseline}", file=sys.stderr)
+        return 0
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
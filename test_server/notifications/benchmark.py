@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the notification service hot paths.
+
+Each benchmark prints the cost per call of the current implementation next to
+the approach it replaced, so the speedup of an optimization can be checked on
+any machine. To catch regressions against stored results, use bench_suite.py.
+
+Usage:
+    python -m test_server.notifications.benchmark            # run all
+    python -m test_server.notifications.benchmark parse_message
+"""
+import contextlib
+import os
+import random
+import sys
+import time
+import timeit
+import tracemalloc
+from types import SimpleNamespace
+
+from . import json_backend, payload_parser
+
+# Representative payloads, one per shape the parser supports
+PLAIN_PAYLOADS = ['online', 'offline', '1', '0', 'ON']
+JSON_PAYLOADS = [
+    '{"payload": "online", "timestamp": "2025-12-23 18:13:31"}',
+    '{"value": 1, "time": "2025-12-23T18:13:31Z"}',
+    '{"state": true, "ts": 1766513611}',
+    '{"status": "off", "timestamp": "23-12-2025 18:13:31"}',
+]
+
+BENCHMARKS = {}
+
+
+def benchmark(name: str):
+    """Register a benchmark function under the given name."""
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def time_per_call(func, payloads: list, repeat: int = 5) -> float:
+    """
+    Measure the best-of-N cost of calling func once per payload.
+
+    Returns:
+        Microseconds per call
+    """
+    def run():
+        for payload in payloads:
+            func(payload)
+
+    timer = timeit.Timer(run)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / (number * len(payloads)) * 1e6
+
+
+def report(title: str, rows: list):
+    """Print rows of (label, usec_per_call); the first row is the baseline."""
+    print(f"\n{title}")
+    baseline = rows[0][1]
+    for label, usec in rows:
+        speedup = baseline / usec if usec else float('inf')
+        rate = 1e6 / usec if usec else float('inf')
+        print(f"  {label:<40} {usec:8.3f} us/call {rate:12,.0f}/s  {speedup:5.2f}x")
+
+
+def _parse_twice(raw_payload: str):
+    # What parse_payload_with_timestamp used to do: two independent decodes
+    return payload_parser.parse_payload(raw_payload), payload_parser.parse_timestamp(raw_payload)
+
+
+@benchmark('parse_message')
+def bench_parse_message():
+    for label, payloads in (('JSON payloads', JSON_PAYLOADS), ('plain payloads', PLAIN_PAYLOADS)):
+        report(f"parse value + timestamp ({label})", [
+            ('parse_payload + parse_timestamp', time_per_call(_parse_twice, payloads)),
+            ('parse_message', time_per_call(payload_parser.parse_message, payloads)),
+        ])
+
+
+# One sample timestamp per entry of TIMESTAMP_FORMATS, in the same order
+TIMESTAMP_SAMPLES = [
+    '2025-12-23 18:13:31',
+    '2025-12-23T18:13:31',
+    '2025-12-23T18:13:31Z',
+    '2025-12-23T18:13:31.123',
+    '2025-12-23T18:13:31.123Z',
+    '2025/12/23 18:13:31',
+    '23-12-2025 18:13:31',
+]
+
+
+@benchmark('timestamp')
+def bench_timestamp():
+    for fmt, sample in zip(payload_parser.TIMESTAMP_FORMATS, TIMESTAMP_SAMPLES):
+        report(f"parse timestamp {sample!r} ({fmt})", [
+            ('strptime loop', time_per_call(payload_parser._strptime_timestamp, [sample])),
+            ('fast path', time_per_call(payload_parser._parse_timestamp_string, [sample])),
+        ])
+
+
+# Payloads whose fields and timestamp format are late in the search order
+LATE_MATCH_PAYLOADS = [
+    '{"data": "on", "date": "2025/1/2 3:04:05"}',
+    '{"state": 0, "datetime": "2-1-2025 3:04:05"}',
+]
+
+
+@benchmark('format_cache')
+def bench_format_cache():
+    def with_cache(raw_payload):
+        return payload_parser.parse_message(raw_payload, device_id='bench-device')
+
+    payload_parser.format_cache.clear()
+    report("parse_message, late-matching fields and unpadded timestamps", [
+        ('full search', time_per_call(payload_parser.parse_message, LATE_MATCH_PAYLOADS[:1])),
+        ('per-device format cache', time_per_call(with_cache, LATE_MATCH_PAYLOADS[:1])),
+    ])
+    report("parse_message, same device alternating layouts (cache misses)", [
+        ('full search', time_per_call(payload_parser.parse_message, LATE_MATCH_PAYLOADS)),
+        ('per-device format cache', time_per_call(with_cache, LATE_MATCH_PAYLOADS)),
+    ])
+    print(f"  cache stats: {payload_parser.format_cache.get_stats()}")
+    payload_parser.format_cache.clear()
+
+
+def mixed_workload(size: int = 1000, plain_ratio: float = 0.8, seed: int = 1) -> list:
+    """Build MQTT-like messages: mostly tiny plain payloads, the rest JSON."""
+    rng = random.Random(seed)
+    messages = []
+    for i in range(size):
+        topic = f"device{i % 50}/{rng.choice(('status', 'pump_status'))}"
+        if rng.random() < plain_ratio:
+            payload = rng.choice(PLAIN_PAYLOADS)
+        else:
+            payload = rng.choice(JSON_PAYLOADS)
+        messages.append(SimpleNamespace(topic=topic, payload=payload.encode('utf-8')))
+    return messages
+
+
+class _NullDispatcher:
+    """Stands in for the Dispatcher so only on_message itself is timed."""
+
+    def submit(self, *args, **kwargs):
+        return True
+
+    def record_latency(self, stage, seconds):
+        pass
+
+
+@benchmark('trivial_payloads')
+def bench_trivial_payloads():
+    from . import mqtt_handler
+
+    messages = mixed_workload()
+
+    def decode_and_parse(msg):
+        return payload_parser.parse_message(msg.payload.decode('utf-8'), device_id='bench')
+
+    def lookup_then_parse(msg):
+        parsed = payload_parser.lookup_trivial(msg.payload)
+        if parsed is None:
+            parsed = payload_parser.parse_message(msg.payload.decode('utf-8'), device_id='bench')
+        return parsed
+
+    report("parse 80% plain / 20% JSON payloads from bytes", [
+        ('decode + parse_message', time_per_call(decode_and_parse, messages)),
+        ('lookup_trivial, then parse_message', time_per_call(lookup_then_parse, messages)),
+    ])
+
+    previous = mqtt_handler._dispatcher
+    mqtt_handler.set_dispatcher(_NullDispatcher())
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            usec = time_per_call(lambda msg: mqtt_handler.on_message(None, None, msg), messages)
+    finally:
+        mqtt_handler.set_dispatcher(previous)
+    report("on_message throughput, same workload (stdout discarded)", [
+        ('on_message', usec),
+    ])
+    payload_parser.format_cache.clear()
+
+
+CLASSIFY_VALUES = ['1', '0', 'online', 'offline', 'inactive', 'unknown-value']
+
+
+def _legacy_is_truthy(value):
+    return value in ('1', 'on', 'true', 'online', 'connected', 'started', 'yes', 'active')
+
+
+def _legacy_is_falsy(value):
+    return value in ('0', 'off', 'false', 'offline', 'disconnected', 'stopped', 'no', 'inactive')
+
+
+@benchmark('classify')
+def bench_classify():
+    def tuple_scans(value):
+        # What on_message used to do for a status message
+        is_offline = _legacy_is_falsy(value)
+        return _legacy_is_truthy(value) or is_offline
+
+    def lookup(value):
+        return payload_parser.classify(value)
+
+    report("classify parsed values", [
+        ('is_truthy/is_falsy tuple scans', time_per_call(tuple_scans, CLASSIFY_VALUES)),
+        ('classify (dict lookup)', time_per_call(lookup, CLASSIFY_VALUES)),
+    ])
+
+
+@benchmark('json_backend')
+def bench_json_backend():
+    raw_bytes = [payload.encode('utf-8') for payload in JSON_PAYLOADS]
+    original = json_backend.name
+    rows = []
+    try:
+        for backend in json_backend.available_backends():
+            json_backend.select_backend(backend)
+            rows.append((f'{backend}, str (decoded first)', time_per_call(
+                lambda raw: payload_parser.parse_message(raw.decode('utf-8')), raw_bytes)))
+            rows.append((f'{backend}, bytes', time_per_call(payload_parser.parse_message, raw_bytes)))
+    finally:
+        json_backend.select_backend(original)
+    rows.sort(key=lambda row: not row[0].startswith('json,'))
+    report("parse_message on JSON payloads per backend", rows)
+
+
+def retained_per_call(func, args: list, count: int = 5000) -> tuple:
+    """
+    Memory held by the objects func returns, via tracemalloc.
+
+    Returns:
+        (bytes, allocated blocks) per call, with count results kept alive
+    """
+    results = []
+    tracemalloc.start()
+    try:
+        before_size = tracemalloc.get_traced_memory()[0]
+        before_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+        for i in range(count):
+            results.append(func(args[i % len(args)]))
+        after_size = tracemalloc.get_traced_memory()[0]
+        after_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    finally:
+        tracemalloc.stop()
+    return (after_size - before_size) / count, (after_blocks - before_blocks) / count
+
+
+def _legacy_build_message(notification_type, data=None, device_id=None, body=None):
+    # What send_to_topic used to build on every call
+    from firebase_admin import messaging
+    from .config import NOTIFICATION_TYPES
+
+    notif_config = NOTIFICATION_TYPES.get(notification_type)
+    if not notif_config:
+        raise ValueError(f"Unknown notification type: {notification_type}")
+    body = body or notif_config['body']
+    if device_id:
+        body = f"{body} (Device: {device_id})"
+    payload_data = {
+        'type': notification_type,
+        'timestamp': str(int(time.time())),
+    }
+    if device_id:
+        payload_data['device_id'] = device_id
+    if data:
+        payload_data.update({k: str(v) for k, v in data.items()})
+    return messaging.Message(
+        notification=messaging.Notification(title=notif_config['title'], body=body),
+        data=payload_data,
+        topic=notif_config['fcm_topic'],
+        android=messaging.AndroidConfig(
+            priority='high',
+            notification=messaging.AndroidNotification(
+                channel_id='beegreen_notifications',
+                priority='high',
+            ),
+        ),
+        apns=messaging.APNSConfig(
+            payload=messaging.APNSPayload(
+                aps=messaging.Aps(
+                    alert=messaging.ApsAlert(title=notif_config['title'], body=body),
+                    sound='default',
+                    badge=1,
+                ),
+            ),
+        ),
+    )
+
+
+@benchmark('fcm_message')
+def bench_fcm_message():
+    from . import fcm_service
+
+    events = [(t, f'device{i}') for i, t in enumerate(('pump_start', 'pump_stop', 'device_online', 'device_offline'))]
+
+    def legacy(event):
+        return _legacy_build_message(event[0], device_id=event[1])
+
+    def template(event):
+        return fcm_service.build_message(event[0], device_id=event[1])
+
+    report("build one FCM message", [
+        ('rebuild every config', time_per_call(legacy, events)),
+        ('compiled template', time_per_call(template, events)),
+    ])
+    print("\nmemory held per built message (e.g. while waiting in a batch)")
+    for label, func in (('rebuild every config', legacy), ('compiled template', template)):
+        size, blocks = retained_per_call(func, events)
+        print(f"  {label:<40} {size:8.0f} bytes {blocks:8.1f} blocks")
+
+
+def main(argv: list = None):
+    names = (argv if argv is not None else sys.argv[1:]) or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name} (available: {', '.join(BENCHMARKS)})")
+            return 1
+        BENCHMARKS[name]()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Capture - Record MQTT traffic to a compact log and replay it through the pipeline.
+
+With NOTIFY_CAPTURE set, mqtt_handler appends every received message
+(topic, payload, receive time) to a capture file. The file can be replayed
+through handle_message later, at the original pace or as fast as possible,
+to reproduce a production load exactly.
+
+File format (little-endian):
+
+    header   magic b'BGCAP\\0', version (uint16), capture start (float64, unix time)
+    block*   flags (uint8, 1 = zlib), raw length (uint32), stored length (uint32),
+             then stored length bytes holding records
+    record   offset (float64, seconds since capture start), topic length (uint16),
+             payload length (uint32), topic (UTF-8), payload
+
+Records are buffered in memory and written a block at a time by a writer
+thread (at least every flush_interval seconds), so recording costs the MQTT
+thread one append. If the disk cannot keep up, records beyond max_buffer
+bytes are dropped and counted rather than blocking the MQTT thread. A crash
+loses at most the last block; a partially written final block is ignored.
+
+Replay memory-maps the file: uncompressed blocks are sliced straight from
+the mapping, compressed ones are inflated one block at a time.
+
+Usage:
+    NOTIFY_CAPTURE=traffic.bgcap python -m test_server.notifications.mqtt_handler
+
+    python -m test_server.notifications.capture info traffic.bgcap
+    python -m test_server.notifications.capture replay traffic.bgcap            # original pace
+    python -m test_server.notifications.capture replay traffic.bgcap --fast --fcm dry_run
+
+    from .capture import CaptureReader
+    with CaptureReader('traffic.bgcap') as reader:
+        for offset, topic, payload in reader:
+            ...
+"""
+import argparse
+import contextlib
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from typing import Iterator, Tuple
+
+from .config import CAPTURE_CONFIG
+
+MAGIC = b'BGCAP\0'
+VERSION = 1
+_HEADER = struct.Struct('<6sHd')
+_BLOCK = struct.Struct('<BII')
+_RECORD = struct.Struct('<dHI')
+FLAG_ZLIB = 1
+
+
+class CaptureWriter:
+    """
+    Appends received messages to a capture file.
+
+    record() is called on the MQTT thread and only appends to an in-memory
+    block under a lock; the writer thread compresses and writes blocks.
+    """
+
+    def __init__(self, path: str = None, compress: bool = None, block_size: int = None,
+                 flush_interval: float = None, max_buffer: int = None):
+        self.path = path or CAPTURE_CONFIG['path']
+        self.compress = compress if compress is not None else CAPTURE_CONFIG['compress']
+        self.block_size = block_size if block_size is not None else CAPTURE_CONFIG['block_size']
+        self.flush_interval = (flush_interval if flush_interval is not None
+                               else CAPTURE_CONFIG['flush_interval'])
+        self.max_buffer = max_buffer if max_buffer is not None else CAPTURE_CONFIG['max_buffer']
+        self._file = None
+        self._buffer = bytearray()
+        self._blocks = []
+        self._buffered = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._started = 0.0
+        self.records = 0
+        self.dropped = 0
+        self.blocks = 0
+        self.raw_bytes = 0
+        self.written_bytes = 0
+
+    def open(self):
+        """Create (or truncate) the capture file and start the writer thread."""
+        self._file = open(self.path, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION, time.time()))
+        self._started = time.monotonic()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='capture-writer', daemon=True)
+        self._thread.start()
+        print(f"Capturing MQTT traffic to {self.path}"
+              f"{' (zlib)' if self.compress else ''}")
+
+    def close(self, timeout: float = 10.0):
+        """Write what is buffered, stop the writer thread and close the file."""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        self._thread = None
+        self._file.close()
+        self._file = None
+
+    def record(self, topic: str, payload: bytes, received_at: float = None):
+        """Append one message. Never blocks on disk."""
+        if received_at is None:
+            received_at = time.monotonic()
+        topic = topic.encode('utf-8')
+        with self._cond:
+            if self._buffered >= self.max_buffer:
+                self.dropped += 1
+                return
+            buffer = self._buffer
+            size = len(buffer)
+            buffer += _RECORD.pack(received_at - self._started, len(topic), len(payload))
+            buffer += topic
+            buffer += payload
+            self._buffered += len(buffer) - size
+            self.records += 1
+            if len(buffer) >= self.block_size:
+                self._blocks.append(buffer)
+                self._buffer = bytearray()
+                self._cond.notify()
+
+    def get_stats(self) -> dict:
+        """Snapshot of records captured and dropped, blocks and bytes written."""
+        with self._cond:
+            return {
+                'records': self.records,
+                'dropped': self.dropped,
+                'blocks': self.blocks,
+                'raw_bytes': self.raw_bytes,
+                'written_bytes': self.written_bytes,
+                'buffered_bytes': self._buffered,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._blocks and not self._stopping:
+                    self._cond.wait(self.flush_interval)
+                blocks, self._blocks = self._blocks, []
+                if self._buffer and (not blocks or self._stopping):
+                    # Partial block: written after flush_interval or on close
+                    blocks.append(self._buffer)
+                    self._buffer = bytearray()
+                stopping = self._stopping
+            for block in blocks:
+                self._write(block)
+            if blocks:
+                self._file.flush()
+            if stopping:
+                return
+
+    def _write(self, block: bytearray):
+        flags = 0
+        data = block
+        if self.compress:
+            data = zlib.compress(block, 1)
+            flags = FLAG_ZLIB
+        self._file.write(_BLOCK.pack(flags, len(block), len(data)))
+        self._file.write(data)
+        with self._cond:
+            self._buffered -= len(block)
+            self.blocks += 1
+            self.raw_bytes += len(block)
+            self.written_bytes += _BLOCK.size + len(data)
+
+
+class CaptureReader:
+    """Iterates the (offset, topic, payload) records of a memory-mapped capture file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.started_at = None
+        self.truncated = False
+        self._file = None
+        self._map = None
+        # Topics repeat per device; decode each once
+        self._topics = {}
+
+    def open(self):
+        """
+        Map the file and read its header.
+
+        Raises:
+            ValueError: Not a capture file, or an unsupported version
+        """
+        self._file = open(self.path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < _HEADER.size:
+            raise ValueError(f"{self.path} is not a capture file")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.started_at = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a capture file")
+        if version != VERSION:
+            raise ValueError(f"{self.path}: unsupported capture version {version}")
+        return self
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = self._file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self) -> Iterator[Tuple[float, str, bytes]]:
+        """Yield (seconds since capture start, topic, payload) in capture order."""
+        for data, start, end in self._blocks():
+            topics = self._topics
+            position = start
+            while position < end:
+                offset, topic_length, payload_length = _RECORD.unpack_from(data, position)
+                position += _RECORD.size
+                raw_topic = data[position:position + topic_length]
+                position += topic_length
+                topic = topics.get(raw_topic)
+                if topic is None:
+                    topic = topics[raw_topic] = raw_topic.decode('utf-8')
+                yield offset, topic, data[position:position + payload_length]
+                position += payload_length
+
+    def _blocks(self):
+        # Yields (buffer, start, end) of each complete block's records
+        data = self._map
+        size = len(data)
+        position = _HEADER.size
+        while position < size:
+            if position + _BLOCK.size > size:
+                self.truncated = True
+                return
+            flags, raw_length, stored_length = _BLOCK.unpack_from(data, position)
+            position += _BLOCK.size
+            if position + stored_length > size:
+                self.truncated = True
+                return
+            if flags & FLAG_ZLIB:
+                yield zlib.decompress(data[position:position + stored_length]), 0, raw_length
+            else:
+                yield data, position, position + stored_length
+            position += stored_length
+
+
+def replay(path: str, speed: float = 1.0, fcm: str = 'none', workers: int = None) -> dict:
+    """
+    Feed a capture through mqtt_handler.handle_message.
+
+    Messages are judged on the captured clock: their age is measured from
+    when they were recorded, and the transition, flap, coalescing and rate
+    limit filters (reset first) and their housekeeping see captured time, so
+    a replay gives the same notifications at any speed and on any day.
+
+    Args:
+        path: Capture file
+        speed: 1.0 replays at the captured pace, 2.0 twice as fast; 0 as fast as possible
+        fcm: Also send notifications through 'dry_run' or a local 'stub' (see loadgen)
+        workers: Dispatcher sender threads
+
+    Returns:
+        Report dict: messages, elapsed time, messages/s, notification latency and drops
+    """
+    from . import loadgen, mqtt_handler
+    from .dispatcher import Dispatcher
+
+    forward, cleanup = loadgen.fcm_forwarder(fcm)
+    recorder = loadgen.Recorder(forward)
+    dispatcher = Dispatcher(workers=workers, queue_size=1_000_000, send=recorder.send)
+    dispatcher.start()
+    mqtt_handler.set_dispatcher(dispatcher)
+    mqtt_handler.reset_filters()
+
+    messages = 0
+    with CaptureReader(path) as reader, open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        started = time.monotonic()
+        housekeeping_interval = mqtt_handler.housekeeper.interval
+        next_housekeeping = housekeeping_interval
+        for offset, topic, payload in reader:
+            if speed > 0:
+                delay = started + offset / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            if offset >= next_housekeeping:
+                mqtt_handler.housekeeper.run_once(reader.started_at + offset)
+                next_housekeeping = offset + housekeeping_interval
+            now = time.monotonic()
+            recorder.mark(mqtt_handler.extract_device_id(topic), now)
+            mqtt_handler.handle_message(topic, payload, now, captured_at=reader.started_at + offset)
+            messages += 1
+        ingest_elapsed = time.monotonic() - started
+        mqtt_handler.housekeeper.run_once(reader.started_at + next_housekeeping)
+        mqtt_handler.flush_coalesced(reader.started_at + next_housekeeping, flush_all=True)
+        dispatcher.stop(timeout=60)
+        truncated = reader.truncated
+    elapsed = time.monotonic() - started
+    cleanup()
+
+    stats = dispatcher.get_stats()
+    return {
+        'messages': messages,
+        'truncated': truncated,
+        'elapsed_s': round(elapsed, 3),
+        'messages_per_s': round(messages / ingest_elapsed, 1) if ingest_elapsed else 0.0,
+        'notifications': stats['submitted'],
+        'latency_ms': loadgen.percentiles(recorder.latencies),
+        'drops': {'queue_full': stats['dropped'], 'send_failed': stats['failed']},
+    }
+
+
+def info(path: str) -> dict:
+    """Summary of a capture file: records, duration, topics and sizes."""
+    records = 0
+    payload_bytes = 0
+    last = 0.0
+    devices = set()
+    with CaptureReader(path) as reader:
+        for offset, topic, payload in reader:
+            records += 1
+            payload_bytes += len(payload)
+            last = offset
+            devices.add(topic.split('/', 1)[0])
+        started_at = reader.started_at
+        truncated = reader.truncated
+    return {
+        'path': path,
+        'started_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started_at)),
+        'records': records,
+        'duration_s': round(last, 3),
+        'devices': len(devices),
+        'payload_bytes': payload_bytes,
+        'file_bytes': os.path.getsize(path),
+        'truncated': truncated,
+    }
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    info_parser = commands.add_parser('info', help='Summarize a capture file')
+    info_parser.add_argument('path')
+    replay_parser = commands.add_parser('replay', help='Feed a capture through the pipeline')
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--speed', type=float, default=1.0,
+                               help='Replay speed relative to the capture (default: 1.0)')
+    replay_parser.add_argument('--fast', action='store_true', help='Replay as fast as possible')
+    replay_parser.add_argument('--fcm', choices=('none', 'dry_run', 'stub'), default='none',
+                               help='Also send each notification through this transport')
+    replay_parser.add_argument('--workers', type=int, default=None, help='Dispatcher sender threads')
+    args = parser.parse_args(argv)
+
+    if args.command == 'info':
+        for key, value in info(args.path).items():
+            print(f"  {key:14s} {value}")
+        return 0
+    report = replay(args.path, speed=0 if args.fast else args.speed, fcm=args.fcm, workers=args.workers)
+    print(f"Replayed {report['messages']:,} messages in {report['elapsed_s']:.1f}s "
+          f"({report['messages_per_s']:,.0f} messages/s)"
+          f"{', capture truncated' if report['truncated'] else ''}")
+    print(f"  notifications: {report['notifications']:,}")
+    if report['latency_ms']:
+        print('  latency (ms):  ' + '  '.join(f"{k} {v:,.2f}" for k, v in report['latency_ms'].items()))
+    print('  drops:         ' + ', '.join(f"{k} {v:,}" for k, v in report['drops'].items()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
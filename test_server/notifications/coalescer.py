@@ -0,0 +1,173 @@
+"""
+Coalescer - Folds bursts of same-kind notifications into one digest.
+
+When a site's power returns, dozens of devices publish 'online' within
+seconds. Instead of one FCM send per device, the first event of a coalesced
+notification type opens a window of window_seconds; every event of that type
+arriving in the window is buffered. When the window closes, a lone event is
+sent as usual and two or more are sent as a single digest such as
+"12 devices came online", with the device IDs in the data payload.
+
+Buffering must not reorder a device's events. An event of the opposite type
+(device_offline for a buffered device_online, and so on) reverts the device
+to the state its users were last told about, so the two cancel out: the
+buffered event is removed from its batch and neither is sent. This holds
+whether or not the opposite type is itself coalesced, so a device_offline
+sent at once can never be followed by a stale device_online digest.
+
+Usage:
+    from .coalescer import Coalescer
+
+    coalescer = Coalescer(window_seconds=5, types=['device_online'])
+    if not coalescer.add('device_online', 'device123'):
+        ...  # type not coalesced, send now
+    for batch in coalescer.flush_due():
+        ...  # send batch
+"""
+import threading
+import time
+from typing import Iterable, List
+
+from .config import COALESCE_CONFIG, NOTIFICATION_TYPES
+
+# Notification types that undo each other for a device
+OPPOSITES = {
+    'device_online': 'device_offline',
+    'device_offline': 'device_online',
+    'pump_start': 'pump_stop',
+    'pump_stop': 'pump_start',
+}
+
+
+class CoalescedBatch:
+    """Events of one notification type collected during one window."""
+
+    __slots__ = ('notification_type', 'device_ids', 'opened_at', 'first_received_at')
+
+    def __init__(self, notification_type: str, opened_at: float, received_at: float):
+        self.notification_type = notification_type
+        # dict keeps arrival order and ignores repeats of a device
+        self.device_ids = {}
+        self.opened_at = opened_at
+        self.first_received_at = received_at
+
+    @property
+    def count(self) -> int:
+        return len(self.device_ids)
+
+    def digest_body(self) -> str:
+        """Notification text for the whole batch, e.g. '12 devices came online'."""
+        template = NOTIFICATION_TYPES[self.notification_type].get(
+            'digest_body', '{count} devices: ' + NOTIFICATION_TYPES[self.notification_type]['title'])
+        return template.format(count=self.count)
+
+    def digest_data(self, max_ids: int) -> dict:
+        """Data payload listing (up to max_ids of) the batch's device IDs."""
+        device_ids = list(self.device_ids)
+        data = {
+            'digest': 'true',
+            'count': str(len(device_ids)),
+            'device_ids': ','.join(device_ids[:max_ids]),
+        }
+        if len(device_ids) > max_ids:
+            data['truncated'] = 'true'
+        return data
+
+    def __repr__(self):
+        return f"CoalescedBatch({self.notification_type!r}, count={self.count})"
+
+
+class Coalescer:
+    """
+    Buffers coalesced notification types per time window.
+
+    add() is called from the MQTT thread and flush_due() from the
+    housekeeping thread, so both take the same lock.
+    """
+
+    def __init__(self, window_seconds: float = None, types: Iterable[str] = None, max_ids: int = None):
+        self.window_seconds = window_seconds if window_seconds is not None else COALESCE_CONFIG['window_seconds']
+        self.types = frozenset(types if types is not None else COALESCE_CONFIG['types'])
+        self.max_ids = max_ids if max_ids is not None else COALESCE_CONFIG['max_ids']
+        unknown = self.types - set(NOTIFICATION_TYPES)
+        if unknown:
+            raise ValueError(f"Unknown notification type(s) to coalesce: {', '.join(sorted(unknown))}")
+        self._open = {}
+        self._lock = threading.Lock()
+        self.events = 0
+        self.cancelled = 0
+        self.batches = 0
+        self.digests = 0
+
+    def add(self, notification_type: str, device_id: str, received_at: float = None,
+            now: float = None) -> bool:
+        """
+        Buffer an event if its type is coalesced, or cancel it against a
+        buffered event of the opposite type for the same device.
+
+        Args:
+            notification_type: Key of NOTIFICATION_TYPES
+            device_id: Device the event is about
+            received_at: time.monotonic() when the triggering message arrived
+            now: Clock the window is measured on, as passed to flush_due (default: time.monotonic())
+
+        Returns:
+            True if buffered or cancelled, False if the type is not coalesced (send it now)
+        """
+        opposite = OPPOSITES.get(notification_type)
+        if opposite in self.types and self._cancel(opposite, device_id):
+            return True
+        if notification_type not in self.types:
+            return False
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            batch = self._open.get(notification_type)
+            if batch is None:
+                batch = self._open[notification_type] = CoalescedBatch(
+                    notification_type, now, received_at if received_at is not None else now)
+            batch.device_ids[device_id] = None
+            self.events += 1
+        return True
+
+    def _cancel(self, notification_type: str, device_id: str) -> bool:
+        # Removes the device's buffered event of this type, if any
+        with self._lock:
+            batch = self._open.get(notification_type)
+            if batch is None or device_id not in batch.device_ids:
+                return False
+            del batch.device_ids[device_id]
+            if not batch.device_ids:
+                del self._open[notification_type]
+            self.cancelled += 1
+        return True
+
+    def flush_due(self, now: float = None) -> List[CoalescedBatch]:
+        """Close and return the batches whose window has ended."""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            due = [t for t, batch in self._open.items() if now - batch.opened_at >= self.window_seconds]
+            return self._close(due)
+
+    def flush_all(self) -> List[CoalescedBatch]:
+        """Close and return every open batch (e.g. on shutdown)."""
+        with self._lock:
+            return self._close(list(self._open))
+
+    def _close(self, notification_types: list) -> List[CoalescedBatch]:
+        batches = [self._open.pop(t) for t in notification_types]
+        self.batches += len(batches)
+        self.digests += sum(1 for batch in batches if batch.count > 1)
+        return batches
+
+    def get_stats(self) -> dict:
+        """Snapshot of buffered events, closed batches and digests sent."""
+        with self._lock:
+            return {
+                'open_batches': len(self._open),
+                'events': self.events,
+                'cancelled': self.cancelled,
+                'batches': self.batches,
+                'digests': self.digests,
+            }
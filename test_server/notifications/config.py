@@ -6,6 +6,7 @@ Download it from Firebase Console > Project Settings > Service Accounts > Genera
 Save it as 'firebase-admin-key.json' in this directory.
 """
 import os
+import socket
 
 # Path to Firebase Admin SDK credentials
 # Download from: Firebase Console > Project Settings > Service Accounts
@@ -25,6 +26,12 @@ MQTT_CONFIG = {
     'client_id': 'beegreen-notification-service',
     # Enable TLS for secure connection (required for HiveMQ Cloud)
     'use_tls': os.environ.get('MQTT_USE_TLS', 'true').lower() in ('true', '1', 'yes'),
+    # Multi-instance mode: when set, every instance joins this MQTT v5 shared
+    # subscription group ($share/<group>/<topic>) and the broker splits the
+    # messages between them. Each instance needs a unique client ID, built
+    # from client_id and instance_id.
+    'shared_group': os.environ.get('MQTT_SHARED_GROUP') or None,
+    'instance_id': os.environ.get('MQTT_INSTANCE_ID') or f'{socket.gethostname()}-{os.getpid()}',
 }
 
 # MQTT Topics to subscribe to
@@ -35,6 +42,13 @@ MQTT_TOPICS = {
     'device_status': '+/status',          # {deviceID}/status (online/offline)
 }
 
+# Extra payload values understood as ON / OFF for firmware-specific vocabularies
+# Comma-separated, e.g. NOTIFY_ON_TOKENS="running,up" NOTIFY_OFF_TOKENS="idle,down"
+STATE_VOCABULARY = {
+    'on': [t for t in os.environ.get('NOTIFY_ON_TOKENS', '').split(',') if t.strip()],
+    'off': [t for t in os.environ.get('NOTIFY_OFF_TOKENS', '').split(',') if t.strip()],
+}
+
 # FCM Topics that the app subscribes to
 FCM_TOPICS = {
     'pump_events': 'pump_events',
@@ -42,25 +56,249 @@ FCM_TOPICS = {
 }
 
 # Notification type definitions
+# 'digest_body' is the text used when several events are coalesced into one
+# notification (see COALESCE_CONFIG)
+# 'priority' is the dispatch lane: critical, default or bulk (see PRIORITY_CONFIG)
 NOTIFICATION_TYPES = {
     'pump_start': {
         'title': 'Pump Started',
         'body': 'Your irrigation pump has started',
         'fcm_topic': 'pump_events',
+        'digest_body': '{count} irrigation pumps have started',
+        'priority': 'bulk',
     },
     'pump_stop': {
         'title': 'Pump Stopped',
         'body': 'Your irrigation pump has stopped',
         'fcm_topic': 'pump_events',
+        'digest_body': '{count} irrigation pumps have stopped',
+        'priority': 'bulk',
     },
     'device_online': {
         'title': 'Device Online',
         'body': 'Your device is now connected',
         'fcm_topic': 'device_status',
+        'digest_body': '{count} devices came online',
+        'priority': 'default',
     },
     'device_offline': {
         'title': 'Device Offline',
         'body': 'Your device has disconnected',
         'fcm_topic': 'device_status',
+        'digest_body': '{count} devices went offline',
+        'priority': 'critical',
+    },
+    # Sent once a device that was flapping online/offline settles (see FLAP_CONFIG)
+    'device_stabilized': {
+        'title': 'Device Connection Stabilized',
+        'body': 'Your device connection was unstable and has now settled',
+        'fcm_topic': 'device_status',
+        'priority': 'default',
+    },
+    # Sent for a device whose notifications were rate limited (see RATE_LIMIT_CONFIG)
+    'notifications_limited': {
+        'title': 'Notifications Limited',
+        'body': 'Your device reported changes too often; some notifications were skipped',
+        'fcm_topic': 'device_status',
+        'priority': 'bulk',
     },
 }
+
+# Notification dispatch configuration
+# FCM sends run on a pool of sender threads fed by a bounded queue, so a slow
+# FCM round-trip never blocks the MQTT network loop.
+# Notifications of one device are sent one at a time, in order.
+# When the queue (or a device's share of it) is full new notifications are
+# dropped (and counted).
+DISPATCH_CONFIG = {
+    'workers': int(os.environ.get('NOTIFY_WORKERS', 4)),
+    'queue_size': int(os.environ.get('NOTIFY_QUEUE_SIZE', 1000)),
+    'device_queue_size': int(os.environ.get('NOTIFY_DEVICE_QUEUE_SIZE', 100)),
+}
+
+# Priority lanes of the dispatch queue
+# Each notification type's 'priority' picks a lane (default: 'default').
+# Sender threads serve lanes in proportion to their weight, so offline alerts
+# keep going out while a backlog of pump events drains; a lane whose oldest
+# notification has waited max_wait seconds is served next regardless.
+# queue_size bounds each lane separately.
+PRIORITY_CONFIG = {
+    'lanes': {
+        'critical': int(os.environ.get('NOTIFY_LANE_CRITICAL_WEIGHT', 8)),
+        'default': int(os.environ.get('NOTIFY_LANE_DEFAULT_WEIGHT', 3)),
+        'bulk': int(os.environ.get('NOTIFY_LANE_BULK_WEIGHT', 1)),
+    },
+    'max_wait': float(os.environ.get('NOTIFY_LANE_MAX_WAIT', 2.0)),
+}
+
+# Micro-batched FCM delivery (batch_sender.py)
+# When enabled, notifications are sent with messaging.send_each in batches of
+# up to max_size (FCM allows 500), flushed at the latest max_delay seconds
+# after the batch opened.
+BATCH_CONFIG = {
+    'enabled': os.environ.get('NOTIFY_BATCH', 'false').lower() in ('true', '1', 'yes'),
+    'max_size': int(os.environ.get('NOTIFY_BATCH_SIZE', 500)),
+    'max_delay': float(os.environ.get('NOTIFY_BATCH_DELAY', 0.05)),
+    'flushers': int(os.environ.get('NOTIFY_BATCH_FLUSHERS', 2)),
+}
+
+# Persistent outbox (outbox.py)
+# When enabled, every notification is committed to a SQLite database before
+# it is sent and removed once FCM acknowledged it; undelivered notifications
+# are sent again on startup, unless older than replay_max_age seconds.
+OUTBOX_CONFIG = {
+    'enabled': os.environ.get('NOTIFY_OUTBOX', 'false').lower() in ('true', '1', 'yes'),
+    'path': os.environ.get('NOTIFY_OUTBOX_PATH', os.path.join(os.path.dirname(__file__), 'outbox.db')),
+    # Extra seconds to gather rows into one commit (0 = commit as soon as the previous one ends)
+    'commit_interval': float(os.environ.get('NOTIFY_OUTBOX_COMMIT_INTERVAL', 0)),
+    # SQLite synchronous mode: FULL syncs every commit, NORMAL may lose the last ones on power loss
+    'synchronous': os.environ.get('NOTIFY_OUTBOX_SYNC', 'FULL'),
+    'replay_max_age': float(os.environ.get('NOTIFY_OUTBOX_REPLAY_MAX_AGE', 3600)),
+}
+
+# Retries of failed FCM sends (retry.py)
+# Transient failures are retried with full-jitter exponential backoff (or the
+# server's Retry-After); after breaker_threshold consecutive failures sends
+# pause for breaker_open_seconds. Waiting sends are released at no more than
+# drain_rate per second.
+RETRY_CONFIG = {
+    'enabled': os.environ.get('NOTIFY_RETRY', 'true').lower() in ('true', '1', 'yes'),
+    'max_attempts': int(os.environ.get('NOTIFY_RETRY_MAX_ATTEMPTS', 6)),
+    'base_delay': float(os.environ.get('NOTIFY_RETRY_BASE_DELAY', 0.5)),
+    'max_delay': float(os.environ.get('NOTIFY_RETRY_MAX_DELAY', 60)),
+    'drain_rate': float(os.environ.get('NOTIFY_RETRY_DRAIN_RATE', 50)),
+    'workers': int(os.environ.get('NOTIFY_RETRY_WORKERS', 4)),
+    'breaker_threshold': int(os.environ.get('NOTIFY_BREAKER_THRESHOLD', 5)),
+    'breaker_open_seconds': float(os.environ.get('NOTIFY_BREAKER_OPEN_SECONDS', 30)),
+}
+
+# Rate limiting of outgoing notifications (rate_limiter.py)
+# Token buckets per device, per notification type and globally: rate tokens
+# per second, up to burst at once; a rate of 0 turns that level off. Devices
+# over their limit get one 'notifications_limited' summary per
+# summary_interval seconds (0 = no summaries). Critical types (device_offline)
+# are never limited: a dropped offline alert is worse than a noisy device.
+RATE_LIMIT_CONFIG = {
+    'enabled': os.environ.get('NOTIFY_RATE_LIMIT', 'true').lower() in ('true', '1', 'yes'),
+    'device_rate': float(os.environ.get('NOTIFY_DEVICE_RATE', 0.1)),
+    'device_burst': float(os.environ.get('NOTIFY_DEVICE_BURST', 10)),
+    'type_rate': float(os.environ.get('NOTIFY_TYPE_RATE', 0)),
+    'type_burst': float(os.environ.get('NOTIFY_TYPE_BURST', 100)),
+    'global_rate': float(os.environ.get('NOTIFY_GLOBAL_RATE', 0)),
+    'global_burst': float(os.environ.get('NOTIFY_GLOBAL_BURST', 500)),
+    'max_devices': int(os.environ.get('NOTIFY_RATE_LIMIT_DEVICES', 100000)),
+    'summary_interval': float(os.environ.get('NOTIFY_RATE_LIMIT_SUMMARY', 300)),
+}
+
+# Capture of received MQTT traffic (capture.py)
+# When path is set, every received message is appended to that file for
+# replay with python -m test_server.notifications.capture replay <path>.
+CAPTURE_CONFIG = {
+    'path': os.environ.get('NOTIFY_CAPTURE', ''),
+    'compress': os.environ.get('NOTIFY_CAPTURE_COMPRESS', 'true').lower() in ('true', '1', 'yes'),
+    'block_size': int(os.environ.get('NOTIFY_CAPTURE_BLOCK_SIZE', 64 * 1024)),
+    # Seconds before a partly filled block is written anyway
+    'flush_interval': float(os.environ.get('NOTIFY_CAPTURE_FLUSH_INTERVAL', 1.0)),
+    # Bytes waiting for the disk before new records are dropped
+    'max_buffer': int(os.environ.get('NOTIFY_CAPTURE_MAX_BUFFER', 64 * 1024 * 1024)),
+}
+
+# Transition-only notifications
+# Remember each device's last reported pump and online/offline state and only
+# notify when it changes. Devices silent for ttl_seconds are forgotten.
+STATE_CACHE_CONFIG = {
+    'enabled': os.environ.get('NOTIFY_TRANSITIONS_ONLY', 'true').lower() in ('true', '1', 'yes'),
+    'max_devices': int(os.environ.get('NOTIFY_STATE_CACHE_SIZE', 100000)),
+    'ttl_seconds': float(os.environ.get('NOTIFY_STATE_TTL', 24 * 3600)),
+}
+
+# Flap damping for devices bouncing online/offline
+# Each device may notify max_transitions online/offline changes per sliding
+# window; further changes are suppressed until the device holds one state for
+# hold_down_seconds, then one 'device_stabilized' summary is sent.
+FLAP_CONFIG = {
+    'enabled': os.environ.get('NOTIFY_FLAP_DAMPING', 'true').lower() in ('true', '1', 'yes'),
+    'window_seconds': float(os.environ.get('NOTIFY_FLAP_WINDOW', 300)),
+    'max_transitions': int(os.environ.get('NOTIFY_FLAP_MAX_TRANSITIONS', 4)),
+    'hold_down_seconds': float(os.environ.get('NOTIFY_FLAP_HOLD_DOWN', 120)),
+}
+
+# Coalescing of notification bursts into digests
+# The first event of a listed type opens a window of window_seconds; all events
+# of that type in the window are sent as one digest ("12 devices came online")
+# listing up to max_ids device IDs. A window of 0 (the default) disables
+# coalescing. Coalescing is opt-in because it delays every notification of a
+# listed type, including a lone one, by up to window_seconds plus one
+# housekeeping tick (0.5 s): with a window of 5, a device_online arrives up to
+# about 5.5 s after the device came back.
+# device_offline is critical and not coalesced by default: it would wait for
+# the window instead of taking the fast lane.
+COALESCE_CONFIG = {
+    'window_seconds': float(os.environ.get('NOTIFY_COALESCE_WINDOW', 0)),
+    'types': [t for t in os.environ.get('NOTIFY_COALESCE_TYPES', 'device_online').split(',') if t],
+    'max_ids': int(os.environ.get('NOTIFY_COALESCE_MAX_IDS', 100)),
+}
+
+# Sharded mode: spread message handling over worker processes
+# With shards > 1 the MQTT process only routes messages, hashed on device ID,
+# to that many worker processes, which parse, filter and send. Messages are
+# forwarded in batches of up to batch_size, or after max_delay seconds.
+SHARD_CONFIG = {
+    'shards': int(os.environ.get('NOTIFY_SHARDS', 0)),
+    'batch_size': int(os.environ.get('NOTIFY_SHARD_BATCH', 100)),
+    'max_delay': float(os.environ.get('NOTIFY_SHARD_MAX_DELAY', 0.02)),
+    # Seconds between per-shard throughput log lines
+    'stats_interval': float(os.environ.get('NOTIFY_SHARD_STATS_INTERVAL', 60)),
+}
+
+# asyncio service (async_service.py)
+# FCM HTTP v1 requests are multiplexed over HTTP/2 connections; at most
+# max_in_flight sends are outstanding at once.
+ASYNC_CONFIG = {
+    'max_in_flight': int(os.environ.get('NOTIFY_ASYNC_MAX_IN_FLIGHT', 1000)),
+    'connections': int(os.environ.get('NOTIFY_ASYNC_CONNECTIONS', 4)),
+    # Base URL of the FCM v1 API (override to point at a local stand-in)
+    'fcm_endpoint': os.environ.get('FCM_ENDPOINT', 'https://fcm.googleapis.com'),
+    'timeout': float(os.environ.get('FCM_TIMEOUT', 10)),
+}
+
+# Delivery transport of fcm_service (transport.py)
+# - fcm: firebase_admin against real FCM (needs firebase-admin-key.json)
+# - dry_run: nothing leaves the process; messages are encoded and counted
+# - http: FCM HTTP v1 requests to endpoint, e.g. the local stand-in
+#   (python -m test_server.notifications.fcm_stub)
+TRANSPORT_CONFIG = {
+    'transport': os.environ.get('NOTIFY_TRANSPORT', 'fcm').lower(),
+    'endpoint': os.environ.get('FCM_ENDPOINT', 'https://fcm.googleapis.com'),
+    # Project in the request URL (default: from the credentials, else 'beegreen-local')
+    'project_id': os.environ.get('FCM_PROJECT_ID', ''),
+    'timeout': float(os.environ.get('FCM_TIMEOUT', 10)),
+    # Threads sending the messages of one send_each batch
+    'workers': int(os.environ.get('NOTIFY_HTTP_WORKERS', 16)),
+    # Simulated round-trip of the dry_run transport, in seconds
+    'dry_run_latency': float(os.environ.get('NOTIFY_DRY_RUN_LATENCY', 0)),
+}
+
+# Local FCM v1 stand-in (fcm_stub.py)
+# Answers messages:send like FCM after latency (+/- jitter) seconds; a share
+# of requests fail with 503 UNAVAILABLE (error_rate) or 429
+# RESOURCE_EXHAUSTED with a Retry-After header (throttle_rate).
+FCM_STUB_CONFIG = {
+    'host': os.environ.get('FCM_STUB_HOST', '127.0.0.1'),
+    'port': int(os.environ.get('FCM_STUB_PORT', 8089)),
+    'latency': float(os.environ.get('FCM_STUB_LATENCY', 0.02)),
+    'jitter': float(os.environ.get('FCM_STUB_JITTER', 0.01)),
+    'error_rate': float(os.environ.get('FCM_STUB_ERROR_RATE', 0)),
+    'throttle_rate': float(os.environ.get('FCM_STUB_THROTTLE_RATE', 0)),
+    'retry_after': int(os.environ.get('FCM_STUB_RETRY_AFTER', 1)),
+}
+
+# Prometheus-style metrics endpoint (metrics.py), served on
+# http://<host>:<port>/metrics while the service runs. Sharded workers serve
+# their own on port + 1 + shard (a port of 0 picks free ports everywhere).
+METRICS_CONFIG = {
+    'enabled': os.environ.get('NOTIFY_METRICS', 'true').lower() in ('true', '1', 'yes'),
+    # Local only by default; set 0.0.0.0 to let a remote Prometheus scrape it
+    'host': os.environ.get('NOTIFY_METRICS_HOST', '127.0.0.1'),
+    'port': int(os.environ.get('NOTIFY_METRICS_PORT', 9108)),
+}
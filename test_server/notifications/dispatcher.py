@@ -0,0 +1,298 @@
+"""
+Dispatcher - Hands notifications from the MQTT thread to FCM sender workers.
+
+The MQTT callback only decides *which* notification to send and queues it;
+a pool of sender threads performs the (slow) FCM HTTP round-trips.  This keeps
+paho's network loop free to answer keepalives and PUBACKs during bursts.
+
+Events are queued per device on a KeyedExecutor: notifications of one device
+are sent one at a time in the order they were submitted, so a pump_stop can
+never reach FCM before the pump_start it follows, while different devices
+are sent concurrently.
+
+The send function may return a concurrent.futures.Future instead of a result
+(see batch_sender.py); the event counts as sent or failed when it completes.
+
+Each event goes to the priority lane of its notification type (see
+PRIORITY_CONFIG): senders favour the critical lane, so a device_offline is
+not stuck behind a backlog of pump events of other devices.
+
+Sent, failed and dropped notifications are also counted per type in the
+notify_notifications_* metrics (see metrics.py).
+
+With an outbox (see outbox.py) every event is logged before it is sent and
+acknowledged once sent; replay() re-queues what an earlier run left undelivered.
+
+Usage:
+    from .dispatcher import Dispatcher
+
+    dispatcher = Dispatcher(workers=4, queue_size=1000)
+    dispatcher.start()
+    dispatcher.submit('pump_start', device_id='device123')
+    ...
+    print(dispatcher.get_stats())
+    dispatcher.stop()
+"""
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from typing import Callable
+
+from . import metrics
+from .config import DISPATCH_CONFIG, NOTIFICATION_TYPES, PRIORITY_CONFIG
+from .keyed_executor import DEFAULT_LANE, KeyedExecutor
+
+SENT = metrics.counter('notify_notifications_sent_total', 'Notifications delivered, by type', ['type'])
+FAILED = metrics.counter('notify_notifications_failed_total', 'Notifications that failed to send, by type', ['type'])
+DROPPED = metrics.counter('notify_notifications_dropped_total', 'Notifications dropped on a full queue, by type',
+                          ['type'])
+NOTIFICATION_LATENCY = metrics.histogram('notify_notification_seconds',
+                                         'Time from message receipt until its notification is sent')
+
+
+class NotificationEvent:
+    """A notification waiting to be sent."""
+
+    __slots__ = ('notification_type', 'device_id', 'data', 'body', 'received_at', 'enqueued_at', 'outbox_id')
+
+    def __init__(self, notification_type: str, device_id: str = None, data: dict = None,
+                 body: str = None, received_at: float = None):
+        self.notification_type = notification_type
+        self.device_id = device_id
+        self.data = data
+        self.body = body
+        now = time.monotonic()
+        self.received_at = received_at if received_at is not None else now
+        self.enqueued_at = now
+        # Row in the outbox, if one is used
+        self.outbox_id = None
+
+    def __repr__(self):
+        return f"NotificationEvent({self.notification_type!r}, device_id={self.device_id!r})"
+
+
+class LatencyStats:
+    """Running count / average / max of a latency, in seconds. Thread-safe."""
+
+    __slots__ = ('count', 'total', 'max', '_lock')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            avg = self.total / self.count if self.count else 0.0
+            return {
+                'count': self.count,
+                'avg_ms': round(avg * 1000, 3),
+                'max_ms': round(self.max * 1000, 3),
+            }
+
+
+def _send_via_fcm(event: NotificationEvent):
+    """Default send function: deliver the event to its FCM topic."""
+    from . import fcm_service
+    return fcm_service.send_to_topic(
+        event.notification_type,
+        data=event.data,
+        device_id=event.device_id,
+        body=event.body,
+    )
+
+
+class Dispatcher:
+    """
+    Bounded per-device queues plus a pool of sender threads between MQTT ingest and FCM.
+
+    Stages timed by the dispatcher:
+    - ingest: time spent in the MQTT callback (recorded by the caller)
+    - queue: time an event waits in the queue before a worker picks it up
+    - send: time spent in the send function (the FCM round-trip)
+    - total: from message receipt until the send completes
+    """
+
+    STAGES = ('ingest', 'queue', 'send', 'total')
+
+    def __init__(self, workers: int = None, queue_size: int = None,
+                 send: Callable[[NotificationEvent], object] = None, device_queue_size: int = None,
+                 outbox=None, lanes: dict = None, max_wait: float = None):
+        self.workers = workers if workers is not None else DISPATCH_CONFIG['workers']
+        self.queue_size = queue_size if queue_size is not None else DISPATCH_CONFIG['queue_size']
+        self.device_queue_size = (device_queue_size if device_queue_size is not None
+                                  else DISPATCH_CONFIG['device_queue_size'])
+        self.lanes = lanes if lanes is not None else PRIORITY_CONFIG['lanes']
+        self.max_wait = max_wait if max_wait is not None else PRIORITY_CONFIG['max_wait']
+        self._send = send or _send_via_fcm
+        self._outbox = outbox
+        self._executor = KeyedExecutor(
+            handler=self._deliver,
+            workers=self.workers,
+            max_pending=self.queue_size,
+            max_per_key=self.device_queue_size,
+            name='fcm-sender',
+            lanes=self.lanes,
+            max_wait=self.max_wait,
+        )
+        self._started = False
+        self._counter_lock = threading.Lock()
+        self.submitted = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latency = {stage: LatencyStats() for stage in self.STAGES}
+        # Queue wait per lane
+        self.lane_latency = {lane: LatencyStats() for lane in self.lanes}
+
+    def start(self):
+        """Start the sender threads. Safe to call more than once."""
+        if self._started:
+            return
+        self._executor.start()
+        self._started = True
+        print(f"Dispatcher started: {self.workers} sender(s), queue size {self.queue_size} per lane, "
+              f"lanes {self.lanes}")
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Stop the sender threads after the queue drains.
+
+        Args:
+            timeout: Seconds to wait for each sender thread to finish
+        """
+        self._executor.stop(timeout)
+        self._started = False
+
+    def submit(self, notification_type: str, device_id: str = None, data: dict = None,
+               body: str = None, received_at: float = None) -> bool:
+        """
+        Queue a notification behind earlier ones of the same device. Never blocks.
+
+        Args:
+            notification_type: Key of NOTIFICATION_TYPES
+            device_id: Device the notification is about
+            data: Additional data payload
+            body: Text replacing the notification type's default body
+            received_at: time.monotonic() when the triggering message arrived
+
+        Returns:
+            True if queued, False if the dispatcher or the device's queue was
+            full and the event was dropped (with an outbox, until the next start)
+        """
+        event = NotificationEvent(notification_type, device_id, data, body, received_at)
+        if self._outbox is not None:
+            self._outbox.append(event)
+        return self._enqueue(event)
+
+    def replay(self) -> int:
+        """
+        Queue the events an earlier run left in the outbox. Call once after start().
+
+        Returns:
+            Number of events queued
+        """
+        if self._outbox is None:
+            return 0
+        events = self._outbox.pending()
+        queued = sum(1 for event in events if self._enqueue(event))
+        if events:
+            print(f"Replaying {queued} undelivered notification(s) from the outbox")
+        return queued
+
+    def lane_of(self, notification_type: str) -> str:
+        """Priority lane of a notification type (the default lane if it has none or an unknown one)."""
+        lane = NOTIFICATION_TYPES.get(notification_type, {}).get('priority', DEFAULT_LANE)
+        return lane if lane in self.lane_latency else self._executor.default_lane
+
+    def _enqueue(self, event: NotificationEvent) -> bool:
+        if not self._executor.submit(event.device_id, event, self.lane_of(event.notification_type)):
+            with self._counter_lock:
+                self.dropped += 1
+            DROPPED.labels(event.notification_type).inc()
+            # An outbox row stays in place: the next start replays the event
+            print(f"!!! Dispatch queue full ({self.queue_size} per lane, "
+                  f"{self.device_queue_size} per device), dropped {event}")
+            return False
+        with self._counter_lock:
+            self.submitted += 1
+        return True
+
+    def record_latency(self, stage: str, seconds: float):
+        """Record a latency sample for one of STAGES."""
+        self.latency[stage].record(seconds)
+
+    def queue_depth(self) -> int:
+        """Number of events waiting for a sender."""
+        return self._executor.pending()
+
+    def get_stats(self) -> dict:
+        """Snapshot of queue depth, counters and per-stage latency."""
+        with self._counter_lock:
+            stats = {
+                'queue_depth': self.queue_depth(),
+                'queue_size': self.queue_size,
+                'active_devices': self._executor.active_keys(),
+                'workers': self.workers,
+                'submitted': self.submitted,
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+            }
+        stats['latency'] = {stage: s.snapshot() for stage, s in self.latency.items()}
+        stats['lanes'] = self._executor.get_stats()['lanes']
+        for lane, lane_stats in stats['lanes'].items():
+            lane_stats['queue_latency'] = self.lane_latency[lane].snapshot()
+        return stats
+
+    def _deliver(self, event: NotificationEvent):
+        # Runs on a sender thread; the executor guarantees one event per device at a time
+        started = time.monotonic()
+        self.latency['queue'].record(started - event.enqueued_at)
+        self.lane_latency[self.lane_of(event.notification_type)].record(started - event.enqueued_at)
+        if event.outbox_id is not None:
+            # Usually committed long ago; only a fresh event waits for the next group commit
+            self._outbox.wait_durable(event.outbox_id)
+        try:
+            result = self._send(event)
+        except Exception as e:
+            self._finish(event, started, error=e)
+            return None
+        if isinstance(result, Future):
+            # Sent later (e.g. in a batch); the device stays busy until then
+            result.add_done_callback(lambda future: self._finish_future(event, started, future))
+            return result
+        self._finish(event, started, result)
+        return None
+
+    def _finish_future(self, event: NotificationEvent, started: float, future: Future):
+        error = future.exception()
+        self._finish(event, started, None if error else future.result(), error)
+
+    def _finish(self, event: NotificationEvent, started: float, result=None, error: Exception = None):
+        if error is None:
+            with self._counter_lock:
+                self.sent += 1
+            SENT.labels(event.notification_type).inc()
+            if event.outbox_id is not None:
+                self._outbox.ack(event.outbox_id)
+            print(f">>> FCM Response: {result}")
+        else:
+            with self._counter_lock:
+                self.failed += 1
+            FAILED.labels(event.notification_type).inc()
+            print(f"!!! ERROR sending notification {event}: {type(error).__name__}: {error}")
+            traceback.print_exception(type(error), error, error.__traceback__)
+        finished = time.monotonic()
+        self.latency['send'].record(finished - started)
+        self.latency['total'].record(finished - event.received_at)
+        NOTIFICATION_LATENCY.observe(finished - event.received_at)
@@ -2,11 +2,28 @@
 FCM Service - Firebase Cloud Messaging operations
 
 This module handles sending push notifications via Firebase Admin SDK.
+
+Messages are built from templates compiled once per notification type: the
+title, topic and Android/APNs settings that never change are prepared up
+front, so a send only fills in the body and data of the event. Notification
+types added at runtime with register_notification_type get a template too.
+
+Built messages are delivered by a transport (see transport.py): real FCM by
+default, or a dry-run sink or an HTTP endpoint such as the local stand-in,
+picked with NOTIFY_TRANSPORT or set_transport(). Each transport call is
+timed, and failed messages counted, in the notify_fcm_* metrics.
 """
 import os
+import threading
+import time
 import firebase_admin
 from firebase_admin import credentials, messaging
+from . import metrics
 from .config import FIREBASE_CREDENTIALS_PATH, NOTIFICATION_TYPES
+from .transport import Transport, create_transport
+
+FCM_LATENCY = metrics.histogram('notify_fcm_request_seconds', 'Time per transport call, by method', ['method'])
+FCM_ERRORS = metrics.counter('notify_fcm_errors_total', 'Messages FCM did not accept, by error', ['error'])
 
 # Initialize Firebase Admin SDK
 _app = None
@@ -30,74 +47,224 @@ def _get_firebase_app():
     return _app
 
 
-def send_to_topic(notification_type: str, data: dict = None, device_id: str = None):
-    """
-    Send a notification to all subscribers of a topic.
+# Delivers built messages (created on first use, see get_transport)
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> Transport:
+    """Return the transport used to send messages, creating it from TRANSPORT_CONFIG if needed."""
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = create_transport()
+                print(f"FCM transport: {_transport.name}")
+    return _transport
+
+
+def set_transport(transport: Transport):
+    """Replace the transport used to send messages (e.g. with a DryRunTransport)."""
+    global _transport
+    _transport = transport
+
+
+def _deliver(method: str, *args):
+    # get_transport().<method>(*args), recording its latency and the messages that failed
+    started = time.perf_counter()
+    try:
+        response = getattr(get_transport(), method)(*args)
+    except Exception as e:
+        FCM_ERRORS.labels(type(e).__name__).inc()
+        raise
+    finally:
+        FCM_LATENCY.labels(method).observe(time.perf_counter() - started)
+    if isinstance(response, messaging.BatchResponse) and response.failure_count:
+        for item in response.responses:
+            if item.exception is not None:
+                FCM_ERRORS.labels(type(item.exception).__name__).inc()
+    return response
 
-    Args:
-        notification_type: One of 'pump_start', 'pump_stop', 'device_online', 'device_offline'
-        data: Additional data payload to include
-        device_id: Optional device ID to include in the notification
 
-    Returns:
-        str: Message ID from Firebase
+class NotificationTemplate:
+    """
+    The parts of a notification type's FCM message shared by every send.
 
-    Example:
-        send_to_topic('pump_start', device_id='device123')
+    Messages are treated as read-only by firebase_admin, so the Android
+    config is built once and shared by all messages of the type.
     """
-    _get_firebase_app()
-
-    notif_config = NOTIFICATION_TYPES.get(notification_type)
-    if not notif_config:
-        raise ValueError(f"Unknown notification type: {notification_type}")
-
-    # Build notification body with device ID if provided
-    body = notif_config['body']
-    if device_id:
-        body = f"{body} (Device: {device_id})"
-
-    # Build data payload
-    payload_data = {
-        'type': notification_type,
-        'timestamp': str(int(__import__('time').time())),
-    }
-    if device_id:
-        payload_data['device_id'] = device_id
-    if data:
-        payload_data.update({k: str(v) for k, v in data.items()})
-
-    message = messaging.Message(
-        notification=messaging.Notification(
-            title=notif_config['title'],
-            body=body,
-        ),
-        data=payload_data,
-        topic=notif_config['fcm_topic'],
+
+    __slots__ = ('notification_type', 'title', 'body', 'fcm_topic', 'android')
+
+    def __init__(self, notification_type: str, notif_config: dict):
+        self.notification_type = notification_type
+        self.title = notif_config['title']
+        self.body = notif_config['body']
+        self.fcm_topic = notif_config['fcm_topic']
         # Android specific configuration
-        android=messaging.AndroidConfig(
+        self.android = messaging.AndroidConfig(
             priority='high',
             notification=messaging.AndroidNotification(
                 channel_id='beegreen_notifications',
                 priority='high',
             ),
-        ),
-        # iOS (APNs) specific configuration
-        apns=messaging.APNSConfig(
-            payload=messaging.APNSPayload(
-                aps=messaging.Aps(
-                    alert=messaging.ApsAlert(
-                        title=notif_config['title'],
-                        body=body,
+        )
+
+    def render_body(self, body: str = None, device_id: str = None) -> str:
+        """Notification text: the given or default body, with the device ID if provided."""
+        body = body or self.body
+        if device_id:
+            body = f"{body} (Device: {device_id})"
+        return body
+
+    def render_data(self, data: dict = None, device_id: str = None) -> dict:
+        """Data payload: type, timestamp, device ID and the event's extra fields as strings."""
+        payload_data = {
+            'type': self.notification_type,
+            'timestamp': str(int(time.time())),
+        }
+        if device_id:
+            payload_data['device_id'] = device_id
+        if data:
+            payload_data.update({k: str(v) for k, v in data.items()})
+        return payload_data
+
+    def build(self, data: dict = None, device_id: str = None, body: str = None,
+              token: str = None) -> messaging.Message:
+        """Message to the type's topic, or to one device if token is given."""
+        body = self.render_body(body, device_id)
+        return messaging.Message(
+            notification=messaging.Notification(title=self.title, body=body),
+            data=self.render_data(data, device_id),
+            topic=None if token else self.fcm_topic,
+            token=token,
+            android=self.android,
+            # iOS (APNs) specific configuration; the alert carries the per-event body
+            apns=messaging.APNSConfig(
+                payload=messaging.APNSPayload(
+                    aps=messaging.Aps(
+                        alert=messaging.ApsAlert(title=self.title, body=body),
+                        sound='default',
+                        badge=1,
                     ),
-                    sound='default',
-                    badge=1,
                 ),
             ),
-        ),
-    )
+        )
+
+    def build_multicast(self, tokens: list, data: dict = None,
+                        device_id: str = None) -> messaging.MulticastMessage:
+        """Message to a list of device tokens."""
+        return messaging.MulticastMessage(
+            notification=messaging.Notification(title=self.title, body=self.render_body(None, device_id)),
+            data=self.render_data(data, device_id),
+            tokens=tokens,
+        )
 
-    response = messaging.send(message)
-    print(f"Notification sent: {notification_type} -> {notif_config['fcm_topic']} (ID: {response})")
+    def __repr__(self):
+        return f"NotificationTemplate({self.notification_type!r}, topic={self.fcm_topic!r})"
+
+
+# Compiled templates by notification type (see compile_templates)
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def compile_templates() -> dict:
+    """(Re)build the template of every entry in NOTIFICATION_TYPES."""
+    global _templates
+    with _templates_lock:
+        _templates = {t: NotificationTemplate(t, c) for t, c in NOTIFICATION_TYPES.items()}
+    return _templates
+
+
+def get_template(notification_type: str) -> NotificationTemplate:
+    """
+    Return the compiled template of a notification type.
+
+    Types added to NOTIFICATION_TYPES after startup are compiled on first use.
+
+    Raises:
+        ValueError: Unknown notification type
+    """
+    template = _templates.get(notification_type)
+    if template is None:
+        notif_config = NOTIFICATION_TYPES.get(notification_type)
+        if not notif_config:
+            raise ValueError(f"Unknown notification type: {notification_type}")
+        template = NotificationTemplate(notification_type, notif_config)
+        with _templates_lock:
+            _templates[notification_type] = template
+    return template
+
+
+def register_notification_type(notification_type: str, title: str, body: str, fcm_topic: str,
+                               digest_body: str = None, priority: str = None) -> NotificationTemplate:
+    """
+    Add (or replace) a notification type at runtime.
+
+    Args:
+        notification_type: New key of NOTIFICATION_TYPES, e.g. 'low_water'
+        title: Notification title
+        body: Default notification text
+        fcm_topic: FCM topic the app subscribes to
+        digest_body: Text of a coalesced digest, with a {count} placeholder (optional)
+        priority: Dispatch lane, e.g. 'critical' (optional, see PRIORITY_CONFIG)
+
+    Returns:
+        The compiled template
+
+    Example:
+        register_notification_type('low_water', 'Low Water', 'The tank is almost empty', 'pump_events')
+    """
+    notif_config = {'title': title, 'body': body, 'fcm_topic': fcm_topic}
+    if digest_body:
+        notif_config['digest_body'] = digest_body
+    if priority:
+        notif_config['priority'] = priority
+    template = NotificationTemplate(notification_type, notif_config)
+    with _templates_lock:
+        NOTIFICATION_TYPES[notification_type] = notif_config
+        _templates[notification_type] = template
+    return template
+
+
+def build_message(notification_type: str, data: dict = None, device_id: str = None, body: str = None,
+                  token: str = None) -> messaging.Message:
+    """
+    Build the FCM message for a notification.
+
+    Args:
+        notification_type: One of 'pump_start', 'pump_stop', 'device_online', 'device_offline'
+        data: Additional data payload to include
+        device_id: Optional device ID to include in the notification
+        body: Optional text replacing the notification type's default body
+        token: FCM device token; if omitted the message goes to the type's topic
+
+    Returns:
+        messaging.Message ready for messaging.send / messaging.send_each
+    """
+    return get_template(notification_type).build(data=data, device_id=device_id, body=body, token=token)
+
+
+def send_to_topic(notification_type: str, data: dict = None, device_id: str = None, body: str = None):
+    """
+    Send a notification to all subscribers of a topic.
+
+    Args:
+        notification_type: One of 'pump_start', 'pump_stop', 'device_online', 'device_offline'
+        data: Additional data payload to include
+        device_id: Optional device ID to include in the notification
+        body: Optional text replacing the notification type's default body
+
+    Returns:
+        str: Message ID from Firebase
+
+    Example:
+        send_to_topic('pump_start', device_id='device123')
+    """
+    message = build_message(notification_type, data=data, device_id=device_id, body=body)
+    response = _deliver('send', message)
+    print(f"Notification sent: {notification_type} -> {message.topic} (ID: {response})")
     return response
 
 
@@ -117,58 +284,25 @@ def send_to_device(token: str, notification_type: str, data: dict = None, device
     Example:
         send_to_device('fcm_token_here', 'pump_stop', device_id='device123')
     """
-    _get_firebase_app()
-
-    notif_config = NOTIFICATION_TYPES.get(notification_type)
-    if not notif_config:
-        raise ValueError(f"Unknown notification type: {notification_type}")
-
-    body = notif_config['body']
-    if device_id:
-        body = f"{body} (Device: {device_id})"
-
-    payload_data = {
-        'type': notification_type,
-        'timestamp': str(int(__import__('time').time())),
-    }
-    if device_id:
-        payload_data['device_id'] = device_id
-    if data:
-        payload_data.update({k: str(v) for k, v in data.items()})
-
-    message = messaging.Message(
-        notification=messaging.Notification(
-            title=notif_config['title'],
-            body=body,
-        ),
-        data=payload_data,
-        token=token,
-        android=messaging.AndroidConfig(
-            priority='high',
-            notification=messaging.AndroidNotification(
-                channel_id='beegreen_notifications',
-                priority='high',
-            ),
-        ),
-        apns=messaging.APNSConfig(
-            payload=messaging.APNSPayload(
-                aps=messaging.Aps(
-                    alert=messaging.ApsAlert(
-                        title=notif_config['title'],
-                        body=body,
-                    ),
-                    sound='default',
-                    badge=1,
-                ),
-            ),
-        ),
-    )
-
-    response = messaging.send(message)
+    message = build_message(notification_type, data=data, device_id=device_id, token=token)
+    response = _deliver('send', message)
     print(f"Notification sent to device: {notification_type} (ID: {response})")
     return response
 
 
+def send_batch(messages: list):
+    """
+    Send up to 500 messages in one FCM batch request.
+
+    Args:
+        messages: List of messaging.Message (e.g. from build_message)
+
+    Returns:
+        BatchResponse: responses[i] is the result of messages[i]
+    """
+    return _deliver('send_each', messages)
+
+
 def send_multicast(tokens: list, notification_type: str, data: dict = None, device_id: str = None):
     """
     Send a notification to multiple devices.
@@ -182,34 +316,11 @@ def send_multicast(tokens: list, notification_type: str, data: dict = None, devi
     Returns:
         BatchResponse: Firebase batch response with success/failure counts
     """
-    _get_firebase_app()
-
-    notif_config = NOTIFICATION_TYPES.get(notification_type)
-    if not notif_config:
-        raise ValueError(f"Unknown notification type: {notification_type}")
-
-    body = notif_config['body']
-    if device_id:
-        body = f"{body} (Device: {device_id})"
-
-    payload_data = {
-        'type': notification_type,
-        'timestamp': str(int(__import__('time').time())),
-    }
-    if device_id:
-        payload_data['device_id'] = device_id
-    if data:
-        payload_data.update({k: str(v) for k, v in data.items()})
-
-    message = messaging.MulticastMessage(
-        notification=messaging.Notification(
-            title=notif_config['title'],
-            body=body,
-        ),
-        data=payload_data,
-        tokens=tokens,
-    )
-
-    response = messaging.send_each_for_multicast(message)
+    message = get_template(notification_type).build_multicast(tokens, data=data, device_id=device_id)
+
+    response = _deliver('send_multicast', message)
     print(f"Multicast sent: {response.success_count} success, {response.failure_count} failed")
     return response
+
+
+compile_templates()
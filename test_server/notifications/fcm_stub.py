@@ -0,0 +1,229 @@
+"""
+FCM Stub - Local stand-in for the FCM HTTP v1 send endpoint.
+
+Answers POST /v1/projects/<project>/messages:send like FCM does, so the
+notification path can be exercised and load-tested without Firebase
+credentials or network access. Each request waits latency +/- jitter
+seconds, then:
+
+- fails with 429 RESOURCE_EXHAUSTED and a Retry-After header (throttle_rate)
+- or fails with 503 UNAVAILABLE (error_rate)
+- or, if the message is valid (exactly one of token/topic/condition),
+  returns {"name": "projects/<project>/messages/<n>"}; invalid messages get
+  400 INVALID_ARGUMENT
+
+GET /stats returns the request counters as JSON.
+
+Usage:
+    python -m test_server.notifications.fcm_stub --latency 0.05 --throttle-rate 0.01
+
+    NOTIFY_TRANSPORT=http FCM_ENDPOINT=http://127.0.0.1:8089 \\
+        python -m test_server.notifications.mqtt_handler
+
+    # Or in-process, e.g. from a benchmark
+    from .fcm_stub import FcmStub
+
+    stub = FcmStub(port=0, latency=0.01)
+    stub.start()
+    ...  # HttpTransport(endpoint=stub.url)
+    print(stub.get_stats())
+    stub.stop()
+"""
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .config import FCM_STUB_CONFIG
+
+_SEND_PATH = re.compile(r'^/v1/projects/([^/]+)/messages:send$')
+_TARGETS = ('token', 'topic', 'condition')
+
+
+class _Server(ThreadingHTTPServer):
+    # The default backlog of 5 resets connections when many senders connect at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class FcmStub:
+    """
+    Threaded HTTP server mimicking messages:send, with injected latency and failures.
+
+    One thread per connection; clients keep connections alive (HTTP/1.1).
+    """
+
+    def __init__(self, host: str = None, port: int = None, latency: float = None, jitter: float = None,
+                 error_rate: float = None, throttle_rate: float = None, retry_after: int = None,
+                 rng=None):
+        self.host = host or FCM_STUB_CONFIG['host']
+        self.port = port if port is not None else FCM_STUB_CONFIG['port']
+        self.latency = latency if latency is not None else FCM_STUB_CONFIG['latency']
+        self.jitter = jitter if jitter is not None else FCM_STUB_CONFIG['jitter']
+        self.error_rate = error_rate if error_rate is not None else FCM_STUB_CONFIG['error_rate']
+        self.throttle_rate = throttle_rate if throttle_rate is not None else FCM_STUB_CONFIG['throttle_rate']
+        self.retry_after = retry_after if retry_after is not None else FCM_STUB_CONFIG['retry_after']
+        self._rng = rng or random.Random()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self.requests = 0
+        self.accepted = 0
+        self.throttled = 0
+        self.errors = 0
+        self.invalid = 0
+
+    @property
+    def url(self) -> str:
+        """Base URL to use as FCM_ENDPOINT."""
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        """Start serving on a background thread (port 0 picks a free port)."""
+        self._server = _Server((self.host, self.port), _handler_for(self))
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fcm-stub', daemon=True)
+        self._thread.start()
+        print(f"FCM stub listening on {self.url}: latency {self.latency * 1000:.0f}"
+              f"+/-{self.jitter * 1000:.0f} ms, {self.error_rate:.1%} errors, "
+              f"{self.throttle_rate:.1%} throttled")
+
+    def stop(self):
+        """Stop serving and close the listening socket."""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+
+    def get_stats(self) -> dict:
+        """Snapshot of request counters."""
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'accepted': self.accepted,
+                'throttled': self.throttled,
+                'errors': self.errors,
+                'invalid': self.invalid,
+            }
+
+    def handle_send(self, project: str, body: bytes) -> tuple:
+        """
+        Decide the response to one messages:send request.
+
+        Returns:
+            (HTTP status, response body dict, extra headers dict)
+        """
+        delay = self.latency + self._rng.uniform(-self.jitter, self.jitter) if self.jitter else self.latency
+        if delay > 0:
+            time.sleep(delay)
+        roll = self._rng.random()
+        with self._lock:
+            self.requests += 1
+            if roll < self.throttle_rate:
+                self.throttled += 1
+                return (429, _error(429, 'Quota exceeded for project', 'RESOURCE_EXHAUSTED'),
+                        {'Retry-After': str(self.retry_after)})
+            if roll < self.throttle_rate + self.error_rate:
+                self.errors += 1
+                return 503, _error(503, 'The service is currently unavailable', 'UNAVAILABLE'), {}
+        problem = _validate(body)
+        with self._lock:
+            if problem:
+                self.invalid += 1
+                return 400, _error(400, problem, 'INVALID_ARGUMENT'), {}
+            self.accepted += 1
+        return 200, {'name': f"projects/{project}/messages/{next(self._ids)}"}, {}
+
+
+def _validate(body: bytes) -> str:
+    # Returns what is wrong with the request body, or None
+    try:
+        request = json.loads(body)
+    except ValueError:
+        return 'Request body is not valid JSON'
+    message = request.get('message') if isinstance(request, dict) else None
+    if not isinstance(message, dict):
+        return "Request is missing the 'message' field"
+    if sum(1 for target in _TARGETS if message.get(target)) != 1:
+        return 'Exactly one of token, topic or condition must be specified'
+    data = message.get('data') or {}
+    if not isinstance(data, dict) or not all(isinstance(v, str) for v in data.values()):
+        return "Invalid value in 'message.data': values must be strings"
+    return None
+
+
+def _error(code: int, message: str, status: str) -> dict:
+    return {'error': {'code': code, 'message': message, 'status': status}}
+
+
+def _handler_for(stub: FcmStub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body are written separately; don't let Nagle hold the body back
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            match = _SEND_PATH.match(self.path)
+            if match is None:
+                self._reply(404, _error(404, f"Unknown path: {self.path}", 'NOT_FOUND'))
+                return
+            status, response, headers = stub.handle_send(match.group(1), body)
+            self._reply(status, response, headers)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, stub.get_stats())
+            else:
+                self._reply(404, _error(404, f"Unknown path: {self.path}", 'NOT_FOUND'))
+
+        def _reply(self, status: int, response: dict, headers: dict = None):
+            payload = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=UTF-8')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            # One line per request would drown out everything else
+            pass
+
+    return Handler
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default=None)
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--latency', type=float, default=None, help='Seconds per request')
+    parser.add_argument('--jitter', type=float, default=None, help='Random +/- seconds on the latency')
+    parser.add_argument('--error-rate', type=float, default=None, help='Share of 503 responses')
+    parser.add_argument('--throttle-rate', type=float, default=None, help='Share of 429 responses')
+    parser.add_argument('--retry-after', type=int, default=None, help='Retry-After of 429 responses')
+    args = parser.parse_args(argv)
+
+    stub = FcmStub(host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+                   error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                   retry_after=args.retry_after)
+    stub.start()
+    try:
+        while True:
+            time.sleep(60)
+            print(f"FCM stub stats: {stub.get_stats()}")
+    except KeyboardInterrupt:
+        stub.stop()
+        print(f"FCM stub stats: {stub.get_stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""
+Flap Damper - Bounds notifications from devices bouncing online/offline.
+
+A device on weak Wi-Fi can reconnect many times a minute. Each device may
+notify up to max_transitions online/offline changes within a sliding window;
+beyond that it is damped: further changes are suppressed until it has held
+one state for hold_down_seconds, and then a single summary notification
+reports the state it settled in and how many changes were suppressed.
+
+Per device this bounds FCM calls to max_transitions per window plus one
+summary per hold-down period, however unstable its network is.
+
+poll() runs every housekeeping tick under the lock allow() needs, so it
+never walks the whole fleet: damped devices wait in a heap on the time they
+may be released, and devices are kept in the order of their last change, so
+forgetting quiet devices stops at the first one that changed recently.
+
+Usage:
+    from .flap_damper import FlapDamper
+
+    damper = FlapDamper(window_seconds=300, max_transitions=4, hold_down_seconds=120)
+    if damper.allow('device123', State.OFF):
+        ...  # send device_offline
+    for summary in damper.poll():
+        ...  # send device_stabilized for summary.device_id
+"""
+import heapq
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import List
+
+from .config import FLAP_CONFIG
+from .payload_parser import State
+
+
+class _FlapState:
+    """Recent online/offline changes of one device."""
+
+    __slots__ = ('changes', 'damped', 'suppressed', 'last_change', 'state')
+
+    def __init__(self):
+        self.changes = deque()
+        self.damped = False
+        self.suppressed = 0
+        self.last_change = 0.0
+        self.state = State.UNKNOWN
+
+
+class FlapSummary:
+    """A damped device that has stabilized."""
+
+    __slots__ = ('device_id', 'state', 'suppressed', 'damped_seconds')
+
+    def __init__(self, device_id: str, state: State, suppressed: int, damped_seconds: float):
+        self.device_id = device_id
+        self.state = state
+        self.suppressed = suppressed
+        self.damped_seconds = damped_seconds
+
+    def __repr__(self):
+        return (f"FlapSummary({self.device_id!r}, {self.state.name}, "
+                f"suppressed={self.suppressed}, damped_seconds={self.damped_seconds:.0f})")
+
+
+class FlapDamper:
+    """
+    Per-device flap detection with a sliding window and hold-down timer.
+
+    allow() is called from the MQTT thread and poll() from the housekeeping
+    thread, so both take the same lock.
+    """
+
+    def __init__(self, window_seconds: float = None, max_transitions: int = None,
+                 hold_down_seconds: float = None):
+        self.window_seconds = window_seconds if window_seconds is not None else FLAP_CONFIG['window_seconds']
+        self.max_transitions = max_transitions if max_transitions is not None else FLAP_CONFIG['max_transitions']
+        self.hold_down_seconds = (hold_down_seconds if hold_down_seconds is not None
+                                  else FLAP_CONFIG['hold_down_seconds'])
+        # Device ID -> _FlapState, least recently changed first
+        self._devices = OrderedDict()
+        # (release due, device ID), one per damped device; due is pushed back
+        # when it turns out the device changed again
+        self._damped = []
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.suppressed = 0
+        self.damped_total = 0
+        self.summaries = 0
+
+    def allow(self, device_id: str, state: State, now: float = None) -> bool:
+        """
+        Record an online/offline transition of a device.
+
+        Args:
+            device_id: Device whose state changed
+            state: New State.ON or State.OFF
+            now: time.monotonic() of the change (default: now)
+
+        Returns:
+            True if the change should be notified, False if it is damped
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            entry = self._devices.get(device_id)
+            if entry is None:
+                entry = self._devices[device_id] = _FlapState()
+            else:
+                self._devices.move_to_end(device_id)
+            entry.state = state
+            entry.last_change = now
+            changes = entry.changes
+            changes.append(now)
+            while changes and changes[0] <= now - self.window_seconds:
+                changes.popleft()
+
+            if not entry.damped and len(changes) > self.max_transitions:
+                entry.damped = True
+                heapq.heappush(self._damped, (now + self.hold_down_seconds, device_id))
+                self.damped_total += 1
+                print(f">>> FLAPPING: device {device_id} changed state {len(changes)} times "
+                      f"in {self.window_seconds:.0f}s, damping notifications")
+            if entry.damped:
+                entry.suppressed += 1
+                self.suppressed += 1
+                return False
+            self.allowed += 1
+            return True
+
+    def poll(self, now: float = None) -> List[FlapSummary]:
+        """
+        Release devices that held one state for hold_down_seconds.
+
+        Also forgets undamped devices with no changes inside the window.
+
+        Returns:
+            A summary for every damped device that has stabilized
+        """
+        if now is None:
+            now = time.monotonic()
+        summaries = []
+        with self._lock:
+            damped = self._damped
+            while damped and damped[0][0] <= now:
+                _, device_id = heapq.heappop(damped)
+                entry = self._devices[device_id]
+                if now - entry.last_change < self.hold_down_seconds:
+                    # Changed again since it was queued
+                    heapq.heappush(damped, (entry.last_change + self.hold_down_seconds, device_id))
+                    continue
+                summaries.append(FlapSummary(
+                    device_id,
+                    entry.state,
+                    entry.suppressed,
+                    now - entry.changes[0] if entry.changes else 0.0,
+                ))
+                # Keep the change history so renewed flapping is damped at once
+                entry.damped = False
+                entry.suppressed = 0
+            # Damped devices stay until released (only if hold-down outlasts the window)
+            devices = self._devices
+            while devices:
+                device_id, entry = next(iter(devices.items()))
+                if entry.damped or now - entry.last_change < self.window_seconds:
+                    break
+                del devices[device_id]
+            self.summaries += len(summaries)
+        return summaries
+
+    def is_damped(self, device_id: str) -> bool:
+        """True if notifications for the device are currently damped."""
+        with self._lock:
+            entry = self._devices.get(device_id)
+            return entry is not None and entry.damped
+
+    def get_stats(self) -> dict:
+        """Snapshot of tracked/damped devices and allowed/suppressed counters."""
+        with self._lock:
+            return {
+                'tracked_devices': len(self._devices),
+                'damped_devices': len(self._damped),
+                'allowed': self.allowed,
+                'suppressed': self.suppressed,
+                'damped_total': self.damped_total,
+                'summaries': self.summaries,
+            }
@@ -0,0 +1,63 @@
+"""
+Housekeeping - Runs periodic tasks of the notification service.
+
+Time-driven work (e.g. releasing stabilized flapping devices) cannot run in
+the MQTT callback, which only fires when a message arrives. The housekeeper
+calls every registered task once per interval on a daemon thread.
+
+Usage:
+    from .housekeeping import Housekeeper
+
+    housekeeper = Housekeeper(interval=1.0)
+    housekeeper.add(flap_damper_poll)
+    housekeeper.start()
+"""
+import threading
+import time
+import traceback
+from typing import Callable
+
+
+class Housekeeper:
+    """Calls registered tasks every interval seconds on a daemon thread."""
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self._tasks = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, task: Callable[[float], None]):
+        """Register a task; it is called with time.monotonic() each interval."""
+        self._tasks.append(task)
+
+    def run_once(self, now: float = None):
+        """Run every task once, now. Errors are printed and do not stop other tasks."""
+        if now is None:
+            now = time.monotonic()
+        for task in self._tasks:
+            try:
+                task(now)
+            except Exception as e:
+                print(f"!!! ERROR in housekeeping task {task.__name__}: {type(e).__name__}: {e}")
+                traceback.print_exc()
+
+    def start(self):
+        """Start the housekeeping thread. Safe to call more than once."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='housekeeping', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the housekeeping thread."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
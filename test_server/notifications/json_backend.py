@@ -0,0 +1,126 @@
+"""
+JSON Backend - Selects the JSON decoder used by the payload parser.
+
+The fastest installed backend is chosen once at import: orjson, then ujson,
+then the standard library json module. Set NOTIFY_JSON_BACKEND to 'orjson',
+'ujson' or 'json' to force one.
+
+Every backend accepts str or bytes and returns exactly what json.loads returns.
+orjson and ujson are stricter than the standard library (NaN/Infinity, lone
+surrogates), so input they reject is handed to json.loads before it counts as
+invalid; any decode failure raises ValueError. Payloads with a run of 19+
+digits also go to json.loads, because the fast backends may turn integers
+wider than 64 bits into floats or reject them.
+
+Usage:
+    from . import json_backend
+
+    data = json_backend.loads(b'{"payload": "online"}')
+    print(json_backend.name)  # e.g. 'orjson'
+"""
+import json
+import os
+import re
+from typing import Callable, Dict, Union
+
+# Backends in order of preference
+BACKENDS = ('orjson', 'ujson', 'json')
+
+# Digit runs that may not fit in 64 bits
+_LONG_DIGITS = re.compile(r'\d{19}')
+_LONG_DIGITS_BYTES = re.compile(rb'\d{19}')
+
+
+def _has_long_digits(raw: Union[str, bytes]) -> bool:
+    pattern = _LONG_DIGITS if isinstance(raw, str) else _LONG_DIGITS_BYTES
+    return pattern.search(raw) is not None
+
+
+def _stdlib_loads(raw: Union[str, bytes]):
+    # json.loads would guess UTF-16/32 for bytes; payloads are always UTF-8
+    if not isinstance(raw, str):
+        raw = bytes(raw).decode('utf-8')
+    return json.loads(raw)
+
+
+def _make_orjson_loads() -> Callable:
+    import orjson
+
+    def loads(raw: Union[str, bytes]):
+        if _has_long_digits(raw):
+            return _stdlib_loads(raw)
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            return _stdlib_loads(raw)
+    return loads
+
+
+def _make_ujson_loads() -> Callable:
+    import ujson
+
+    def loads(raw: Union[str, bytes]):
+        if _has_long_digits(raw):
+            return _stdlib_loads(raw)
+        try:
+            return ujson.loads(raw)
+        except (ValueError, OverflowError):
+            return _stdlib_loads(raw)
+    return loads
+
+
+_FACTORIES = {
+    'orjson': _make_orjson_loads,
+    'ujson': _make_ujson_loads,
+    'json': lambda: _stdlib_loads,
+}
+
+# Name and loads function of the selected backend (set by select_backend)
+name = 'json'
+loads = _stdlib_loads
+
+
+def available_backends() -> Dict[str, Callable]:
+    """Return {name: loads} for every backend that is installed."""
+    backends = {}
+    for backend in BACKENDS:
+        try:
+            backends[backend] = _FACTORIES[backend]()
+        except ImportError:
+            continue
+    return backends
+
+
+def select_backend(backend: str = None) -> str:
+    """
+    Select the JSON backend used by loads().
+
+    Args:
+        backend: 'orjson', 'ujson' or 'json'; None picks the fastest installed
+
+    Returns:
+        Name of the selected backend
+
+    Raises:
+        ValueError: If the backend name is unknown
+        ImportError: If the requested backend is not installed
+    """
+    global name, loads
+    if backend:
+        if backend not in _FACTORIES:
+            raise ValueError(f"Unknown JSON backend: {backend} (choose from {', '.join(BACKENDS)})")
+        loads = _FACTORIES[backend]()
+        name = backend
+        return name
+
+    for candidate in BACKENDS:
+        try:
+            loads = _FACTORIES[candidate]()
+        except ImportError:
+            continue
+        name = candidate
+        break
+    return name
+
+
+select_backend(os.environ.get('NOTIFY_JSON_BACKEND') or None)
@@ -0,0 +1,288 @@
+"""
+Keyed Executor - Thread pool that runs work for the same key one at a time.
+
+Sender threads deliver notifications in parallel, but a pump_start and the
+pump_stop that follows it for the same device must not overtake each other.
+The keyed executor keeps one FIFO queue per key (device ID): different keys
+run concurrently, while a key's items run strictly in submission order, never
+two at once. A key whose queue drains is forgotten, so memory follows the
+number of devices with pending work, not the size of the fleet.
+
+Keys take turns: after one item a busy key goes to the back of the ready
+queue, so a device with a long backlog cannot starve the others.
+
+Items may be submitted to priority lanes, each with its own ready queue and
+max_pending bound. Workers pick lanes by smooth weighted round robin (a lane
+of weight 8 gets 8 turns for every turn of a lane of weight 1), so a backlog
+in a bulk lane cannot delay a critical one; a lane whose oldest ready key has
+waited max_wait seconds is served next regardless, so no lane starves. A key
+is ready in the lane of its most urgent pending item: the items queued ahead
+of it (for the same key, so they must go first) are carried along with it.
+
+A handler may finish its work elsewhere by returning a concurrent.futures
+Future (e.g. a message waiting in an FCM batch): the worker moves on at once,
+and the key's next item runs only after the future completes.
+
+Usage:
+    from .keyed_executor import KeyedExecutor
+
+    executor = KeyedExecutor(handler=send, workers=4, max_pending=1000, max_per_key=100,
+                             lanes={'critical': 8, 'default': 1})
+    executor.start()
+    if not executor.submit('device123', event, lane='critical'):
+        ...  # rejected, a bound was hit
+    executor.stop()
+"""
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable
+
+DEFAULT_LANE = 'default'
+
+
+class _KeyQueue:
+    """Pending items of one key, as (lane index, item), plus its ready-queue entry."""
+
+    __slots__ = ('items', 'lane_counts', 'ready')
+
+    def __init__(self, lanes: int):
+        self.items = deque()
+        self.lane_counts = [0] * lanes
+        # (key, lane index, ready since) while the key sits in a ready queue
+        self.ready = None
+
+    def lane(self) -> int:
+        """Index of the most urgent lane with a pending item."""
+        for lane, count in enumerate(self.lane_counts):
+            if count:
+                return lane
+        return None
+
+
+class KeyedExecutor:
+    """
+    Worker threads over per-key FIFO queues.
+
+    Invariant: a key is in _queues while it has pending items or an item
+    running (or awaiting its future); it has a ready entry only while it has
+    pending items and no item running. So at most one item per key is in
+    progress at any time. Promoting a key to a more urgent lane leaves its
+    old entry behind; entries that are not their key's current one are
+    skipped when they come up.
+    """
+
+    def __init__(self, handler: Callable[[object], None], workers: int = 4,
+                 max_pending: int = 1000, max_per_key: int = 100, name: str = 'keyed-worker',
+                 lanes: Dict[str, int] = None, max_wait: float = None):
+        self.handler = handler
+        self.workers = workers
+        # Bound per lane, so a bulk backlog never crowds out critical items
+        self.max_pending = max_pending
+        self.max_per_key = max_per_key
+        self.name = name
+        # Lane name -> weight, most urgent first
+        lanes = lanes or {DEFAULT_LANE: 1}
+        self.lanes = list(lanes)
+        self.weights = [max(1, int(weight)) for weight in lanes.values()]
+        # Seconds a ready key may wait before its lane is served out of turn (None = no aging)
+        self.max_wait = max_wait
+        self._lane_index = {lane: i for i, lane in enumerate(self.lanes)}
+        # Lane of items submitted without one
+        self.default_lane = DEFAULT_LANE if DEFAULT_LANE in lanes else self.lanes[-1]
+        self._default_lane = self._lane_index[self.default_lane]
+        self._queues = {}
+        self._ready = [deque() for _ in self.lanes]
+        self._ready_keys = 0
+        # Smooth weighted round robin state
+        self._credit = [0] * len(self.lanes)
+        self._pending = [0] * len(self.lanes)
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self.submitted = 0
+        self.rejected_full = 0
+        self.rejected_key = 0
+        self.evicted_keys = 0
+        self.peak_keys = 0
+        self.promoted = 0
+        self.served = [0] * len(self.lanes)
+        self.aged = [0] * len(self.lanes)
+
+    def start(self):
+        """Start the worker threads. Safe to call more than once."""
+        if self._threads:
+            return
+        self._stopping = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'{self.name}-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Stop the workers after every pending item has run.
+
+        Args:
+            timeout: Seconds to wait for each worker thread to finish
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, key: Hashable, item, lane: str = None) -> bool:
+        """
+        Queue an item behind every earlier item of the same key. Never blocks.
+
+        Args:
+            key: Items of one key run one at a time, in order
+            item: Passed to the handler
+            lane: Priority lane (default: default_lane)
+
+        Returns:
+            False if max_pending items are queued in the lane or max_per_key
+            for this key; the item is rejected
+        """
+        index = self._default_lane if lane is None else self._lane_index[lane]
+        with self._cond:
+            if self._pending[index] >= self.max_pending:
+                self.rejected_full += 1
+                return False
+            queue = self._queues.get(key)
+            new_key = queue is None
+            if new_key:
+                queue = self._queues[key] = _KeyQueue(len(self.lanes))
+                if len(self._queues) > self.peak_keys:
+                    self.peak_keys = len(self._queues)
+            elif len(queue.items) >= self.max_per_key:
+                self.rejected_key += 1
+                return False
+            queue.items.append((index, item))
+            queue.lane_counts[index] += 1
+            self._pending[index] += 1
+            self.submitted += 1
+            if new_key:
+                self._make_ready(key, queue, index)
+            elif queue.ready is not None and index < queue.ready[1]:
+                # Carry the key, and the items ahead of this one, into the more urgent lane
+                self.promoted += 1
+                self._make_ready(key, queue, index)
+            return True
+
+    def pending(self) -> int:
+        """Number of items waiting for a worker."""
+        return sum(self._pending)
+
+    def active_keys(self) -> int:
+        """Number of keys with pending or running items."""
+        return len(self._queues)
+
+    def get_stats(self) -> dict:
+        """Snapshot of pending items, active keys, rejection counters and lanes."""
+        with self._cond:
+            return {
+                'pending': sum(self._pending),
+                'max_pending': self.max_pending,
+                'active_keys': len(self._queues),
+                'peak_keys': self.peak_keys,
+                'submitted': self.submitted,
+                'rejected_full': self.rejected_full,
+                'rejected_key': self.rejected_key,
+                'evicted_keys': self.evicted_keys,
+                'promoted': self.promoted,
+                'lanes': {
+                    lane: {'weight': self.weights[i], 'pending': self._pending[i],
+                           'served': self.served[i], 'aged': self.aged[i]}
+                    for i, lane in enumerate(self.lanes)
+                },
+            }
+
+    def _make_ready(self, key: Hashable, queue: _KeyQueue, lane: int):
+        if queue.ready is None:
+            self._ready_keys += 1
+            self._cond.notify()
+        queue.ready = entry = (key, lane, time.monotonic())
+        self._ready[lane].append(entry)
+
+    def _head(self, lane: int):
+        # The lane's oldest current entry, dropping entries left behind by promotions
+        ready = self._ready[lane]
+        while ready:
+            entry = ready[0]
+            queue = self._queues.get(entry[0])
+            if queue is not None and queue.ready is entry:
+                return entry
+            ready.popleft()
+        return None
+
+    def _pick_lane(self) -> int:
+        heads = [self._head(lane) for lane in range(len(self.lanes))]
+        if self.max_wait is not None:
+            oldest = None
+            now = time.monotonic()
+            for lane, head in enumerate(heads):
+                if head is not None and now - head[2] >= self.max_wait and (
+                        oldest is None or head[2] < heads[oldest][2]):
+                    oldest = lane
+            if oldest is not None:
+                self.aged[oldest] += 1
+                return oldest
+        credit = self._credit
+        total = 0
+        best = None
+        for lane, head in enumerate(heads):
+            if head is None:
+                continue
+            credit[lane] += self.weights[lane]
+            total += self.weights[lane]
+            if best is None or credit[lane] > credit[best]:
+                best = lane
+        credit[best] -= total
+        return best
+
+    def _worker(self):
+        cond = self._cond
+        while True:
+            with cond:
+                while not self._ready_keys:
+                    if self._stopping and not any(self._pending):
+                        return
+                    cond.wait()
+                lane = self._pick_lane()
+                key = self._ready[lane].popleft()[0]
+                queue = self._queues[key]
+                queue.ready = None
+                self._ready_keys -= 1
+                self.served[lane] += 1
+                index, item = queue.items.popleft()
+                queue.lane_counts[index] -= 1
+                self._pending[index] -= 1
+
+            try:
+                result = self.handler(item)
+            except Exception as e:
+                print(f"!!! ERROR in {self.name} handler for key {key!r}: {type(e).__name__}: {e}")
+                traceback.print_exc()
+                result = None
+
+            if isinstance(result, Future):
+                # The key stays busy until the work completes
+                result.add_done_callback(lambda _, key=key, queue=queue: self._release(key, queue))
+            else:
+                self._release(key, queue)
+
+    def _release(self, key: Hashable, queue: _KeyQueue):
+        # The key's item is done: schedule its next item or forget the key
+        with self._cond:
+            if queue.items:
+                self._make_ready(key, queue, queue.lane())
+            else:
+                del self._queues[key]
+                self.evicted_keys += 1
+                if self._stopping and not any(self._pending):
+                    self._cond.notify_all()
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""
+Load generator - Synthetic device fleet driving the notification pipeline.
+
+Simulates N virtual devices (up to 100k) publishing {deviceID}/status and
+{deviceID}/pump_status, alternating ON and OFF. Every device sticks to one
+payload shape, and together the fleet covers every shape payload_parser
+accepts:
+
+- plain tokens ('1', 'ON', 'online', 'connected', ...)
+- JSON scalars ('1', 'true', '"on"')
+- JSON objects with each PAYLOAD_FIELDS alias holding a string, number or
+  boolean, without a timestamp or with one under each TIMESTAMP_FIELDS alias
+  in each TIMESTAMP_FORMATS layout or as unix time
+
+A share of the timestamped messages (--stale) is dated ten minutes back, so
+the stale-message filter is exercised too.
+
+Messages go through mqtt_handler.on_message in-process (default) or through
+a real broker (--broker): a publisher client sends to MQTT_BROKER and the
+handler's own client, started in this process, receives. FCM is replaced by
+a recorder, which measures each notification's latency from the publish of
+its device's last message until its send completed. The recorder forwards
+to the dry-run transport (--fcm dry_run) or to a local FCM stand-in
+(--fcm stub) if asked.
+
+Reported: messages/s, notifications/s, latency percentiles, and drops
+(dispatch queue full, rate limited, send failures, messages the broker lost).
+
+Usage:
+    python -m test_server.notifications.loadgen --devices 100000 --messages 500000
+    python -m test_server.notifications.loadgen --rate 5000 --duration 30 --fcm stub
+    python -m test_server.notifications.loadgen --broker --devices 10000 --rate 2000
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from . import fcm_service, mqtt_handler
+from .config import MQTT_CONFIG
+from .dispatcher import Dispatcher, NotificationEvent
+from .payload_parser import DEFAULT_MAX_AGE_SECONDS, PAYLOAD_FIELDS, TIMESTAMP_FIELDS, TIMESTAMP_FORMATS
+
+# Plain ON/OFF words per topic kind
+PLAIN_TOKENS = {
+    'pump': [('1', '0'), ('ON', 'OFF'), ('on', 'off'), ('true', 'false'), ('started', 'stopped'),
+             ('active', 'inactive'), ('yes', 'no')],
+    'status': [('online', 'offline'), ('connected', 'disconnected'), ('1', '0'), ('ON', 'OFF')],
+}
+
+# How a JSON object encodes the state: as a word, a number or a boolean
+VALUE_STYLES = ('string', 'number', 'boolean')
+
+# Messages generated (with current timestamps) at a time
+CHUNK_SIZE = 5000
+
+# Age of a stale message's timestamp
+STALE_AGE = timedelta(seconds=DEFAULT_MAX_AGE_SECONDS * 10)
+
+
+class PayloadShape:
+    """One way of encoding a state; builds payloads for either topic."""
+
+    __slots__ = ('name', 'kind', 'tokens', 'field', 'style', 'timestamp_field', 'timestamp_format')
+
+    def __init__(self, name: str, kind: str, tokens: dict = None, field: str = None, style: str = None,
+                 timestamp_field: str = None, timestamp_format: str = None):
+        self.name = name
+        # 'plain', 'scalar' or 'object'
+        self.kind = kind
+        self.tokens = tokens
+        self.field = field
+        self.style = style
+        self.timestamp_field = timestamp_field
+        self.timestamp_format = timestamp_format
+
+    @property
+    def has_timestamp(self) -> bool:
+        return self.timestamp_field is not None
+
+    def build(self, topic_kind: str, on: bool, timestamp: datetime) -> bytes:
+        """Payload for a pump_status ('pump') or status message."""
+        if self.kind == 'plain':
+            return self.tokens[topic_kind][0 if on else 1].encode()
+        if self.style == 'number':
+            value = 1 if on else 0
+        elif self.style == 'boolean':
+            value = on
+        elif topic_kind == 'status':
+            value = 'online' if on else 'offline'
+        else:
+            value = 'on' if on else 'off'
+        if self.kind == 'scalar':
+            return json.dumps(value).encode()
+        document = {self.field: value}
+        if self.timestamp_field is not None:
+            if self.timestamp_format == 'unix':
+                document[self.timestamp_field] = int(timestamp.timestamp())
+            else:
+                document[self.timestamp_field] = _format_timestamp(timestamp, self.timestamp_format)
+        return json.dumps(document).encode()
+
+    def __repr__(self):
+        return f"PayloadShape({self.name!r})"
+
+
+def _format_timestamp(timestamp: datetime, fmt: str) -> str:
+    text = timestamp.strftime(fmt)
+    if '%f' in fmt:
+        # Devices send milliseconds; strftime writes microseconds
+        text = text.replace(timestamp.strftime('%f'), timestamp.strftime('%f')[:3], 1)
+    return text
+
+
+def payload_shapes() -> list:
+    """Every payload shape the parser accepts, one PayloadShape each."""
+    shapes = []
+    for on, off in PLAIN_TOKENS['pump']:
+        status = PLAIN_TOKENS['status'][len(shapes) % len(PLAIN_TOKENS['status'])]
+        shapes.append(PayloadShape(f'plain:{on}/{off}', 'plain',
+                                   tokens={'pump': (on, off), 'status': status}))
+    for style in VALUE_STYLES:
+        shapes.append(PayloadShape(f'scalar:{style}', 'scalar', style=style))
+    timestamps = [None, 'unix'] + TIMESTAMP_FORMATS
+    aliases = itertools.cycle(TIMESTAMP_FIELDS)
+    for field in PAYLOAD_FIELDS:
+        for style in VALUE_STYLES:
+            for timestamp_format in timestamps:
+                timestamp_field = next(aliases) if timestamp_format is not None else None
+                name = f'json:{field}:{style}' + (f':{timestamp_field}={timestamp_format}'
+                                                  if timestamp_format else '')
+                shapes.append(PayloadShape(name, 'object', field=field, style=style,
+                                           timestamp_field=timestamp_field,
+                                           timestamp_format=timestamp_format))
+    return shapes
+
+
+class Fleet:
+    """Virtual devices, each with a payload shape and its own ON/OFF cycle."""
+
+    def __init__(self, devices: int, stale_ratio: float = 0.0, shapes: list = None):
+        self.shapes = shapes or payload_shapes()
+        self.device_ids = [f'load{i:06d}' for i in range(devices)]
+        self.stale_ratio = stale_ratio
+        self.published = 0
+        self.stale = 0
+        self._stale_every = round(1 / stale_ratio) if stale_ratio > 0 else 0
+
+    def shape_of(self, index: int) -> PayloadShape:
+        return self.shapes[index % len(self.shapes)]
+
+    def chunk(self, start: int, count: int) -> list:
+        """
+        Messages start .. start + count of the run, as (device_id, topic, payload).
+
+        Devices publish in turn. Each round a device sends a pump_status or a
+        status message (alternately); each topic flips between ON and OFF
+        every other time the device sends it.
+        """
+        devices = len(self.device_ids)
+        now = datetime.now()
+        stale_time = now - STALE_AGE
+        messages = []
+        for n in range(start, start + count):
+            index = n % devices
+            round_ = n // devices
+            shape = self.shape_of(index)
+            topic_kind = 'pump' if round_ % 2 == 0 else 'status'
+            on = (round_ // 2) % 2 == 0
+            stale = bool(self._stale_every and shape.has_timestamp and n % self._stale_every == 0)
+            self.stale += stale
+            device_id = self.device_ids[index]
+            topic = f"{device_id}/{'pump_status' if topic_kind == 'pump' else 'status'}"
+            messages.append((device_id, topic, shape.build(topic_kind, on, stale_time if stale else now)))
+        self.published += count
+        return messages
+
+
+class Recorder:
+    """
+    Send function of the load test: records when each notification completed.
+
+    Latency is measured from the publish of the device's most recent message,
+    which is the one that triggered the notification as long as a device
+    publishes less often than the pipeline takes to notify.
+    """
+
+    def __init__(self, forward=None):
+        self.forward = forward
+        self.published_at = {}
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def mark(self, device_id: str, now: float):
+        self.published_at[device_id] = now
+
+    def send(self, event: NotificationEvent):
+        result = self.forward(event) if self.forward is not None else None
+        published = self.published_at.get(event.device_id, event.received_at)
+        latency = time.monotonic() - published
+        with self._lock:
+            self.latencies.append(latency)
+        return result
+
+
+def percentiles(samples: list, points=(50, 90, 99, 99.9)) -> dict:
+    """Nearest-rank percentiles of samples (seconds) in milliseconds, plus max."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    result = {}
+    for point in points:
+        rank = max(0, min(len(ordered) - 1, int(round(point / 100 * len(ordered))) - 1))
+        result[f'p{point:g}'] = round(ordered[rank] * 1000, 3)
+    result['max'] = round(ordered[-1] * 1000, 3)
+    return result
+
+
+def fcm_forwarder(fcm: str):
+    """Return (send function forwarding events to 'dry_run' or a local 'stub' FCM, cleanup)."""
+    if fcm == 'none':
+        return None, lambda: None
+    from .transport import DryRunTransport, HttpTransport
+    if fcm == 'dry_run':
+        fcm_service.set_transport(DryRunTransport())
+        return _send_to_topic, lambda: None
+    from .fcm_stub import FcmStub
+    stub = FcmStub(port=0)
+    stub.start()
+    transport = HttpTransport(endpoint=stub.url)
+    fcm_service.set_transport(transport)
+
+    def cleanup():
+        transport.close()
+        stub.stop()
+        print(f"FCM stub stats: {stub.get_stats()}")
+    return _send_to_topic, cleanup
+
+
+def _send_to_topic(event: NotificationEvent):
+    return fcm_service.send_to_topic(event.notification_type, data=event.data,
+                                     device_id=event.device_id, body=event.body)
+
+
+class _Pacer:
+    """Sleeps so that messages go out at rate per second (0 = no limit)."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.started = time.monotonic()
+
+    def wait(self, sent: int):
+        if self.rate > 0:
+            delay = self.started + sent / self.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def run(fleet: Fleet, messages: int, rate: float = 0, duration: float = None, broker: bool = False,
+        fcm: str = 'none', workers: int = None, settle: float = 60.0) -> dict:
+    """
+    Publish messages (or for duration seconds) and wait for the pipeline to drain.
+
+    Returns:
+        Report dict (see print_report)
+    """
+    forward, cleanup = fcm_forwarder(fcm)
+    recorder = Recorder(forward)
+    dispatcher = Dispatcher(workers=workers, queue_size=1_000_000, send=recorder.send)
+    dispatcher.start()
+    mqtt_handler.set_dispatcher(dispatcher)
+    limited_before = _rate_limited()
+
+    received = [0]
+
+    def on_message(client, userdata, msg):
+        received[0] += 1
+        mqtt_handler.on_message(client, userdata, msg)
+
+    publisher = handler_client = None
+    if broker:
+        handler_client = mqtt_handler.create_client()
+        handler_client.on_message = on_message
+        handler_client.connect(MQTT_CONFIG['broker'], MQTT_CONFIG['port'], keepalive=60)
+        handler_client.loop_start()
+        publisher = _publisher_client()
+        time.sleep(1.0)
+
+    pacer = _Pacer(rate)
+    deadline = pacer.started + duration if duration else None
+    generation = 0.0
+    sent = 0
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        while sent < messages or deadline is not None:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            count = CHUNK_SIZE if deadline is not None else min(CHUNK_SIZE, messages - sent)
+            started = time.monotonic()
+            chunk = fleet.chunk(sent, count)
+            generation += time.monotonic() - started
+            for device_id, topic, payload in chunk:
+                pacer.wait(sent)
+                now = time.monotonic()
+                recorder.mark(device_id, now)
+                if publisher is not None:
+                    publisher.publish(topic, payload, qos=0)
+                else:
+                    on_message(None, None, SimpleNamespace(topic=topic, payload=payload))
+                sent += 1
+        if broker:
+            # Wait for the broker to deliver what is in flight
+            settle_until = time.monotonic() + settle
+            while received[0] < sent and time.monotonic() < settle_until:
+                time.sleep(0.05)
+        publish_elapsed = time.monotonic() - pacer.started
+        mqtt_handler.flush_coalesced(flush_all=True)
+        dispatcher.stop(timeout=settle)
+    elapsed = time.monotonic() - pacer.started
+    if broker:
+        publisher.loop_stop()
+        publisher.disconnect()
+        handler_client.loop_stop()
+        handler_client.disconnect()
+    cleanup()
+
+    stats = dispatcher.get_stats()
+    busy = max(publish_elapsed - generation, 1e-9)
+    return {
+        'mode': 'broker' if broker else 'in-process',
+        'devices': len(fleet.device_ids),
+        'shapes': len(fleet.shapes),
+        'published': sent,
+        'stale_published': fleet.stale,
+        'received': received[0],
+        'elapsed_s': round(elapsed, 3),
+        'messages_per_s': round(received[0] / busy, 1),
+        'notifications': stats['submitted'],
+        'notifications_per_s': round(len(recorder.latencies) / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': percentiles(recorder.latencies),
+        'drops': {
+            'broker_lost': sent - received[0],
+            'queue_full': stats['dropped'],
+            'rate_limited': _rate_limited() - limited_before,
+            'send_failed': stats['failed'],
+            'unfinished': stats['submitted'] - stats['sent'] - stats['failed'],
+        },
+    }
+
+
+def _rate_limited() -> int:
+    limiter = mqtt_handler.rate_limiter
+    return sum(limiter.get_stats()['limited'].values()) if limiter is not None else 0
+
+
+def _publisher_client():
+    import paho.mqtt.client as mqtt
+    client = mqtt.Client(client_id=f"{MQTT_CONFIG['client_id']}-loadgen-{os.getpid()}")
+    if MQTT_CONFIG['username'] and MQTT_CONFIG['password']:
+        client.username_pw_set(MQTT_CONFIG['username'], MQTT_CONFIG['password'])
+    if MQTT_CONFIG.get('use_tls', False):
+        import ssl
+        client.tls_set(cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLS)
+    # Queue without limit while the network thread catches up with the publisher
+    client.max_queued_messages_set(0)
+    client.connect(MQTT_CONFIG['broker'], MQTT_CONFIG['port'], keepalive=60)
+    client.loop_start()
+    return client
+
+
+def print_report(report: dict):
+    print(f"{report['mode']}: {report['published']:,} messages from {report['devices']:,} devices "
+          f"({report['shapes']} payload shapes, {report['stale_published']:,} stale) "
+          f"in {report['elapsed_s']:.1f}s")
+    print(f"  ingest:        {report['messages_per_s']:12,.0f} messages/s")
+    print(f"  notifications: {report['notifications']:12,} queued, "
+          f"{report['notifications_per_s']:,.0f}/s sent")
+    latency = report['latency_ms']
+    if latency:
+        print('  latency (ms):  ' + '  '.join(f"{k} {v:,.2f}" for k, v in latency.items()))
+    print('  drops:         ' + ', '.join(f"{k} {v:,}" for k, v in report['drops'].items()))
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--devices', type=int, default=10000, help='Virtual devices (up to 100k)')
+    parser.add_argument('--messages', type=int, default=200000, help='Messages to publish')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='Publish for this many seconds instead of a message count')
+    parser.add_argument('--rate', type=float, default=0, help='Messages per second (0 = as fast as possible)')
+    parser.add_argument('--stale', type=float, default=0.05,
+                        help='Share of timestamped messages dated in the past')
+    parser.add_argument('--broker', action='store_true',
+                        help='Publish through MQTT_BROKER instead of calling on_message')
+    parser.add_argument('--fcm', choices=('none', 'dry_run', 'stub'), default='none',
+                        help='Also send each notification through this transport')
+    parser.add_argument('--workers', type=int, default=None, help='Dispatcher sender threads')
+    parser.add_argument('--json', metavar='PATH', help='Also write the report as JSON')
+    args = parser.parse_args(argv)
+
+    fleet = Fleet(args.devices, stale_ratio=args.stale)
+    report = run(fleet, args.messages, rate=args.rate, duration=args.duration, broker=args.broker,
+                 fcm=args.fcm, workers=args.workers)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
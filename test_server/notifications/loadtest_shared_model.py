@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Shared subscription model - Ingest scaling of multi-instance mode, without a broker.
+
+Runs N handler instances as separate processes behind an in-process model of
+an MQTT v5 broker, publishes a fixed workload of pump_status/status messages
+and reports throughput for each instance count. FCM sends are replaced by a
+no-op so only ingest (parse, classify, filter, dispatch) is measured.
+
+The model delivers like a v5 broker: each $share/<group>/<filter> group
+receives a matching message once, round-robin over its members, and a second
+session with the same client ID takes over the first one. Deliveries are
+batched per subscriber to keep IPC overhead out of the measurement.
+
+What it does not cover: messages never touch paho or a socket. The handler's
+own client (create_client, on_connect, the $share subscribe and MQTT v5
+negotiation), a real broker's share distribution, QoS and in-flight windows,
+keepalives and TLS are all bypassed, so the numbers are an upper bound on
+what N instances can ingest, not what a broker will deliver to them. For the
+real client path of one instance use loadgen --broker (with MQTT_SHARED_GROUP
+set, its handler client subscribes through $share).
+
+Usage:
+    python -m test_server.notifications.loadtest_shared_model
+    python -m test_server.notifications.loadtest_shared_model --instances 1,2,4,8 --messages 400000
+"""
+import argparse
+import contextlib
+import multiprocessing
+import os
+import sys
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from paho.mqtt.client import topic_matches_sub
+
+from . import mqtt_handler
+from .config import MQTT_CONFIG
+from .dispatcher import Dispatcher
+
+# Messages handed to a subscriber per delivery
+BATCH_SIZE = 500
+
+
+class BrokerModel:
+    """Minimal in-process MQTT broker model: sessions, plain and shared subscriptions."""
+
+    def __init__(self, batch_size: int = BATCH_SIZE):
+        self.batch_size = batch_size
+        self._sessions = {}
+        self._plain = []
+        self._groups = {}
+        self._pending = {}
+
+    def connect(self, client_id: str, inbox):
+        """Open a session; an existing session with the same client ID is taken over."""
+        if client_id in self._sessions:
+            print(f"Broker: client ID {client_id} already connected, disconnecting the old session")
+            self.disconnect(client_id)
+        self._sessions[client_id] = inbox
+        self._pending[client_id] = []
+
+    def disconnect(self, client_id: str):
+        """Close a session and drop its subscriptions."""
+        self._sessions.pop(client_id, None)
+        self._pending.pop(client_id, None)
+        self._plain = [(f, c) for f, c in self._plain if c != client_id]
+        for members in self._groups.values():
+            if client_id in members['clients']:
+                members['clients'].remove(client_id)
+
+    def subscribe(self, client_id: str, topic_filter: str):
+        """Subscribe a session to a plain or $share/<group>/<filter> topic filter."""
+        if topic_filter.startswith('$share/'):
+            _, group, real_filter = topic_filter.split('/', 2)
+            members = self._groups.setdefault((group, real_filter), {'clients': [], 'next': 0})
+            members['clients'].append(client_id)
+        else:
+            self._plain.append((topic_filter, client_id))
+
+    def publish(self, topic: str, payload: bytes):
+        """Route one message to every matching plain subscriber and one member per group."""
+        for topic_filter, client_id in self._plain:
+            if topic_matches_sub(topic_filter, topic):
+                self._deliver(client_id, topic, payload)
+        for (group, topic_filter), members in self._groups.items():
+            clients = members['clients']
+            if clients and topic_matches_sub(topic_filter, topic):
+                client_id = clients[members['next'] % len(clients)]
+                members['next'] += 1
+                self._deliver(client_id, topic, payload)
+
+    def flush(self):
+        """Deliver every partially filled batch."""
+        for client_id, pending in self._pending.items():
+            if pending:
+                self._sessions[client_id].put(pending)
+                self._pending[client_id] = []
+
+    def close(self):
+        """Flush and tell every session the test is over."""
+        self.flush()
+        for inbox in self._sessions.values():
+            inbox.put(None)
+
+    def _deliver(self, client_id: str, topic: str, payload: bytes):
+        pending = self._pending[client_id]
+        pending.append((topic, payload))
+        if len(pending) >= self.batch_size:
+            self._sessions[client_id].put(pending)
+            self._pending[client_id] = []
+
+
+def build_workload(messages: int, devices: int) -> list:
+    """Alternating ON/OFF pump_status and status messages in plain and JSON shapes."""
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    workload = []
+    for i in range(messages):
+        device = f"device{i % devices}"
+        on = (i // devices) % 2 == 0
+        if i % 2:
+            topic = f"{device}/pump_status"
+            payload = b'1' if on else b'0'
+        else:
+            topic = f"{device}/status"
+            payload = (f'{{"payload": "{"online" if on else "offline"}", "timestamp": "{now}"}}'
+                       .encode('utf-8'))
+        workload.append((topic, payload))
+    return workload
+
+
+def _run_instance(client_id: str, inbox, results):
+    """Handler instance process: feed delivered messages through on_message."""
+    dispatcher = Dispatcher(workers=1, queue_size=1_000_000, send=lambda event: None)
+    dispatcher.start()
+    mqtt_handler.set_dispatcher(dispatcher)
+    results.put(('ready', client_id))
+
+    processed = 0
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        while True:
+            batch = inbox.get()
+            if batch is None:
+                break
+            for topic, payload in batch:
+                mqtt_handler.on_message(None, None, SimpleNamespace(topic=topic, payload=payload))
+            processed += len(batch)
+        dispatcher.stop()
+    results.put(('done', client_id, processed, dispatcher.get_stats()['submitted']))
+
+
+def run(instances: int, workload: list, group: str) -> dict:
+    """Run one load test with the given number of instances."""
+    broker = BrokerModel()
+    results = multiprocessing.Queue()
+    processes = []
+    for index in range(instances):
+        MQTT_CONFIG['instance_id'] = f'loadtest-{index}'
+        client_id = mqtt_handler.get_client_id(group)
+        inbox = multiprocessing.Queue()
+        broker.connect(client_id, inbox)
+        for topic_filter in mqtt_handler.get_subscriptions(group):
+            broker.subscribe(client_id, topic_filter)
+        process = multiprocessing.Process(target=_run_instance, args=(client_id, inbox, results))
+        process.start()
+        processes.append(process)
+    for _ in range(instances):
+        results.get()
+
+    started = time.perf_counter()
+    for topic, payload in workload:
+        broker.publish(topic, payload)
+    broker.close()
+    per_instance = {}
+    for _ in range(instances):
+        _, client_id, processed, submitted = results.get()
+        per_instance[client_id] = (processed, submitted)
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+
+    return {
+        'instances': instances,
+        'elapsed': elapsed,
+        'rate': len(workload) / elapsed,
+        'per_instance': per_instance,
+    }
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--instances', default='1,2,4', help='Comma-separated instance counts')
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--devices', type=int, default=5000)
+    parser.add_argument('--group', default='beegreen-loadtest')
+    args = parser.parse_args(argv)
+
+    workload = build_workload(args.messages, args.devices)
+    print(f"{args.messages} messages from {args.devices} devices, {os.cpu_count()} CPU(s)")
+    baseline = None
+    for instances in [int(n) for n in args.instances.split(',')]:
+        result = run(instances, workload, args.group)
+        baseline = baseline or result['rate']
+        split = ', '.join(str(processed) for processed, _ in result['per_instance'].values())
+        print(f"  {instances:3d} instance(s): {result['rate']:10,.0f} msgs/s  "
+              f"{result['rate'] / baseline:5.2f}x  (per instance: {split})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
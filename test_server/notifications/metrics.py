@@ -0,0 +1,388 @@
+"""
+Metrics - Counters, gauges and histograms served in the Prometheus text format.
+
+A small built-in replacement for prometheus_client, cheap enough for the
+MQTT callback: a labelled series is looked up once (labels()) and updating
+it is an addition under its own lock. Histograms have fixed buckets, so an
+observation is one bisect.
+
+Metrics are created on the module-level registry where they are recorded
+(mqtt_handler, dispatcher, fcm_service) and served by MetricsServer on
+GET /metrics. Registries are per process and are not merged: in sharded
+mode (NOTIFY_SHARDS) the supervisor's endpoint only shows the routing
+process, and each worker serves its own pipeline metrics on the next ports
+(NOTIFY_METRICS_PORT + 1 + shard). Scrape all of them and aggregate in
+Prometheus, e.g. sum(notify_notifications_sent_total).
+
+Usage:
+    from . import metrics
+
+    RECEIVED = metrics.counter('notify_messages_received_total', 'MQTT messages received', ['topic_type'])
+    RECEIVED.labels('status').inc()
+
+    PARSE = metrics.histogram('notify_message_parse_seconds', 'Payload parse time',
+                              buckets=metrics.PARSE_BUCKETS)
+    PARSE.observe(0.00002)
+
+    metrics.start_server()  # http://127.0.0.1:9108/metrics (see METRICS_CONFIG)
+"""
+import math
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .config import METRICS_CONFIG
+
+# Seconds; FCM round-trips and end-to-end latency
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Seconds; in-process work such as parsing one payload
+PARSE_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3, 1e-2)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _Value:
+    """One counter or gauge series."""
+
+    __slots__ = ('value', '_function', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from function() at scrape time instead (gauges)."""
+        self._function = function
+
+    def get(self) -> float:
+        function = self._function
+        return function() if function is not None else self.value
+
+
+class _HistogramValue:
+    """One histogram series: per-bucket counts, sum and count."""
+
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        # Last slot is the +Inf bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self) -> tuple:
+        """(cumulative bucket counts, sum, count)"""
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total, running
+
+
+class Metric:
+    """
+    A named metric with zero or more label names; each set of label values
+    is its own series. Calls on the metric itself go to the unlabelled series.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        The series for these label values (strings, in labelnames order), created on first use.
+
+        Raises:
+            ValueError: Wrong number of label values
+        """
+        series = self._series.get(values)
+        if series is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self._lock:
+                series = self._series.setdefault(values, self._new_series())
+        return series
+
+    def _new_series(self):
+        return _Value()
+
+    def _items(self) -> list:
+        with self._lock:
+            return list(self._series.items())
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {_escape_help(self.help)}", f"# TYPE {self.name} {self.kind}"]
+        for values, series in self._items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(series.get())}")
+        return lines
+
+    def get_stats(self):
+        """Current values: a number if unlabelled, else {label values: value}."""
+        items = self._items()
+        if not self.labelnames:
+            return items[0][1].get() if items else 0
+        return {','.join(values): series.get() for values, series in items}
+
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """Value that goes up and down, or is read from a function at scrape time."""
+
+    kind = 'gauge'
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+
+class Histogram(Metric):
+    """Distribution of observations over fixed upper bounds."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(float(b) for b in buckets if b != math.inf))
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _new_series(self):
+        return _HistogramValue(self.buckets)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {_escape_help(self.help)}", f"# TYPE {self.name} {self.kind}"]
+        bounds = [_format_value(b) for b in self.buckets] + ['+Inf']
+        for values, series in self._items():
+            cumulative, total, count = series.snapshot()
+            for bound, bucket_count in zip(bounds, cumulative):
+                labels = _format_labels(self.labelnames + ('le',), values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+    def get_stats(self):
+        """{label values: {'count', 'avg'}} (or one such dict if unlabelled)."""
+        stats = {}
+        for values, series in self._items():
+            _, total, count = series.snapshot()
+            stats[','.join(values)] = {'count': count, 'avg': total / count if count else 0.0}
+        if not self.labelnames:
+            return stats.get('', {'count': 0, 'avg': 0.0})
+        return stats
+
+
+class MetricsRegistry:
+    """Named metrics of one process; creating an existing name returns it."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Add a metric, or return the one already registered under its name.
+
+        Raises:
+            ValueError: The name is taken by a metric of another kind or labels
+        """
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is None:
+                self._metrics[metric.name] = metric
+                return metric
+        if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+            raise ValueError(f"Metric {metric.name} is already registered as a {existing.kind} "
+                             f"with labels {existing.labelnames}")
+        return existing
+
+    def get(self, name: str) -> Metric:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def get_stats(self) -> dict:
+        """Snapshot of every metric's values, keyed by name."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.get_stats() for metric in metrics}
+
+
+# Metrics of this process
+registry = MetricsRegistry()
+
+
+def get_registry() -> MetricsRegistry:
+    """Return the process-wide registry."""
+    return registry
+
+
+def counter(name: str, help: str, labels: tuple = ()) -> Counter:
+    """Create (or return) a counter on the process-wide registry."""
+    return registry.register(Counter(name, help, labels))
+
+
+def gauge(name: str, help: str, labels: tuple = ()) -> Gauge:
+    """Create (or return) a gauge on the process-wide registry."""
+    return registry.register(Gauge(name, help, labels))
+
+
+def histogram(name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+    """Create (or return) a histogram on the process-wide registry."""
+    return registry.register(Histogram(name, help, labels, buckets))
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape_label(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _escape_help(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer:
+    """HTTP endpoint serving a registry on GET /metrics, on a background thread."""
+
+    def __init__(self, host: str = None, port: int = None, registry: MetricsRegistry = None):
+        self.host = host or METRICS_CONFIG['host']
+        self.port = port if port is not None else METRICS_CONFIG['port']
+        self.registry = registry or get_registry()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/metrics"
+
+    def start(self):
+        """Start serving (port 0 picks a free port)."""
+        self._server = _Server((self.host, self.port), _handler_for(self.registry))
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        print(f"Metrics endpoint: {self.url}")
+
+    def stop(self):
+        """Stop serving and close the listening socket."""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+
+
+def _handler_for(registry: MetricsRegistry):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            payload = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            # Scrapes every few seconds would drown out everything else
+            pass
+
+    return Handler
+
+
+# Endpoint started by start_server (NOTIFY_METRICS)
+_server = None
+
+
+def start_server(host: str = None, port: int = None) -> MetricsServer:
+    """Serve the process-wide registry over HTTP (see METRICS_CONFIG)."""
+    global _server
+    if _server is None:
+        _server = MetricsServer(host, port)
+        _server.start()
+    return _server
+
+
+def stop_server():
+    """Stop the endpoint started by start_server."""
+    global _server
+    if _server is not None:
+        _server.stop()
+        _server = None
@@ -12,20 +12,298 @@ Environment variables:
     MQTT_PORT - MQTT broker port (default: 1883)
     MQTT_USERNAME - MQTT username (optional)
     MQTT_PASSWORD - MQTT password (optional)
+    MQTT_SHARED_GROUP - Run as one of several instances sharing the load through
+        MQTT v5 shared subscriptions in this group (optional)
+    MQTT_INSTANCE_ID - Unique suffix of this instance's client ID (default: host-pid)
+    NOTIFY_WORKERS - Number of FCM sender threads (default: 4)
+    NOTIFY_QUEUE_SIZE - Max notifications waiting for a sender, per priority lane (default: 1000)
+    NOTIFY_DEVICE_QUEUE_SIZE - Max notifications waiting per device (default: 100)
+    NOTIFY_LANE_CRITICAL_WEIGHT / NOTIFY_LANE_DEFAULT_WEIGHT / NOTIFY_LANE_BULK_WEIGHT - Share of
+        sender turns per priority lane (default: 8 / 3 / 1)
+    NOTIFY_LANE_MAX_WAIT - Seconds before a waiting lane is served out of turn (default: 2)
+    NOTIFY_BATCH - Send notifications in FCM send_each batches (default: false)
+    NOTIFY_BATCH_SIZE / NOTIFY_BATCH_DELAY - Max messages / seconds per batch (default: 500 / 0.05)
+    NOTIFY_OUTBOX - Log notifications to a SQLite outbox and resend undelivered ones on startup (default: false)
+    NOTIFY_OUTBOX_PATH - Outbox database file (default: outbox.db next to this module)
+    NOTIFY_RETRY - Retry transient FCM failures with backoff and a circuit breaker (default: true)
+    NOTIFY_RATE_LIMIT - Drop notifications over per-device/type/global token bucket limits (default: true);
+        critical types (e.g. device_offline) are never limited
+    NOTIFY_DEVICE_RATE / NOTIFY_DEVICE_BURST - Notifications per second / burst per device (default: 0.1 / 10)
+    NOTIFY_RATE_LIMIT_SUMMARY - Seconds between "notifications limited" summaries (default: 300)
+    NOTIFY_TRANSPORT - Deliver through fcm, dry_run (send nothing) or http (default: fcm)
+    FCM_ENDPOINT - FCM v1 base URL of the http transport, e.g. the local stand-in started with
+        python -m test_server.notifications.fcm_stub (default: https://fcm.googleapis.com)
+    NOTIFY_CAPTURE - Append every received message to this capture file for replay (optional)
+    NOTIFY_METRICS - Serve Prometheus metrics while running (default: true)
+    NOTIFY_METRICS_HOST / NOTIFY_METRICS_PORT - Address of the /metrics endpoint (default: 127.0.0.1 / 9108);
+        with NOTIFY_SHARDS, shard N serves its own metrics on NOTIFY_METRICS_PORT + 1 + N
+    NOTIFY_TRANSITIONS_ONLY - Notify only when a device's state changes (default: true)
+    NOTIFY_FLAP_DAMPING - Damp devices bouncing online/offline (default: true)
+    NOTIFY_COALESCE_WINDOW - Seconds to gather online/offline events into a digest (default: 0 = off; delays those notifications by up to the window)
+    NOTIFY_COALESCE_TYPES - Notification types gathered into digests (default: device_online)
+    NOTIFY_SHARDS - Handle messages in this many worker processes, split by device ID (default: off)
+    NOTIFY_JSON_BACKEND - JSON decoder: orjson, ujson or json (default: fastest installed)
+
+In multi-instance mode (MQTT_SHARED_GROUP) each instance keeps its own
+transition, flap and coalescing state, and the broker may hand one device's
+messages to different instances, so those filters work per instance.
 """
-import re
+import time
+from datetime import datetime
+
 import paho.mqtt.client as mqtt
-from . import fcm_service
-from .config import MQTT_CONFIG, MQTT_TOPICS
+from . import fcm_service, metrics
+from .batch_sender import BatchSender
+from .capture import CaptureWriter
+from .coalescer import Coalescer
+from .config import (
+    BATCH_CONFIG,
+    CAPTURE_CONFIG,
+    COALESCE_CONFIG,
+    FLAP_CONFIG,
+    METRICS_CONFIG,
+    MQTT_CONFIG,
+    MQTT_TOPICS,
+    NOTIFICATION_TYPES,
+    OUTBOX_CONFIG,
+    RATE_LIMIT_CONFIG,
+    RETRY_CONFIG,
+    SHARD_CONFIG,
+    STATE_CACHE_CONFIG,
+    STATE_VOCABULARY,
+)
+from .dispatcher import Dispatcher
+from .flap_damper import FlapDamper
+from .outbox import Outbox
+from .rate_limiter import RateLimiter
+from .retry import RetryScheduler
+from .housekeeping import Housekeeper
+from .sharding import ShardSupervisor, adopt_orphaned_outboxes
+from .state_cache import DeviceStateCache
 from .payload_parser import (
-    parse_payload_with_timestamp,
-    is_truthy,
-    is_falsy,
+    format_cache,
+    lookup_trivial,
+    parse_message,
+    classify,
+    register_state_tokens,
+    State,
     is_message_recent,
     get_message_age_seconds,
     DEFAULT_MAX_AGE_SECONDS,
 )
 
+# Firmware-specific ON/OFF words from the environment
+register_state_tokens(on=STATE_VOCABULARY['on'], off=STATE_VOCABULARY['off'])
+
+# Last known pump/online state per device; notifications fire on transitions only
+state_cache = DeviceStateCache() if STATE_CACHE_CONFIG['enabled'] else None
+
+# Damps online/offline notifications from devices with unstable connections
+flap_damper = FlapDamper() if FLAP_CONFIG['enabled'] else None
+
+# Folds bursts of same-kind notifications into digests
+coalescer = Coalescer() if COALESCE_CONFIG['window_seconds'] > 0 else None
+
+# Caps notifications per device, per type and overall
+rate_limiter = RateLimiter() if RATE_LIMIT_CONFIG['enabled'] else None
+
+# Hands notifications to the FCM sender threads (created on first use)
+_dispatcher = None
+
+# Sends the dispatcher's messages in send_each batches (NOTIFY_BATCH)
+_batch_sender = None
+
+# Durable log of undelivered notifications (NOTIFY_OUTBOX)
+_outbox = None
+
+# Retries failed sends behind a circuit breaker (NOTIFY_RETRY)
+_retry = None
+
+# Records received traffic for replay (NOTIFY_CAPTURE)
+_capture = None
+
+RECEIVED = metrics.counter('notify_messages_received_total', 'MQTT messages received, by topic type',
+                           ['topic_type'])
+PARSE_TIME = metrics.histogram('notify_message_parse_seconds', 'Time to decode and parse a payload',
+                               buckets=metrics.PARSE_BUCKETS)
+STALE = metrics.counter('notify_messages_stale_total', 'Messages skipped as too old, by topic type',
+                        ['topic_type'])
+RATE_LIMITED = metrics.counter('notify_notifications_rate_limited_total',
+                               'Notifications over a rate limit, by type', ['type'])
+SUPPRESSED = metrics.counter('notify_notifications_suppressed_total',
+                             'Notifications not sent: repeated pump or status state, or a flapping device',
+                             ['kind'])
+QUEUE_DEPTH = metrics.gauge('notify_dispatch_queue_depth', 'Notifications waiting for a sender')
+QUEUE_DEPTH.set_function(lambda: _dispatcher.queue_depth() if _dispatcher is not None else 0)
+
+
+def get_dispatcher() -> Dispatcher:
+    """Return the dispatcher used by on_message, starting it if needed."""
+    global _dispatcher, _batch_sender, _outbox, _retry
+    if _dispatcher is None:
+        send = None
+        if BATCH_CONFIG['enabled']:
+            _batch_sender = BatchSender()
+            _batch_sender.start()
+            send = _batch_sender.send
+        if RETRY_CONFIG['enabled']:
+            _retry = RetryScheduler(send=send)
+            _retry.start()
+            send = _retry.send
+        if OUTBOX_CONFIG['enabled']:
+            _outbox = Outbox()
+            _outbox.open()
+        _dispatcher = Dispatcher(send=send, outbox=_outbox)
+        _dispatcher.start()
+        _dispatcher.replay()
+    return _dispatcher
+
+
+def set_dispatcher(dispatcher: Dispatcher):
+    """Replace the dispatcher used by on_message (e.g. with a custom send function)."""
+    global _dispatcher
+    _dispatcher = dispatcher
+
+
+def is_transition(device_id: str, kind: str, state: State, now: float = None) -> bool:
+    """Record a reported state; True if it should notify (always, when the cache is off)."""
+    if state_cache is None:
+        return True
+    return state_cache.is_transition(device_id, kind, state, now)
+
+
+def is_critical(notification_type: str) -> bool:
+    """True for types in the critical priority lane (device_offline): never rate limited."""
+    return NOTIFICATION_TYPES.get(notification_type, {}).get('priority') == 'critical'
+
+
+def submit_notification(notification_type: str, device_id: str = None, data: dict = None,
+                        body: str = None, received_at: float = None, now: float = None) -> bool:
+    """Queue a notification for sending unless it is over a rate limit (measured at now)."""
+    if (rate_limiter is not None and not is_critical(notification_type)
+            and not rate_limiter.allow(notification_type, device_id, now)):
+        RATE_LIMITED.labels(notification_type).inc()
+        print(f">>> RATE LIMITED: {notification_type} for device {device_id}")
+        return False
+    return get_dispatcher().submit(notification_type, device_id=device_id, data=data, body=body,
+                                   received_at=received_at)
+
+
+def notify(notification_type: str, device_id: str = None, received_at: float = None, now: float = None):
+    """Send a notification, or buffer it if its type is coalesced."""
+    if coalescer is not None and coalescer.add(notification_type, device_id, received_at, now):
+        return
+    submit_notification(notification_type, device_id=device_id, received_at=received_at, now=now)
+
+
+def flush_coalesced(now: float = None, flush_all: bool = False):
+    """Send every coalesced batch whose window has closed (housekeeping task)."""
+    if coalescer is None:
+        return
+    batches = coalescer.flush_all() if flush_all else coalescer.flush_due(now)
+    for batch in batches:
+        if batch.count == 1:
+            device_id = next(iter(batch.device_ids))
+            submit_notification(batch.notification_type, device_id=device_id,
+                                received_at=batch.first_received_at, now=now)
+            continue
+        print(f">>> Sending {batch.notification_type} digest for {batch.count} devices")
+        submit_notification(
+            batch.notification_type,
+            data=batch.digest_data(coalescer.max_ids),
+            body=batch.digest_body(),
+            received_at=batch.first_received_at,
+            now=now,
+        )
+
+
+def release_stabilized_devices(now: float = None):
+    """Send a summary for every flapping device that has settled (housekeeping task)."""
+    if flap_damper is None:
+        return
+    for summary in flap_damper.poll(now):
+        state = 'online' if summary.state is State.ON else 'offline'
+        print(f">>> Device {summary.device_id} stabilized {state}, "
+              f"{summary.suppressed} change(s) suppressed")
+        submit_notification(
+            'device_stabilized',
+            device_id=summary.device_id,
+            data={'state': state, 'suppressed_changes': summary.suppressed},
+            body=f"Your device connection was unstable and is now {state}",
+            now=now,
+        )
+
+
+# When the last summaries went out (None: start counting at the next call)
+_last_rate_limit_summary = None
+
+
+def send_rate_limit_summaries(now: float = None):
+    """Tell each rate limited device how many notifications it missed (housekeeping task)."""
+    global _last_rate_limit_summary
+    interval = RATE_LIMIT_CONFIG['summary_interval']
+    if rate_limiter is None or interval <= 0:
+        return
+    if now is None:
+        now = time.monotonic()
+    if _last_rate_limit_summary is None:
+        _last_rate_limit_summary = now
+    if now - _last_rate_limit_summary < interval:
+        return
+    _last_rate_limit_summary = now
+    for device_id, skipped in rate_limiter.take_summaries():
+        print(f">>> Device {device_id} was rate limited, {skipped} notification(s) skipped")
+        # One per device per interval, so it bypasses the limiter it reports on
+        get_dispatcher().submit(
+            'notifications_limited',
+            device_id=device_id,
+            data={'skipped': skipped},
+            body=f"Your device reported changes too often; {skipped} notification(s) were skipped",
+        )
+
+
+def reset_filters():
+    """Forget transitions, flapping devices, open digests and rate limits (e.g. before a replay)."""
+    global state_cache, flap_damper, coalescer, rate_limiter, _last_rate_limit_summary
+    state_cache = DeviceStateCache() if STATE_CACHE_CONFIG['enabled'] else None
+    flap_damper = FlapDamper() if FLAP_CONFIG['enabled'] else None
+    coalescer = Coalescer() if COALESCE_CONFIG['window_seconds'] > 0 else None
+    rate_limiter = RateLimiter() if RATE_LIMIT_CONFIG['enabled'] else None
+    _last_rate_limit_summary = None
+
+
+# Periodic tasks, run on their own thread while the service is started
+housekeeper = Housekeeper(interval=0.5)
+housekeeper.add(release_stabilized_devices)
+housekeeper.add(flush_coalesced)
+housekeeper.add(send_rate_limit_summaries)
+
+
+def start_capture(path: str = None) -> CaptureWriter:
+    """Start recording received messages to a capture file (default: NOTIFY_CAPTURE)."""
+    global _capture
+    if _capture is None:
+        _capture = CaptureWriter(path)
+        _capture.open()
+    return _capture
+
+
+def stop_capture():
+    """Write the rest of the capture and close it."""
+    global _capture
+    if _capture is not None:
+        _capture.close()
+        print(f"Capture stats: {_capture.get_stats()}")
+        _capture = None
+
+
+def capturing(callback):
+    """Wrap an on_message callback so every message is recorded before it is handled."""
+    def on_message_captured(client, userdata, msg):
+        _capture.record(msg.topic, msg.payload)
+        callback(client, userdata, msg)
+    return on_message_captured
+
 
 def extract_device_id(topic: str) -> str:
     """Extract device ID from MQTT topic."""
@@ -34,20 +312,42 @@ def extract_device_id(topic: str) -> str:
     return parts[0] if parts else None
 
 
-def on_connect(client, userdata, flags, rc):
-    """Callback when connected to MQTT broker."""
+def get_client_id(shared_group: str = None) -> str:
+    """Return the MQTT client ID; unique per instance in multi-instance mode."""
+    if shared_group:
+        return f"{MQTT_CONFIG['client_id']}-{MQTT_CONFIG['instance_id']}"
+    return MQTT_CONFIG['client_id']
+
+
+def get_subscriptions(shared_group: str = None) -> list:
+    """
+    Return the topic filters to subscribe to.
+
+    Args:
+        shared_group: MQTT v5 shared subscription group, or None for plain filters
+
+    Returns:
+        One filter per MQTT_TOPICS entry, e.g. '$share/<group>/+/status'
+    """
+    if shared_group:
+        return [f"$share/{shared_group}/{pattern}" for pattern in MQTT_TOPICS.values()]
+    return list(MQTT_TOPICS.values())
+
+
+def on_connect(client, userdata, flags, rc, properties=None):
+    """Callback when connected to MQTT broker (MQTT v3.1.1 or v5)."""
     if rc == 0:
         print(f"Connected to MQTT broker: {MQTT_CONFIG['broker']}:{MQTT_CONFIG['port']}")
 
         # Subscribe to all configured topics
-        for topic_name, topic_pattern in MQTT_TOPICS.items():
+        for topic_pattern in get_subscriptions(MQTT_CONFIG['shared_group']):
             client.subscribe(topic_pattern)
             print(f"Subscribed to: {topic_pattern}")
     else:
         print(f"Failed to connect to MQTT broker. Return code: {rc}")
 
 
-def on_disconnect(client, userdata, rc):
+def on_disconnect(client, userdata, rc, properties=None):
     """Callback when disconnected from MQTT broker."""
     print(f"Disconnected from MQTT broker. Return code: {rc}")
     if rc != 0:
@@ -56,71 +356,128 @@ def on_disconnect(client, userdata, rc):
 
 def on_message(client, userdata, msg):
     """Callback when message received from MQTT broker."""
-    topic = msg.topic
-    try:
-        raw_payload = msg.payload.decode('utf-8')
-    except UnicodeDecodeError:
-        print(f"Failed to decode message payload from topic: {topic}")
-        return
+    handle_message(msg.topic, msg.payload)
+
 
+def handle_message(topic: str, raw_payload: bytes, received_at: float = None, captured_at: float = None):
+    """
+    Process one device message: parse, classify, filter and queue notifications.
+
+    Args:
+        topic: MQTT topic, {deviceID}/pump_status or {deviceID}/status
+        raw_payload: Raw MQTT payload bytes
+        received_at: time.monotonic() when the message arrived (default: now)
+        captured_at: Unix time a replayed message was originally received; its
+            age and the time-based filters are then measured on that clock
+    """
+    if received_at is None:
+        received_at = time.monotonic()
+    if captured_at is None:
+        now, arrived = received_at, None
+    else:
+        now, arrived = captured_at, datetime.fromtimestamp(captured_at)
     device_id = extract_device_id(topic)
-    payload, timestamp = parse_payload_with_timestamp(raw_payload)
-    age_seconds = get_message_age_seconds(timestamp)
+    if topic.endswith('/pump_status'):
+        topic_type = 'pump_status'
+    elif topic.endswith('/status'):
+        topic_type = 'status'
+    else:
+        topic_type = 'other'
+    RECEIVED.labels(topic_type).inc()
+
+    # Common plain payloads ('1', 'offline', ...) skip decoding and parsing
+    parse_started = time.perf_counter()
+    parsed = lookup_trivial(raw_payload)
+    if parsed is None:
+        try:
+            parsed = parse_message(raw_payload, device_id=device_id)
+        except UnicodeDecodeError:
+            print(f"Failed to decode message payload from topic: {topic}")
+            return
+    PARSE_TIME.observe(time.perf_counter() - parse_started)
+    payload, timestamp = parsed.value, parsed.timestamp
+    state = classify(payload)
+    age_seconds = get_message_age_seconds(timestamp, arrived)
     age_str = f"{age_seconds:.1f}s ago" if age_seconds is not None else "no timestamp"
     
     print(f"Message received - Topic: {topic}, Parsed: {payload}, Age: {age_str}, Device: {device_id}")
 
+    dispatcher = get_dispatcher()
     try:
         # Handle pump status changes: {deviceID}/pump_status
-        if topic.endswith('/pump_status'):
+        if topic_type == 'pump_status':
             # Check if message is recent (skip stale retained messages)
-            if not is_message_recent(timestamp):
+            if not is_message_recent(timestamp, now=arrived):
+                STALE.labels(topic_type).inc()
                 print(f">>> SKIPPED: Message is stale ({age_str}, max {DEFAULT_MAX_AGE_SECONDS}s)")
                 return
+
+            # Skip repeats of the state we already notified about
+            if state is not State.UNKNOWN and not is_transition(device_id, 'pump', state, now):
+                SUPPRESSED.labels('pump').inc()
+                print(f">>> SUPPRESSED: Pump already {state.name} for device: {device_id}")
+                return
                 
-            if is_truthy(payload):
+            if state is State.ON:
                 print(f">>> Triggering PUMP_START notification for device: {device_id}")
-                result = fcm_service.send_to_topic('pump_start', device_id=device_id)
-                print(f">>> FCM Response: {result}")
-            elif is_falsy(payload):
+                notify('pump_start', device_id=device_id, received_at=received_at, now=now)
+            elif state is State.OFF:
                 print(f">>> Triggering PUMP_STOP notification for device: {device_id}")
-                result = fcm_service.send_to_topic('pump_stop', device_id=device_id)
-                print(f">>> FCM Response: {result}")
+                notify('pump_stop', device_id=device_id, received_at=received_at, now=now)
             else:
                 print(f">>> Unknown pump_status payload: '{payload}' (not triggering notification)")
 
         # Handle device online/offline status: {deviceID}/status
-        elif topic.endswith('/status'):
+        elif topic_type == 'status':
             # For OFFLINE status: always send (important to know device is down)
             # For ONLINE status: check if message is recent
-            is_offline = is_falsy(payload)
+            # Either way, only when the state changed
+            is_offline = state is State.OFF
             
-            if not is_offline and not is_message_recent(timestamp):
+            if not is_offline and not is_message_recent(timestamp, now=arrived):
+                STALE.labels(topic_type).inc()
                 print(f">>> SKIPPED: Online message is stale ({age_str}, max {DEFAULT_MAX_AGE_SECONDS}s)")
                 return
+
+            if state is not State.UNKNOWN and not is_transition(device_id, 'status', state, now):
+                SUPPRESSED.labels('status').inc()
+                print(f">>> SUPPRESSED: Device already {state.name} for device: {device_id}")
+                return
+
+            if (state is not State.UNKNOWN and flap_damper is not None
+                    and not flap_damper.allow(device_id, state, now)):
+                SUPPRESSED.labels('flap').inc()
+                print(f">>> DAMPED: Device {device_id} is flapping, {state.name} not notified")
+                return
             
-            if is_truthy(payload):
+            if state is State.ON:
                 print(f">>> Triggering DEVICE_ONLINE notification for device: {device_id}")
-                result = fcm_service.send_to_topic('device_online', device_id=device_id)
-                print(f">>> FCM Response: {result}")
+                notify('device_online', device_id=device_id, received_at=received_at, now=now)
             elif is_offline:
-                print(f">>> Triggering DEVICE_OFFLINE notification for device: {device_id} (always sent)")
-                result = fcm_service.send_to_topic('device_offline', device_id=device_id)
-                print(f">>> FCM Response: {result}")
+                print(f">>> Triggering DEVICE_OFFLINE notification for device: {device_id}")
+                notify('device_offline', device_id=device_id, received_at=received_at, now=now)
             else:
                 print(f">>> Unknown status payload: '{payload}' (not triggering notification)")
         else:
             print(f">>> Topic '{topic}' doesn't match pump_status or status patterns")
 
     except Exception as e:
-        print(f"!!! ERROR sending notification: {type(e).__name__}: {e}")
+        print(f"!!! ERROR handling message: {type(e).__name__}: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        dispatcher.record_latency('ingest', time.monotonic() - received_at)
 
 
 def create_client() -> mqtt.Client:
     """Create and configure MQTT client."""
-    client = mqtt.Client(client_id=MQTT_CONFIG['client_id'])
+    shared_group = MQTT_CONFIG['shared_group']
+    if shared_group:
+        # Shared subscriptions need MQTT v5
+        client = mqtt.Client(client_id=get_client_id(shared_group), protocol=mqtt.MQTTv5)
+        print(f"Multi-instance mode: client {get_client_id(shared_group)} in shared group '{shared_group}'")
+    else:
+        client = mqtt.Client(client_id=get_client_id())
 
     # Set callbacks
     client.on_connect = on_connect
@@ -140,6 +497,41 @@ def create_client() -> mqtt.Client:
     return client
 
 
+def stop_pipeline():
+    """Flush buffered notifications, stop the dispatcher and print pipeline stats."""
+    flush_coalesced(flush_all=True)
+    # Sends still waiting for a retry fail now; the outbox keeps them for the next start
+    if _retry is not None:
+        _retry.stop()
+    get_dispatcher().stop()
+    if _batch_sender is not None:
+        _batch_sender.stop()
+    if _outbox is not None:
+        _outbox.close()
+    print_pipeline_stats()
+
+
+def print_pipeline_stats():
+    """Print dispatcher, cache and filter stats."""
+    print(f"Dispatcher stats: {get_dispatcher().get_stats()}")
+    if _batch_sender is not None:
+        print(f"Batch sender stats: {_batch_sender.get_stats()}")
+    if _outbox is not None:
+        print(f"Outbox stats: {_outbox.get_stats()}")
+    if _retry is not None:
+        print(f"Retry stats: {_retry.get_stats()}")
+    print(f"Transport stats: {fcm_service.get_transport().get_stats()}")
+    print(f"Format cache stats: {format_cache.get_stats()}")
+    if state_cache is not None:
+        print(f"State cache stats: {state_cache.get_stats()}")
+    if flap_damper is not None:
+        print(f"Flap damper stats: {flap_damper.get_stats()}")
+    if coalescer is not None:
+        print(f"Coalescer stats: {coalescer.get_stats()}")
+    if rate_limiter is not None:
+        print(f"Rate limiter stats: {rate_limiter.get_stats()}")
+
+
 def start():
     """Start the MQTT handler service."""
     print("Starting BeeGreen Notification Service...")
@@ -147,6 +539,34 @@ def start():
 
     client = create_client()
 
+    if OUTBOX_CONFIG['enabled']:
+        # Events left in another shard layout's files would never be replayed
+        adopt_orphaned_outboxes(OUTBOX_CONFIG['path'], SHARD_CONFIG['shards'])
+
+    # Sharded mode: this process only routes messages to worker processes
+    supervisor = None
+    if SHARD_CONFIG['shards'] > 1:
+        supervisor = ShardSupervisor()
+        supervisor.start()
+        client.on_message = supervisor.on_message
+        background = Housekeeper(interval=supervisor.max_delay)
+        background.add(supervisor.flush)
+        background.add(supervisor.check_workers)
+        background.add(supervisor.log_stats)
+    else:
+        get_dispatcher()
+        background = housekeeper
+    if CAPTURE_CONFIG['path']:
+        start_capture()
+        client.on_message = capturing(client.on_message)
+    if METRICS_CONFIG['enabled']:
+        try:
+            metrics.start_server()
+        except OSError as e:
+            # Not worth refusing to start over
+            print(f"Metrics endpoint unavailable on port {METRICS_CONFIG['port']}: {e}")
+    background.start()
+
     try:
         client.connect(MQTT_CONFIG['broker'], MQTT_CONFIG['port'], keepalive=60)
         print("Starting MQTT loop (Ctrl+C to stop)...")
@@ -154,6 +574,14 @@ def start():
     except KeyboardInterrupt:
         print("\nShutting down...")
         client.disconnect()
+        stop_capture()
+        metrics.stop_server()
+        background.stop()
+        if supervisor is not None:
+            supervisor.stop()
+            print(f"Shard stats: {supervisor.get_stats()}")
+        else:
+            stop_pipeline()
     except Exception as e:
         print(f"Error: {e}")
         raise
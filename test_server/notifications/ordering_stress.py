@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Stress check for per-device ordering of notification sends.
+
+Submits numbered events for many devices from several producer threads into
+a Dispatcher with many sender threads, and a send function that yields and
+sleeps at random to shake up scheduling. Fails (exit 1) if any device's
+events are sent out of order, if two events of one device are ever sent at
+the same time, or if an accepted event is never sent. A smaller round runs
+with the tests (tests/test_keyed_executor.py); this script is for long runs.
+
+Usage:
+    python -m test_server.notifications.ordering_stress
+    python -m test_server.notifications.ordering_stress --devices 50 --events 500000 --workers 64
+"""
+import argparse
+import contextlib
+import os
+import random
+import sys
+import threading
+import time
+
+from .dispatcher import Dispatcher
+
+
+class OrderChecker:
+    """Send function recording per-device order and concurrency violations."""
+
+    def __init__(self, devices: int, max_sleep: float):
+        self.max_sleep = max_sleep
+        self.last_seq = [-1] * devices
+        self.in_flight = [0] * devices
+        self.sent = 0
+        self.out_of_order = 0
+        self.overlaps = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        device = event.data['device']
+        seq = event.data['seq']
+        with self._lock:
+            self.in_flight[device] += 1
+            if self.in_flight[device] > 1:
+                self.overlaps += 1
+            if seq <= self.last_seq[device]:
+                self.out_of_order += 1
+            self.last_seq[device] = seq
+        # Give other senders every chance to interleave
+        if random.random() < 0.1:
+            time.sleep(random.random() * self.max_sleep)
+        else:
+            time.sleep(0)
+        with self._lock:
+            self.in_flight[device] -= 1
+            self.sent += 1
+
+
+def run(devices: int, events: int, workers: int, producers: int, max_sleep: float) -> dict:
+    """Run one stress round; the dispatcher's per-send output is discarded."""
+    checker = OrderChecker(devices, max_sleep)
+    dispatcher = Dispatcher(workers=workers, queue_size=events, device_queue_size=events, send=checker)
+    accepted = [0] * producers
+
+    def produce(index: int):
+        # Each producer owns a slice of the devices, like shards of the MQTT stream
+        owned = list(range(index, devices, producers))
+        for seq in range(events // producers):
+            device = owned[seq % len(owned)]
+            if dispatcher.submit('pump_start', device_id=f'device{device}',
+                                 data={'device': device, 'seq': seq}):
+                accepted[index] += 1
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        dispatcher.start()
+        started = time.perf_counter()
+        threads = [threading.Thread(target=produce, args=(i,)) for i in range(producers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        dispatcher.stop(timeout=60)
+        elapsed = time.perf_counter() - started
+
+    return {
+        'devices': devices,
+        'accepted': sum(accepted),
+        'sent': checker.sent,
+        'out_of_order': checker.out_of_order,
+        'overlaps': checker.overlaps,
+        'dropped': dispatcher.get_stats()['dropped'],
+        'elapsed': elapsed,
+    }
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--events', type=int, default=200000)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--producers', type=int, default=4)
+    parser.add_argument('--max-sleep', type=float, default=0.0005)
+    args = parser.parse_args(argv)
+
+    print(f"{args.events} events, {args.workers} senders, {args.producers} producers")
+    failed = False
+    # Few hot devices (deep per-device queues) and many devices (wide fan-out)
+    for devices in (min(args.devices, 8), args.devices):
+        result = run(devices, args.events, args.workers, args.producers, args.max_sleep)
+        ok = (result['out_of_order'] == 0 and result['overlaps'] == 0
+              and result['sent'] == result['accepted'])
+        failed = failed or not ok
+        print(f"  {devices:6d} devices: {result['accepted'] / result['elapsed']:10,.0f} events/s  "
+              f"sent {result['sent']}/{result['accepted']}, out of order {result['out_of_order']}, "
+              f"concurrent per device {result['overlaps']}, dropped {result['dropped']}  "
+              f"{'OK' if ok else 'FAIL'}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
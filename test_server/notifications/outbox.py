@@ -0,0 +1,251 @@
+"""
+Outbox - Durable log of notifications not yet delivered to FCM.
+
+Without it, a notification decided by on_message lives only in memory: a
+crash, restart or FCM outage loses it. With the outbox, every event is
+written to a SQLite database (WAL mode) before it is sent and deleted once
+FCM acknowledged it; on startup the events still in the outbox are sent
+again. Delivery is at least once: an event sent right before a crash may be
+sent twice.
+
+Writes are group-committed: append() only buffers the row, and a writer
+thread commits everything buffered in one transaction. While one commit is
+being synced, new rows pile up for the next, so a burst of events costs a
+few fsyncs instead of one per event (commit_interval adds an optional wait
+to gather more). A sender calls wait_durable() before sending, which returns
+as soon as the event's commit is on disk. A failed commit is retried with
+the next one, after COMMIT_RETRY_DELAY; until it succeeds its events are not
+durable and their senders keep waiting.
+
+Usage:
+    from .outbox import Outbox
+
+    outbox = Outbox('outbox.db')
+    outbox.open()
+    for event in outbox.pending():
+        ...  # replay
+    outbox.append(event)       # sets event.outbox_id
+    outbox.wait_durable(event.outbox_id)
+    ...  # send
+    outbox.ack(event.outbox_id)
+    outbox.close()
+"""
+import json
+import sqlite3
+import threading
+import time
+import traceback
+from typing import List
+
+from .config import OUTBOX_CONFIG
+from .dispatcher import LatencyStats, NotificationEvent
+
+# Seconds between attempts to commit after a failed commit
+COMMIT_RETRY_DELAY = 1.0
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    notification_type TEXT NOT NULL,
+    device_id TEXT,
+    data TEXT,
+    body TEXT,
+    created_at REAL NOT NULL
+)
+'''
+
+
+class Outbox:
+    """
+    SQLite outbox with a group-committing writer thread.
+
+    append() and ack() may be called from any thread; they only touch
+    in-memory buffers under a lock. The connection is used by the writer
+    thread, and by open()/pending()/count() under the same database lock.
+    """
+
+    def __init__(self, path: str = None, commit_interval: float = None, synchronous: str = None,
+                 replay_max_age: float = None):
+        self.path = path or OUTBOX_CONFIG['path']
+        self.commit_interval = (commit_interval if commit_interval is not None
+                                else OUTBOX_CONFIG['commit_interval'])
+        self.synchronous = (synchronous or OUTBOX_CONFIG['synchronous']).upper()
+        self.replay_max_age = (replay_max_age if replay_max_age is not None
+                               else OUTBOX_CONFIG['replay_max_age'])
+        self._conn = None
+        self._inserts = []
+        self._acks = []
+        self._next_id = 1
+        self._durable_id = 0
+        self._lock = threading.Lock()
+        # Senders waiting in wait_durable()
+        self._cond = threading.Condition(self._lock)
+        # The writer thread waiting for rows to commit
+        self._work = threading.Condition(self._lock)
+        # Serializes use of the connection
+        self._db_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self.appended = 0
+        self.acked = 0
+        self.commits = 0
+        self.failed_commits = 0
+        self.replayed = 0
+        self.expired = 0
+        self.commit_latency = LatencyStats()
+
+    def open(self):
+        """Open (creating if needed) the database and start the writer thread."""
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        self._conn.execute(_SCHEMA)
+        last_id = self._conn.execute('SELECT MAX(id) FROM outbox').fetchone()[0] or 0
+        self._next_id = last_id + 1
+        self._durable_id = last_id
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='outbox-writer', daemon=True)
+        self._thread.start()
+        print(f"Outbox opened: {self.path} ({self.count()} undelivered event(s))")
+
+    def close(self, timeout: float = 10.0):
+        """Commit what is buffered, stop the writer thread and close the database."""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._work.notify()
+        self._thread.join(timeout)
+        self._thread = None
+        self._conn.close()
+        self._conn = None
+
+    def append(self, event: NotificationEvent) -> int:
+        """
+        Buffer an event for the next commit; sets and returns event.outbox_id.
+
+        Never blocks on disk. Call wait_durable() before sending the event.
+        """
+        data = json.dumps(event.data) if event.data else None
+        created_at = time.time()
+        with self._cond:
+            outbox_id = self._next_id
+            self._next_id += 1
+            self._inserts.append(
+                (outbox_id, event.notification_type, event.device_id, data, event.body, created_at))
+            self.appended += 1
+            self._work.notify()
+        event.outbox_id = outbox_id
+        return outbox_id
+
+    def ack(self, outbox_id: int):
+        """Mark an event delivered; it is deleted in the next commit."""
+        with self._cond:
+            self._acks.append((outbox_id,))
+            self.acked += 1
+            self._work.notify()
+
+    def wait_durable(self, outbox_id: int, timeout: float = None) -> bool:
+        """
+        Block until the event's row is committed.
+
+        Returns:
+            False if the timeout expired first
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._durable_id >= outbox_id, timeout)
+
+    def pending(self) -> List[NotificationEvent]:
+        """
+        Undelivered events from earlier runs, oldest first, for replay.
+
+        Events older than replay_max_age seconds are deleted instead: a
+        "pump started" from hours ago is no longer worth a notification.
+        Call once after open(), before appending.
+        """
+        cutoff = time.time() - self.replay_max_age
+        with self._db_lock:
+            expired = self._conn.execute('DELETE FROM outbox WHERE created_at < ?', (cutoff,)).rowcount
+            rows = self._conn.execute(
+                'SELECT id, notification_type, device_id, data, body FROM outbox ORDER BY id').fetchall()
+        self.expired += expired
+        if expired:
+            print(f"Outbox: discarded {expired} undelivered event(s) older than {self.replay_max_age:.0f}s")
+        events = []
+        for outbox_id, notification_type, device_id, data, body in rows:
+            event = NotificationEvent(notification_type, device_id, json.loads(data) if data else None, body)
+            event.outbox_id = outbox_id
+            events.append(event)
+        self.replayed += len(events)
+        return events
+
+    def count(self) -> int:
+        """Rows in the database (committed, not yet acknowledged)."""
+        with self._db_lock:
+            return self._conn.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    def get_stats(self) -> dict:
+        """Snapshot of appended/acked events, commits and commit latency."""
+        with self._cond:
+            stats = {
+                'appended': self.appended,
+                'acked': self.acked,
+                'undelivered': self.appended + self.replayed - self.acked,
+                'commits': self.commits,
+                'failed_commits': self.failed_commits,
+                'rows_per_commit': round(self.appended / self.commits, 1) if self.commits else 0.0,
+                'replayed': self.replayed,
+                'expired': self.expired,
+            }
+        stats['commit_latency'] = self.commit_latency.snapshot()
+        return stats
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._work.wait_for(lambda: self._stopping or self._inserts or self._acks)
+                if self.commit_interval and not self._stopping:
+                    # Let more rows join this commit
+                    self._work.wait_for(lambda: self._stopping, self.commit_interval)
+                inserts, self._inserts = self._inserts, []
+                acks, self._acks = self._acks, []
+                stopping = self._stopping
+            if (inserts or acks) and not self._commit(inserts, acks):
+                with self._lock:
+                    # Retry these rows first, together with whatever arrived meanwhile
+                    self._inserts = inserts + self._inserts
+                    self._acks = acks + self._acks
+                    if not stopping:
+                        self._work.wait_for(lambda: self._stopping, COMMIT_RETRY_DELAY)
+                        continue
+            if stopping:
+                return
+
+    def _commit(self, inserts: list, acks: list) -> bool:
+        # True if committed; on failure nothing is marked durable
+        started = time.monotonic()
+        with self._db_lock:
+            conn = self._conn
+            try:
+                conn.execute('BEGIN')
+                if inserts:
+                    conn.executemany('INSERT INTO outbox VALUES (?, ?, ?, ?, ?, ?)', inserts)
+                if acks:
+                    conn.executemany('DELETE FROM outbox WHERE id = ?', acks)
+                conn.execute('COMMIT')
+            except sqlite3.Error as e:
+                print(f"!!! ERROR committing outbox ({len(inserts)} new, {len(acks)} acked), "
+                      f"retrying in {COMMIT_RETRY_DELAY}s: {type(e).__name__}: {e}")
+                traceback.print_exc()
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                with self._cond:
+                    self.failed_commits += 1
+                return False
+        self.commit_latency.record(time.monotonic() - started)
+        with self._cond:
+            self.commits += 1
+            if inserts:
+                self._durable_id = max(self._durable_id, inserts[-1][0])
+            self._cond.notify_all()
+        return True
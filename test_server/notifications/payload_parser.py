@@ -7,17 +7,23 @@ Handles various payload formats:
 - JSON with alternative fields: {"value": 1}, {"status": "on"}, {"state": true}
 
 Usage:
-    from .payload_parser import parse_payload, parse_payload_with_timestamp
+    from .payload_parser import parse_message, parse_payload, parse_payload_with_timestamp
     
+    message = parse_message('{"payload": "online", "timestamp": "2025-01-01 12:00:00"}')
+    # Returns: ParsedMessage with .value "online" and .timestamp datetime(2025, 1, 1, 12, 0)
+
     value = parse_payload('{"payload": "online", "timestamp": "2025-01-01"}')
     # Returns: "online"
     
     value, ts = parse_payload_with_timestamp('{"payload": "online", "timestamp": "2025-01-01 12:00:00"}')
     # Returns: ("online", datetime object or None)
 """
-import json
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Any, Optional, Tuple
+from enum import Enum
+from typing import Any, Iterable, Optional, Tuple, Union
+
+from . import json_backend
 
 
 # Fields to check in JSON payloads, in order of priority
@@ -40,6 +46,307 @@ TIMESTAMP_FORMATS = [
 # Default max age for messages (in seconds)
 DEFAULT_MAX_AGE_SECONDS = 60
 
+# Characters (and their byte values) that can start a JSON document
+_JSON_START = frozenset('{["-0123456789tfnNI') | frozenset(b'{["-0123456789tfnNI')
+
+# Values meaning on/true/online and off/false/offline (see classify();
+# register_state_tokens() adds firmware-specific words)
+TRUTHY_VALUES = ('1', 'on', 'true', 'online', 'connected', 'started', 'yes', 'active')
+FALSY_VALUES = ('0', 'off', 'false', 'offline', 'disconnected', 'stopped', 'no', 'inactive')
+
+# Tiny plain payloads most devices send; looked up as raw bytes (in lower,
+# upper and capitalized form) before any decoding, see lookup_trivial()
+TRIVIAL_PAYLOADS = (
+    '1', '0', 'on', 'off', 'true', 'false', 'yes', 'no',
+    'online', 'offline', 'connected', 'disconnected',
+    'started', 'stopped', 'active', 'inactive',
+)
+
+# Max number of devices whose payload format is remembered (least recently
+# seen devices are evicted first)
+DEFAULT_FORMAT_CACHE_SIZE = 10000
+
+
+class ParsedMessage:
+    """
+    Result of parsing one MQTT payload.
+
+    Attributes:
+        value: Extracted value as lowercase string (see parse_payload)
+        timestamp: Parsed timestamp, or None (see parse_timestamp)
+        data: The decoded JSON object when the payload is a JSON object, else None
+        is_json: True if the payload decoded as JSON (any JSON value)
+        payload_field: Key of PAYLOAD_FIELDS the value came from, or None
+        timestamp_field: Key of TIMESTAMP_FIELDS the timestamp came from, or None
+        timestamp_format: Entry of TIMESTAMP_FORMATS that matched, 'unix' for
+            numeric timestamps, or None
+    """
+
+    __slots__ = (
+        'value',
+        'timestamp',
+        'data',
+        'is_json',
+        'payload_field',
+        'timestamp_field',
+        'timestamp_format',
+    )
+
+    def __init__(self, value: str = '', timestamp: Optional[datetime] = None,
+                 data: Optional[dict] = None, is_json: bool = False,
+                 payload_field: Optional[str] = None, timestamp_field: Optional[str] = None,
+                 timestamp_format: Optional[str] = None):
+        self.value = value
+        self.timestamp = timestamp
+        self.data = data
+        self.is_json = is_json
+        self.payload_field = payload_field
+        self.timestamp_field = timestamp_field
+        self.timestamp_format = timestamp_format
+
+    def __repr__(self):
+        return (
+            f"ParsedMessage(value={self.value!r}, timestamp={self.timestamp!r}, "
+            f"payload_field={self.payload_field!r}, timestamp_field={self.timestamp_field!r}, "
+            f"timestamp_format={self.timestamp_format!r})"
+        )
+
+
+class _DeviceFormat:
+    """Payload layout last seen from one device."""
+
+    __slots__ = ('payload_field', 'timestamp_field', 'timestamp_format')
+
+    def __init__(self, payload_field: Optional[str], timestamp_field: Optional[str],
+                 timestamp_format: Optional[str]):
+        self.payload_field = payload_field
+        self.timestamp_field = timestamp_field
+        self.timestamp_format = timestamp_format
+
+
+class DeviceFormatCache:
+    """
+    LRU cache of the payload layout each device uses.
+
+    A device's firmware always sends the same shape, so the payload field,
+    timestamp field and timestamp format that matched last time are tried
+    first on its next message; on a miss the full search runs as usual and the
+    cache learns the new layout. A remembered field is only used while no
+    higher-priority PAYLOAD_FIELDS/TIMESTAMP_FIELDS key is present, so a
+    payload parses the same with or without the cache.
+
+    Not thread-safe: parse_message is only called from the MQTT callback thread.
+    """
+
+    KINDS = ('payload_field', 'timestamp_field', 'timestamp_format')
+
+    def __init__(self, max_devices: int = DEFAULT_FORMAT_CACHE_SIZE):
+        self.max_devices = max_devices
+        self._entries = OrderedDict()
+        self.hits = dict.fromkeys(self.KINDS, 0)
+        self.misses = dict.fromkeys(self.KINDS, 0)
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, device_id: str) -> Optional[_DeviceFormat]:
+        """Return the remembered layout for a device, marking it recently used."""
+        entry = self._entries.get(device_id)
+        if entry is not None:
+            self._entries.move_to_end(device_id)
+        return entry
+
+    def remember(self, device_id: str, message: 'ParsedMessage'):
+        """Store the layout detected in message for the device."""
+        entry = self._entries.get(device_id)
+        if entry is not None:
+            entry.payload_field = message.payload_field
+            entry.timestamp_field = message.timestamp_field
+            entry.timestamp_format = message.timestamp_format
+            return
+        self._entries[device_id] = _DeviceFormat(
+            message.payload_field,
+            message.timestamp_field,
+            message.timestamp_format,
+        )
+        if len(self._entries) > self.max_devices:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def record(self, kind: str, hit: bool):
+        """Count a hit or miss of a remembered choice."""
+        if hit:
+            self.hits[kind] += 1
+        else:
+            self.misses[kind] += 1
+
+    def clear(self):
+        """Forget all devices and reset the counters."""
+        self._entries.clear()
+        self.hits = dict.fromkeys(self.KINDS, 0)
+        self.misses = dict.fromkeys(self.KINDS, 0)
+        self.evictions = 0
+
+    def get_stats(self) -> dict:
+        """Snapshot of cache size and hit/miss counters per kind."""
+        return {
+            'devices': len(self._entries),
+            'max_devices': self.max_devices,
+            'evictions': self.evictions,
+            'hits': dict(self.hits),
+            'misses': dict(self.misses),
+        }
+
+
+# Layouts learned per device ID, used by parse_message(device_id=...)
+format_cache = DeviceFormatCache()
+
+
+def parse_message(raw_payload: Union[str, bytes], with_timestamp: bool = True,
+                  device_id: Optional[str] = None) -> ParsedMessage:
+    """
+    Parse an MQTT payload, decoding JSON at most once.
+
+    Args:
+        raw_payload: Raw MQTT message payload, as string or UTF-8 bytes
+        with_timestamp: Set to False to skip timestamp extraction
+        device_id: Sending device; enables the per-device format_cache
+
+    Returns:
+        ParsedMessage with the extracted value, timestamp and detection metadata
+
+    Raises:
+        UnicodeDecodeError: If a bytes payload is not valid UTF-8
+
+    Examples:
+        >>> parse_message('{"payload": "ON", "ts": 1735732800}').value
+        'on'
+        >>> parse_message(b'offline').is_json
+        False
+    """
+    if not raw_payload:
+        return ParsedMessage()
+
+    raw_payload = raw_payload.strip()
+    if isinstance(raw_payload, (bytes, bytearray)):
+        if not raw_payload:
+            return ParsedMessage()
+        # bytes.strip only removes ASCII whitespace; decode when the edges
+        # could hold other whitespace so results match the str path
+        if not (0x20 < raw_payload[0] < 0x7f and 0x20 < raw_payload[-1] < 0x7f):
+            raw_payload = raw_payload.decode('utf-8').strip()
+
+    # Only these first characters can start a JSON document
+    if not raw_payload or raw_payload[0] not in _JSON_START:
+        return ParsedMessage(_to_text(raw_payload).lower())
+
+    try:
+        data = json_backend.loads(raw_payload)
+    except ValueError:
+        # Plain string payload
+        return ParsedMessage(_to_text(raw_payload).lower())
+
+    message = ParsedMessage(is_json=True)
+
+    if not isinstance(data, dict):
+        # JSON but not an object (e.g., just a number or string)
+        message.value = _normalize_value(data) if data is not None else _to_text(raw_payload).lower()
+        return message
+
+    message.data = data
+    known = format_cache.get(device_id) if device_id is not None else None
+
+    # Try the field this device used last time, then known fields in priority order
+    value = None
+    field = known.payload_field if known is not None else None
+    if _is_first_field(data, field, _EARLIER_PAYLOAD_FIELDS):
+        format_cache.record('payload_field', True)
+    else:
+        if known is not None:
+            format_cache.record('payload_field', False)
+        field = _find_field(data, PAYLOAD_FIELDS)
+    if field is not None:
+        value = data[field]
+        message.payload_field = field
+    message.value = _normalize_value(value) if value is not None else _to_text(raw_payload).lower()
+
+    if with_timestamp:
+        field = known.timestamp_field if known is not None else None
+        if _is_first_field(data, field, _EARLIER_TIMESTAMP_FIELDS):
+            format_cache.record('timestamp_field', True)
+        else:
+            if known is not None:
+                format_cache.record('timestamp_field', False)
+            field = _find_field(data, TIMESTAMP_FIELDS)
+        if field is not None:
+            known_format = known.timestamp_format if known is not None else None
+            message.timestamp_field = field
+            message.timestamp, message.timestamp_format = _parse_timestamp_value(
+                data[field], known_format)
+            if known_format is not None:
+                format_cache.record(
+                    'timestamp_format', message.timestamp_format == known_format)
+
+    if device_id is not None and with_timestamp:
+        format_cache.remember(device_id, message)
+
+    return message
+
+
+def _to_text(raw_payload: Union[str, bytes]) -> str:
+    """Return the payload as str, decoding UTF-8 bytes."""
+    if isinstance(raw_payload, str):
+        return raw_payload
+    return bytes(raw_payload).decode('utf-8')
+
+
+def _find_field(data: dict, fields: list) -> Optional[str]:
+    """Return the first of fields present in data, or None."""
+    for field in fields:
+        if field in data:
+            return field
+    return None
+
+
+def _is_first_field(data: dict, field: Optional[str], earlier: dict) -> bool:
+    """True if field is in data and _find_field would pick it (no earlier field present)."""
+    if field is None or field not in data:
+        return False
+    before = earlier.get(field)
+    if before is None:
+        return False
+    for other in before:
+        if other in data:
+            return False
+    return True
+
+
+def _build_trivial_table() -> dict:
+    """Map the raw bytes of common plain payloads to their pre-parsed message."""
+    table = {}
+    for token in TRIVIAL_PAYLOADS:
+        for variant in (token, token.upper(), token.capitalize()):
+            table[variant.encode('utf-8')] = parse_message(variant)
+    return table
+
+
+def lookup_trivial(raw_payload: bytes) -> Optional[ParsedMessage]:
+    """
+    Look up a raw MQTT payload in the table of common plain payloads.
+
+    The table is built by running parse_message on every entry, so a hit is
+    exactly what parse_message would return. The returned message is shared:
+    do not modify it.
+
+    Args:
+        raw_payload: Raw MQTT message payload as bytes (msg.payload)
+
+    Returns:
+        The pre-parsed message, or None if the payload is not in the table
+    """
+    return _TRIVIAL_TABLE.get(raw_payload)
+
 
 def parse_payload(raw_payload: str) -> str:
     """
@@ -61,43 +368,7 @@ def parse_payload(raw_payload: str) -> str:
         >>> parse_payload('{"state": true}')
         'true'
     """
-    if not raw_payload:
-        return ''
-    
-    raw_payload = raw_payload.strip()
-    
-    # Try to parse as JSON
-    json_value = _extract_from_json(raw_payload)
-    if json_value is not None:
-        return _normalize_value(json_value)
-    
-    # Return as plain string
-    return raw_payload.lower()
-
-
-def _extract_from_json(raw_payload: str) -> Optional[Any]:
-    """
-    Try to extract value from JSON payload.
-    
-    Returns None if not valid JSON or no known field found.
-    """
-    try:
-        data = json.loads(raw_payload)
-        
-        if not isinstance(data, dict):
-            # JSON but not an object (e.g., just a number or string)
-            return data
-        
-        # Check known payload fields in priority order
-        for field in PAYLOAD_FIELDS:
-            if field in data:
-                return data[field]
-        
-        # No known field found
-        return None
-        
-    except (json.JSONDecodeError, TypeError):
-        return None
+    return parse_message(raw_payload, with_timestamp=False).value
 
 
 def _normalize_value(value: Any) -> str:
@@ -118,6 +389,48 @@ def _normalize_value(value: Any) -> str:
     return str(value).lower().strip()
 
 
+class State(Enum):
+    """Device state a payload value represents."""
+    ON = 'on'
+    OFF = 'off'
+    UNKNOWN = 'unknown'
+
+
+def register_state_tokens(on: Iterable[str] = (), off: Iterable[str] = ()):
+    """
+    Teach the classifier firmware-specific words for ON and OFF.
+
+    Tokens are normalized like parse_payload output (lowercase, stripped).
+
+    Args:
+        on: Values meaning on/true/online
+        off: Values meaning off/false/offline
+
+    Raises:
+        ValueError: If a token is already registered for the opposite state
+    """
+    for tokens, state in ((on, State.ON), (off, State.OFF)):
+        for token in tokens:
+            token = _normalize_value(token)
+            known = _STATE_TABLE.get(token)
+            if known is not None and known is not state:
+                raise ValueError(f"State token '{token}' is already registered as {known.name}")
+            _STATE_TABLE[token] = state
+
+
+def classify(value: str) -> State:
+    """
+    Classify a parsed value as ON, OFF or UNKNOWN with one dict lookup.
+
+    Args:
+        value: Parsed payload value (from parse_payload)
+
+    Returns:
+        State.ON, State.OFF or State.UNKNOWN
+    """
+    return _STATE_TABLE.get(value, State.UNKNOWN)
+
+
 def is_truthy(value: str) -> bool:
     """
     Check if a parsed value represents a "true" or "on" state.
@@ -128,7 +441,7 @@ def is_truthy(value: str) -> bool:
     Returns:
         True if value indicates on/true/online state
     """
-    return value in ('1', 'on', 'true', 'online', 'connected', 'started', 'yes', 'active')
+    return _STATE_TABLE.get(value) is State.ON
 
 
 def is_falsy(value: str) -> bool:
@@ -141,7 +454,7 @@ def is_falsy(value: str) -> bool:
     Returns:
         True if value indicates off/false/offline state
     """
-    return value in ('0', 'off', 'false', 'offline', 'disconnected', 'stopped', 'no', 'inactive')
+    return _STATE_TABLE.get(value) is State.OFF
 
 
 def parse_timestamp(raw_payload: str) -> Optional[datetime]:
@@ -154,53 +467,129 @@ def parse_timestamp(raw_payload: str) -> Optional[datetime]:
     Returns:
         datetime object if timestamp found and parsed, None otherwise
     """
-    if not raw_payload:
-        return None
-    
-    try:
-        data = json.loads(raw_payload.strip())
-        if not isinstance(data, dict):
-            return None
-        
-        # Find timestamp field
-        ts_value = None
-        for field in TIMESTAMP_FIELDS:
-            if field in data:
-                ts_value = data[field]
-                break
-        
-        if ts_value is None:
-            return None
-        
-        # Try to parse timestamp
-        return _parse_timestamp_value(ts_value)
-        
-    except (json.JSONDecodeError, TypeError):
-        return None
+    return parse_message(raw_payload).timestamp
 
 
-def _parse_timestamp_value(ts_value: Any) -> Optional[datetime]:
-    """Parse a timestamp value into datetime."""
+def _parse_timestamp_value(ts_value: Any, known_format: Optional[str] = None
+                           ) -> Tuple[Optional[datetime], Optional[str]]:
+    """
+    Parse a timestamp value into datetime.
+
+    Args:
+        ts_value: Timestamp from the payload (string or unix time)
+        known_format: Format this device used last time, tried first
+
+    Returns:
+        Tuple of (datetime or None, matching format or None)
+    """
     if ts_value is None:
-        return None
+        return None, None
     
     # If already a number (unix timestamp)
     if isinstance(ts_value, (int, float)):
         try:
-            return datetime.fromtimestamp(ts_value)
+            return datetime.fromtimestamp(ts_value), 'unix'
         except (ValueError, OSError):
-            return None
+            return None, None
     
     # Try string formats
-    ts_str = str(ts_value).strip()
-    
+    return _parse_timestamp_string(str(ts_value).strip(), known_format)
+
+
+def _parse_timestamp_string(ts_str: str, known_format: Optional[str] = None
+                            ) -> Tuple[Optional[datetime], Optional[str]]:
+    """
+    Parse a timestamp string in one of TIMESTAMP_FORMATS.
+
+    The fixed-width layouts are recognised by their separator positions and
+    parsed without strptime; anything else (e.g. unpadded fields) falls back to
+    trying each format with strptime, which defines the accepted inputs.
+    known_format, if given, is tried before the other formats.
+    """
+    timestamp, fmt = _fast_parse_timestamp(ts_str)
+    if timestamp is not None:
+        return timestamp, fmt
+    if known_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(ts_str, known_format), known_format
+        except ValueError:
+            pass
+    return _strptime_timestamp(ts_str)
+
+
+def _strptime_timestamp(ts_str: str) -> Tuple[Optional[datetime], Optional[str]]:
+    """Try each of TIMESTAMP_FORMATS in order with strptime."""
     for fmt in TIMESTAMP_FORMATS:
         try:
-            return datetime.strptime(ts_str, fmt)
+            return datetime.strptime(ts_str, fmt), fmt
         except ValueError:
             continue
     
-    return None
+    return None, None
+
+
+def _fast_parse_timestamp(ts_str: str) -> Tuple[Optional[datetime], Optional[str]]:
+    """
+    Parse the zero-padded layouts of TIMESTAMP_FORMATS in a single pass.
+
+    ISO layouts go straight to datetime.fromisoformat; the slash and day-first
+    layouts are sliced into ISO order first. Returns (None, None) whenever the
+    string is not exactly one of these layouts or is not a valid date, so the
+    caller can fall back to strptime and results stay identical.
+    """
+    length = len(ts_str)
+    if length < 19 or ts_str[13] != ':' or ts_str[16] != ':' or not ts_str.isascii():
+        return None, None
+
+    separator = ts_str[10]
+    if ts_str[4] == '-' and ts_str[7] == '-':
+        iso = ts_str[:19]
+        fraction = None
+        if length == 19:
+            fmt = '%Y-%m-%d %H:%M:%S' if separator == ' ' else '%Y-%m-%dT%H:%M:%S'
+        elif separator != 'T':
+            return None, None
+        elif length == 20 and ts_str[19] == 'Z':
+            fmt = '%Y-%m-%dT%H:%M:%SZ'
+        elif ts_str[19] == '.':
+            if ts_str[-1] == 'Z':
+                fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
+                fraction = ts_str[20:-1]
+            else:
+                fmt = '%Y-%m-%dT%H:%M:%S.%f'
+                fraction = ts_str[20:]
+            if not 1 <= len(fraction) <= 6 or not fraction.isdigit():
+                return None, None
+        else:
+            return None, None
+        if separator not in ' T':
+            return None, None
+    elif length != 19 or separator != ' ':
+        return None, None
+    elif ts_str[4] == '/' and ts_str[7] == '/':
+        fmt = '%Y/%m/%d %H:%M:%S'
+        iso = f"{ts_str[0:4]}-{ts_str[5:7]}-{ts_str[8:]}"
+        fraction = None
+    elif ts_str[2] == '-' and ts_str[5] == '-':
+        fmt = '%d-%m-%Y %H:%M:%S'
+        iso = f"{ts_str[6:10]}-{ts_str[3:5]}-{ts_str[0:2]}{ts_str[10:]}"
+        fraction = None
+    else:
+        return None, None
+
+    # iso is now 'YYYY-MM-DD?HH:MM:SS'; every field must be plain digits
+    if not (iso[0:4].isdigit() and iso[5:7].isdigit() and iso[8:10].isdigit()
+            and iso[11:13].isdigit() and iso[14:16].isdigit() and iso[17:19].isdigit()):
+        return None, None
+
+    try:
+        timestamp = datetime.fromisoformat(iso)
+    except ValueError:
+        return None, None
+    if fraction:
+        # strptime's %f pads the digits on the right: '.1' is 100000us
+        timestamp = timestamp.replace(microsecond=int(fraction.ljust(6, '0')))
+    return timestamp, fmt
 
 
 def parse_payload_with_timestamp(raw_payload: str) -> Tuple[str, Optional[datetime]]:
@@ -217,18 +606,19 @@ def parse_payload_with_timestamp(raw_payload: str) -> Tuple[str, Optional[dateti
         >>> parse_payload_with_timestamp('{"payload": "online", "timestamp": "2025-01-01 12:00:00"}')
         ('online', datetime(2025, 1, 1, 12, 0, 0))
     """
-    value = parse_payload(raw_payload)
-    timestamp = parse_timestamp(raw_payload)
-    return value, timestamp
+    message = parse_message(raw_payload)
+    return message.value, message.timestamp
 
 
-def is_message_recent(timestamp: Optional[datetime], max_age_seconds: int = DEFAULT_MAX_AGE_SECONDS) -> bool:
+def is_message_recent(timestamp: Optional[datetime], max_age_seconds: int = DEFAULT_MAX_AGE_SECONDS,
+                      now: Optional[datetime] = None) -> bool:
     """
     Check if a message timestamp is recent enough to process.
     
     Args:
         timestamp: Parsed timestamp from message (None = no timestamp, treat as recent)
         max_age_seconds: Maximum age in seconds for a message to be considered recent
+        now: When the message was received (default: now)
         
     Returns:
         True if message is recent or has no timestamp
@@ -237,18 +627,20 @@ def is_message_recent(timestamp: Optional[datetime], max_age_seconds: int = DEFA
         # No timestamp means we can't determine age, treat as recent
         return True
     
-    now = datetime.now()
+    if now is None:
+        now = datetime.now()
     age = now - timestamp
     
     return age <= timedelta(seconds=max_age_seconds)
 
 
-def get_message_age_seconds(timestamp: Optional[datetime]) -> Optional[float]:
+def get_message_age_seconds(timestamp: Optional[datetime], now: Optional[datetime] = None) -> Optional[float]:
     """
     Get the age of a message in seconds.
     
     Args:
         timestamp: Parsed timestamp from message
+        now: When the message was received (default: now)
         
     Returns:
         Age in seconds, or None if no timestamp
@@ -256,6 +648,17 @@ def get_message_age_seconds(timestamp: Optional[datetime]) -> Optional[float]:
     if timestamp is None:
         return None
     
-    now = datetime.now()
+    if now is None:
+        now = datetime.now()
     age = now - timestamp
     return age.total_seconds()
+
+
+# Higher-priority fields of each field, checked before a remembered field is used
+_EARLIER_PAYLOAD_FIELDS = {field: PAYLOAD_FIELDS[:i] for i, field in enumerate(PAYLOAD_FIELDS)}
+_EARLIER_TIMESTAMP_FIELDS = {field: TIMESTAMP_FIELDS[:i] for i, field in enumerate(TIMESTAMP_FIELDS)}
+
+_TRIVIAL_TABLE = _build_trivial_table()
+
+_STATE_TABLE = {}
+register_state_tokens(on=TRUTHY_VALUES, off=FALSY_VALUES)
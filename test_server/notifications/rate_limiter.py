@@ -0,0 +1,168 @@
+"""
+Rate Limiter - Token buckets bounding outgoing notifications.
+
+A device whose firmware toggles pump_status in a loop would otherwise turn
+every toggle into an FCM send to every subscriber of its topic. Before a
+notification is queued it must take a token from up to three buckets:
+
+- its device's bucket (device_rate per second, bursts of device_burst)
+- its notification type's bucket (type_rate / type_burst)
+- the global bucket (global_rate / global_burst)
+
+A rate of 0 disables that level. A notification over any limit is dropped
+and counted; per device, dropped notifications are remembered so a single
+summary can report them every summary_interval seconds.
+
+Buckets refill lazily when used, so each check is O(1). Device buckets are
+kept in an LRU of max_devices; an evicted device starts again with a full
+bucket.
+
+Usage:
+    from .rate_limiter import RateLimiter
+
+    limiter = RateLimiter(device_rate=0.1, device_burst=10)
+    if limiter.allow('pump_start', 'device123'):
+        ...  # send
+    for device_id, limited in limiter.take_summaries():
+        ...  # send one summary per device
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Tuple
+
+from .config import RATE_LIMIT_CONFIG
+
+
+class TokenBucket:
+    """Bucket of up to burst tokens refilled at rate tokens per second."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def available(self, now: float) -> float:
+        """Refill for the time elapsed and return the tokens available."""
+        tokens = self.tokens + (now - self.updated) * self.rate
+        self.tokens = tokens if tokens < self.burst else self.burst
+        self.updated = now
+        return self.tokens
+
+
+class RateLimiter:
+    """
+    Per-device, per-type and global token buckets.
+
+    allow() runs on the MQTT thread and on the housekeeping thread
+    (coalesced digests), so it takes a lock.
+    """
+
+    SCOPES = ('device', 'type', 'global')
+
+    def __init__(self, device_rate: float = None, device_burst: float = None,
+                 type_rate: float = None, type_burst: float = None,
+                 global_rate: float = None, global_burst: float = None,
+                 max_devices: int = None):
+        self.device_rate = device_rate if device_rate is not None else RATE_LIMIT_CONFIG['device_rate']
+        self.device_burst = device_burst if device_burst is not None else RATE_LIMIT_CONFIG['device_burst']
+        self.type_rate = type_rate if type_rate is not None else RATE_LIMIT_CONFIG['type_rate']
+        self.type_burst = type_burst if type_burst is not None else RATE_LIMIT_CONFIG['type_burst']
+        global_rate = global_rate if global_rate is not None else RATE_LIMIT_CONFIG['global_rate']
+        global_burst = global_burst if global_burst is not None else RATE_LIMIT_CONFIG['global_burst']
+        self.max_devices = max_devices if max_devices is not None else RATE_LIMIT_CONFIG['max_devices']
+        now = time.monotonic()
+        self._global = TokenBucket(global_rate, global_burst, now) if global_rate > 0 else None
+        self._types = {}
+        # Ordered from least to most recently used
+        self._devices = OrderedDict()
+        # Notifications dropped per device since the last summary
+        self._limited_devices = {}
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = dict.fromkeys(self.SCOPES, 0)
+        self.evictions = 0
+
+    def allow(self, notification_type: str, device_id: str = None, now: float = None) -> bool:
+        """
+        Take a token for a notification from every bucket that applies.
+
+        Tokens are only taken if all buckets have one, so a notification
+        stopped by the global limit does not use up its device's allowance.
+
+        Args:
+            notification_type: Key of NOTIFICATION_TYPES
+            device_id: Device the notification is about (None for digests)
+            now: time.monotonic() (default: now)
+
+        Returns:
+            True if the notification may be sent, False if it is over a limit
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            device = self._device_bucket(device_id, now) if device_id is not None else None
+            if device is not None and device.available(now) < 1:
+                return self._limit('device', device_id)
+            kind = self._type_bucket(notification_type, now)
+            if kind is not None and kind.available(now) < 1:
+                return self._limit('type', device_id)
+            if self._global is not None and self._global.available(now) < 1:
+                return self._limit('global', device_id)
+            if device is not None:
+                device.tokens -= 1
+            if kind is not None:
+                kind.tokens -= 1
+            if self._global is not None:
+                self._global.tokens -= 1
+            self.allowed += 1
+            return True
+
+    def take_summaries(self) -> List[Tuple[str, int]]:
+        """Return (device_id, dropped count) for every device limited since the last call."""
+        with self._lock:
+            limited, self._limited_devices = self._limited_devices, {}
+        return list(limited.items())
+
+    def get_stats(self) -> dict:
+        """Snapshot of tracked devices and allowed/limited counters."""
+        with self._lock:
+            return {
+                'tracked_devices': len(self._devices),
+                'max_devices': self.max_devices,
+                'evictions': self.evictions,
+                'allowed': self.allowed,
+                'limited': dict(self.limited),
+                'devices_limited': len(self._limited_devices),
+            }
+
+    def _limit(self, scope: str, device_id: str) -> bool:
+        self.limited[scope] += 1
+        if device_id is not None:
+            self._limited_devices[device_id] = self._limited_devices.get(device_id, 0) + 1
+        return False
+
+    def _device_bucket(self, device_id: str, now: float) -> TokenBucket:
+        if self.device_rate <= 0:
+            return None
+        devices = self._devices
+        bucket = devices.get(device_id)
+        if bucket is None:
+            bucket = devices[device_id] = TokenBucket(self.device_rate, self.device_burst, now)
+            if len(devices) > self.max_devices:
+                devices.popitem(last=False)
+                self.evictions += 1
+        else:
+            devices.move_to_end(device_id)
+        return bucket
+
+    def _type_bucket(self, notification_type: str, now: float) -> TokenBucket:
+        if self.type_rate <= 0:
+            return None
+        bucket = self._types.get(notification_type)
+        if bucket is None:
+            bucket = self._types[notification_type] = TokenBucket(self.type_rate, self.type_burst, now)
+        return bucket
@@ -0,0 +1,354 @@
+"""
+Retry - Retries failed FCM sends with backoff, behind a circuit breaker.
+
+Without it a send that fails is dropped. With it, a transient failure
+(throttling, unavailable, timeout) is retried after an exponential backoff
+with full jitter, or after the server's Retry-After if that is longer.
+Permanent errors (bad token, invalid argument) fail at once.
+
+Retries wait on a timer heap served by one scheduler thread; the attempts
+themselves run on a small pool. The RetryScheduler is the Dispatcher's send
+function and returns a Future, so while an event waits for its retry its
+device stays busy: the device's later notifications are parked behind it
+and still go out in order.
+
+A circuit breaker stops hammering FCM while it is unhealthy: after
+breaker_threshold consecutive transient failures it opens for
+breaker_open_seconds (or the Retry-After, if longer). While open, sends are
+parked instead of attempted; then a single probe decides whether it closes
+again. Parked sends are released at no more than drain_rate per second, so
+a recovering FCM is not hit by the whole backlog at once.
+
+Usage:
+    from .retry import RetryScheduler
+
+    retry = RetryScheduler(send=send_via_fcm)
+    retry.start()
+    dispatcher = Dispatcher(send=retry.send)
+    ...
+    retry.stop()
+    dispatcher.stop()
+"""
+import heapq
+import itertools
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Callable
+
+from .config import RETRY_CONFIG
+from .dispatcher import NotificationEvent, _send_via_fcm
+
+# HTTP statuses and Firebase error codes worth retrying
+RETRYABLE_STATUSES = frozenset((429, 500, 502, 503, 504))
+RETRYABLE_CODES = frozenset(('UNAVAILABLE', 'RESOURCE_EXHAUSTED', 'INTERNAL', 'DEADLINE_EXCEEDED',
+                             'ABORTED', 'UNKNOWN'))
+
+
+def is_retryable(error: Exception) -> bool:
+    """True for transient send errors: throttling, server errors, network failures."""
+    status = getattr(error, 'status', None)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    code = getattr(error, 'code', None)
+    if isinstance(code, str):
+        return code in RETRYABLE_CODES
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+def retry_after(error: Exception) -> float:
+    """Seconds the server asked us to wait (Retry-After), or None."""
+    seconds = getattr(error, 'retry_after', None)
+    if seconds is not None:
+        return seconds
+    response = getattr(error, 'http_response', None)
+    header = response.headers.get('Retry-After') if response is not None else None
+    if not header:
+        return None
+    if header.strip().isdigit():
+        return float(header)
+    try:
+        return max(0.0, parsedate_to_datetime(header).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base: float, cap: float, rng=random) -> float:
+    """Full-jitter exponential backoff: uniform in [0, min(cap, base * 2**attempt))."""
+    return rng.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after N consecutive failures -> half-open probe -> closed.
+
+    Thread-safe; allow() is asked before every attempt.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold: int = None, open_seconds: float = None):
+        self.threshold = threshold if threshold is not None else RETRY_CONFIG['breaker_threshold']
+        self.open_seconds = open_seconds if open_seconds is not None else RETRY_CONFIG['breaker_open_seconds']
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_until = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def allow(self, now: float = None) -> bool:
+        """True if an attempt may be made now (in half-open state: one probe at a time)."""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and now >= self._opened_until:
+                self.state = self.HALF_OPEN
+                print(">>> Circuit breaker half-open: probing FCM")
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def retry_in(self, now: float = None) -> float:
+        """Seconds until the breaker may let an attempt through."""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            return max(self._opened_until - now, 0.0)
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                print(">>> Circuit breaker closed: FCM healthy again")
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self, wait: float = None, now: float = None):
+        """Count a transient failure; wait is the server's Retry-After, if any."""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self._failures >= self.threshold:
+                open_for = max(self.open_seconds, wait or 0.0)
+            elif wait:
+                # The server asked every client to back off, not just this send
+                open_for = wait
+            else:
+                return
+            if self.state != self.OPEN:
+                self.opened += 1
+                print(f">>> Circuit breaker open for {open_for:.1f}s after {self._failures} failure(s)")
+            self.state = self.OPEN
+            self._opened_until = max(self._opened_until, now + open_for)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {'state': self.state, 'consecutive_failures': self._failures, 'opened': self.opened}
+
+
+class _Attempt:
+    """An event being sent, with the future its dispatcher waits on."""
+
+    __slots__ = ('event', 'future', 'attempts')
+
+    def __init__(self, event: NotificationEvent):
+        self.event = event
+        self.future = Future()
+        self.attempts = 0
+
+
+class RetryScheduler:
+    """
+    Send function wrapper adding retries, a circuit breaker and drain pacing.
+
+    send() is called on the dispatcher's sender threads and makes the first
+    attempt there. Retries and parked sends wait on the heap; the scheduler
+    thread releases due ones (paced by drain_rate) to the retry pool.
+    """
+
+    def __init__(self, send: Callable[[NotificationEvent], object] = None, max_attempts: int = None,
+                 base_delay: float = None, max_delay: float = None, drain_rate: float = None,
+                 workers: int = None, breaker: CircuitBreaker = None, rng=None):
+        self._send = send or _send_via_fcm
+        self.max_attempts = max_attempts if max_attempts is not None else RETRY_CONFIG['max_attempts']
+        self.base_delay = base_delay if base_delay is not None else RETRY_CONFIG['base_delay']
+        self.max_delay = max_delay if max_delay is not None else RETRY_CONFIG['max_delay']
+        self.drain_rate = drain_rate if drain_rate is not None else RETRY_CONFIG['drain_rate']
+        self.workers = workers if workers is not None else RETRY_CONFIG['workers']
+        self.breaker = breaker or CircuitBreaker()
+        self._rng = rng or random.Random()
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pool = None
+        self._stopping = False
+        # Token bucket pacing releases from the heap
+        self._tokens = self.drain_rate
+        self._refilled = time.monotonic()
+        self.retried = 0
+        self.parked = 0
+        self.gave_up = 0
+        self.permanent = 0
+
+    def start(self):
+        """Start the scheduler thread and retry pool. Safe to call more than once."""
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='fcm-retry')
+        self._thread = threading.Thread(target=self._run, name='retry-scheduler', daemon=True)
+        self._thread.start()
+        print(f"Retry scheduler started: up to {self.max_attempts} attempts, "
+              f"backoff {self.base_delay}s..{self.max_delay}s, drain {self.drain_rate}/s")
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Stop retrying: waiting sends fail at once (an outbox will replay them on
+        the next start) and later sends get a single attempt.
+        """
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            waiting = [task for _, _, task in self._heap]
+            self._heap = []
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        self._thread = None
+        for task in waiting:
+            task.future.set_exception(RuntimeError('shutting down before the retry was due'))
+        self._pool.shutdown(wait=True)
+
+    def send(self, event: NotificationEvent) -> Future:
+        """Send an event, retrying transient failures. Returns a Future of the FCM result."""
+        task = _Attempt(event)
+        self._attempt(task)
+        return task.future
+
+    def pending(self) -> int:
+        """Number of sends waiting for a retry or for the breaker to close."""
+        return len(self._heap)
+
+    def get_stats(self) -> dict:
+        """Snapshot of waiting sends, retry/park/give-up counters and breaker state."""
+        with self._cond:
+            stats = {
+                'waiting': len(self._heap),
+                'retried': self.retried,
+                'parked': self.parked,
+                'gave_up': self.gave_up,
+                'permanent_failures': self.permanent,
+            }
+        stats['breaker'] = self.breaker.get_stats()
+        return stats
+
+    def _attempt(self, task: _Attempt):
+        if not self._stopping and not self.breaker.allow():
+            with self._cond:
+                self.parked += 1
+            # Jitter spreads the parked sends over the first moments after reopening
+            self._schedule(task, self.breaker.retry_in() + self._rng.uniform(0, self.base_delay))
+            return
+        task.attempts += 1
+        try:
+            result = self._send(task.event)
+        except Exception as e:
+            self._failed(task, e)
+            return
+        if isinstance(result, Future):
+            result.add_done_callback(lambda future: self._completed(task, future))
+        else:
+            self._succeeded(task, result)
+
+    def _completed(self, task: _Attempt, future: Future):
+        error = future.exception()
+        if error is None:
+            self._succeeded(task, future.result())
+        else:
+            self._failed(task, error)
+
+    def _succeeded(self, task: _Attempt, result):
+        self.breaker.record_success()
+        task.future.set_result(result)
+
+    def _failed(self, task: _Attempt, error: Exception):
+        if not is_retryable(error):
+            # FCM answered, so it is reachable; this also ends a half-open probe
+            self.breaker.record_success()
+            with self._cond:
+                self.permanent += 1
+            task.future.set_exception(error)
+            return
+        wait = retry_after(error)
+        self.breaker.record_failure(wait)
+        if self._stopping or task.attempts >= self.max_attempts:
+            with self._cond:
+                self.gave_up += 1
+            task.future.set_exception(error)
+            return
+        delay = max(backoff_delay(task.attempts - 1, self.base_delay, self.max_delay, self._rng), wait or 0.0)
+        print(f">>> Retrying {task.event} in {delay:.1f}s (attempt {task.attempts} failed: "
+              f"{type(error).__name__}: {error})")
+        with self._cond:
+            self.retried += 1
+        self._schedule(task, delay)
+
+    def _schedule(self, task: _Attempt, delay: float):
+        with self._cond:
+            if self._stopping:
+                stopping = True
+            else:
+                stopping = False
+                heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), task))
+                if self._heap[0][2] is task:
+                    self._cond.notify()
+        if stopping:
+            task.future.set_exception(RuntimeError('shutting down before the retry was due'))
+
+    def _take_token(self, now: float) -> float:
+        # Returns 0 if a release is allowed now, else seconds until the next token
+        self._tokens = min(self.drain_rate, self._tokens + (now - self._refilled) * self.drain_rate)
+        self._refilled = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.drain_rate
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                now = time.monotonic()
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                due = self._heap[0][0]
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                wait = self._take_token(now)
+                if wait:
+                    self._cond.wait(wait)
+                    continue
+                task = heapq.heappop(self._heap)[2]
+            try:
+                self._pool.submit(self._attempt, task)
+            except RuntimeError as e:
+                # Pool already shut down
+                task.future.set_exception(e)
+            except Exception:
+                traceback.print_exc()
+                task.future.set_exception(RuntimeError('retry scheduling failed'))
@@ -0,0 +1,338 @@
+"""
+Sharding - Spreads message handling over worker processes by device ID.
+
+Decoding, parsing, classification and dispatch all run in Python, so a single
+process is bound to one core by the GIL. In sharded mode the MQTT process only
+routes: each message is hashed on its device ID to one of N worker processes,
+which run the usual handle_message pipeline with their own dispatcher. Every
+message of a given device lands on the same shard, in arrival order, so
+per-device state (transitions, flapping, format cache) stays consistent.
+
+Messages are forwarded in small batches over a multiprocessing queue per
+shard. A crashed worker is restarted on the same queue, so messages still
+queued for it are not lost; restart(shard) replaces a worker gracefully after
+it has drained what was sent to it, and terminates it if it does not finish
+in time, so two workers never share a shard.
+
+Metrics are per process: each worker serves its own pipeline metrics on
+NOTIFY_METRICS_PORT + 1 + shard, the supervisor's endpoint only has what the
+routing process records. Scrape every port and sum across them.
+
+With the outbox enabled, shard i replays only outbox.db.shard{i}. After
+NOTIFY_SHARDS is lowered, or when switching between sharded and unsharded
+mode, undelivered events sit in files no process reads: adopt_orphaned_outboxes()
+moves them to the file of the shard now owning each device before the
+workers start.
+
+Usage:
+    from .sharding import ShardSupervisor
+
+    supervisor = ShardSupervisor(shards=4)
+    supervisor.start()
+    client.on_message = supervisor.on_message
+    ...
+    print(supervisor.get_stats())
+    supervisor.stop()
+"""
+import glob
+import multiprocessing
+import os
+import queue
+import re
+import signal
+import sqlite3
+import threading
+import time
+import traceback
+import zlib
+
+from .config import SHARD_CONFIG
+from .outbox import Outbox
+
+# Workers are spawned, not forked: forking the threaded MQTT process could
+# hand a child locks held by other threads
+_context = multiprocessing.get_context('spawn')
+
+
+def shard_for(device_id: str, shards: int) -> int:
+    """Stable shard index of a device (same in every process and run)."""
+    return zlib.crc32(device_id.encode('utf-8')) % shards
+
+
+def shard_outbox_path(path: str, device_id: str, shards: int) -> str:
+    """Outbox file replaying a device's events: path itself unless sharded."""
+    if shards <= 1:
+        return path
+    return f"{path}.shard{shard_for(device_id or '', shards)}"
+
+
+def adopt_orphaned_outboxes(path: str, shards: int) -> int:
+    """
+    Move undelivered events out of outbox files that no process will replay.
+
+    With shards > 1 those are the unsharded file and path.shard{i} for
+    i >= shards; unsharded, every path.shard{i}. Each event is appended to
+    the file of the shard owning its device (its replay age restarts), then
+    the emptied file is removed. Call before the workers open their outboxes.
+    A file that cannot be moved is left in place and reported.
+
+    Args:
+        path: Unsharded outbox file (OUTBOX_CONFIG['path'])
+        shards: Number of shards about to start (0 or 1 = unsharded)
+
+    Returns:
+        Number of events moved
+    """
+    orphans = []
+    for candidate in glob.glob(glob.escape(path) + '.shard*'):
+        match = re.fullmatch(r'\.shard(\d+)', candidate[len(path):])
+        if match and (shards <= 1 or int(match.group(1)) >= shards):
+            orphans.append(candidate)
+    if shards > 1 and os.path.exists(path):
+        orphans.append(path)
+
+    moved = 0
+    for orphan in sorted(orphans):
+        source = Outbox(orphan, commit_interval=0)
+        try:
+            source.open()
+            events = source.pending()
+            by_target = {}
+            for event in events:
+                by_target.setdefault(shard_outbox_path(path, event.device_id, shards), []).append(event)
+            for target_path, target_events in by_target.items():
+                target = Outbox(target_path, commit_interval=0)
+                target.open()
+                try:
+                    for event in target_events:
+                        target.append(event)
+                    if not target.wait_durable(target_events[-1].outbox_id, timeout=30):
+                        raise sqlite3.OperationalError(f'{target_path} not committed')
+                finally:
+                    target.close()
+            source.close()
+        except (sqlite3.Error, OSError) as e:
+            source.close()
+            print(f"!!! ERROR moving undelivered events out of {orphan}, left in place "
+                  f"and not replayed: {type(e).__name__}: {e}")
+            traceback.print_exc()
+            continue
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(orphan + suffix):
+                os.remove(orphan + suffix)
+        print(f"Outbox: moved {len(events)} undelivered event(s) from {orphan}")
+        moved += len(events)
+    return moved
+
+
+def _shard_main(index: int, inbox, processed):
+    """Worker process: run the handler pipeline on every message routed to this shard."""
+    from . import metrics, mqtt_handler
+    from .config import METRICS_CONFIG, OUTBOX_CONFIG
+
+    # Each shard replays only its own devices' undelivered notifications
+    OUTBOX_CONFIG['path'] = f"{OUTBOX_CONFIG['path']}.shard{index}"
+
+    # Ctrl+C reaches the whole process group; the supervisor decides when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    print(f"Shard {index} started (pid {_context.current_process().pid})")
+    if METRICS_CONFIG['enabled']:
+        # The pipeline's metrics live in this process: serve them next to the supervisor's
+        port = METRICS_CONFIG['port']
+        try:
+            metrics.start_server(port=port + 1 + index if port else 0)
+        except OSError as e:
+            print(f"Shard {index} metrics endpoint unavailable: {e}")
+    dispatcher = mqtt_handler.get_dispatcher()
+    mqtt_handler.housekeeper.start()
+    try:
+        while True:
+            batch = inbox.get()
+            if batch is None:
+                break
+            for topic, raw_payload, received_at in batch:
+                mqtt_handler.handle_message(topic, raw_payload, received_at)
+            with processed.get_lock():
+                processed[index] += len(batch)
+    finally:
+        mqtt_handler.housekeeper.stop()
+        print(f"Shard {index} stopping")
+        mqtt_handler.stop_pipeline()
+        metrics.stop_server()
+
+
+class ShardSupervisor:
+    """
+    Routes messages to N worker processes by device ID and keeps them running.
+
+    Workers start with the spawn method, so each imports a fresh handler
+    with its own dispatcher, caches and housekeeping thread.
+
+    route()/on_message() run on the MQTT thread; flush() and check_workers()
+    run on the housekeeping thread; a lock guards the pending batches.
+    """
+
+    def __init__(self, shards: int = None, batch_size: int = None, max_delay: float = None):
+        self.shards = shards if shards is not None else SHARD_CONFIG['shards']
+        self.batch_size = batch_size if batch_size is not None else SHARD_CONFIG['batch_size']
+        self.max_delay = max_delay if max_delay is not None else SHARD_CONFIG['max_delay']
+        self._inboxes = [_context.Queue() for _ in range(self.shards)]
+        self._processes = [None] * self.shards
+        self._pending = [[] for _ in range(self.shards)]
+        self._oldest = [0.0] * self.shards
+        self._lock = threading.Lock()
+        # Serializes restart() with the crash check in check_workers()
+        self._process_lock = threading.Lock()
+        self._stopping = False
+        # Shared with the workers: messages each shard has finished
+        self._processed = _context.Array('Q', self.shards)
+        self.routed = [0] * self.shards
+        self.restarts = [0] * self.shards
+        self._last_sample = (time.monotonic(), [0] * self.shards)
+        self._last_log = time.monotonic()
+
+    def start(self):
+        """Start one worker process per shard."""
+        for index in range(self.shards):
+            self._spawn(index)
+        print(f"Shard supervisor started: {self.shards} worker process(es)")
+
+    def stop(self, timeout: float = 10.0):
+        """Send pending batches, then stop every worker after it drains its queue."""
+        self._stopping = True
+        self.flush(force=True)
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            if process is not None:
+                process.join(timeout)
+
+    def restart(self, index: int, timeout: float = 10.0):
+        """
+        Gracefully replace a shard's worker.
+
+        The old worker finishes every message already routed to it, then a new
+        worker takes over the same queue; nothing is dropped or reordered.
+        A worker still running after timeout seconds is terminated before the
+        new one starts: the batch it was handling is lost, the batches still
+        queued move to the new worker.
+        """
+        self.flush(force=True)
+        with self._process_lock:
+            self._inboxes[index].put(None)
+            process = self._processes[index]
+            if process is not None:
+                process.join(timeout)
+                if process.is_alive():
+                    print(f"!!! Shard {index} worker did not stop within {timeout}s, terminating it")
+                    process.terminate()
+                    process.join()
+                    self._replace_inbox(index)
+            self._spawn(index)
+            self.restarts[index] += 1
+
+    def on_message(self, client, userdata, msg):
+        """paho on_message callback: route instead of handling in this process."""
+        self.route(msg.topic, msg.payload)
+
+    def route(self, topic: str, raw_payload: bytes, received_at: float = None):
+        """Queue a message for the shard owning its device."""
+        if received_at is None:
+            received_at = time.monotonic()
+        device_id = topic.split('/', 1)[0]
+        index = shard_for(device_id, self.shards)
+        with self._lock:
+            pending = self._pending[index]
+            if not pending:
+                self._oldest[index] = received_at
+            pending.append((topic, raw_payload, received_at))
+            self.routed[index] += 1
+            if len(pending) >= self.batch_size:
+                self._send(index)
+
+    def flush(self, now: float = None, force: bool = False):
+        """Send batches older than max_delay (all of them if force). Housekeeping task."""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            for index, pending in enumerate(self._pending):
+                if pending and (force or now - self._oldest[index] >= self.max_delay):
+                    self._send(index)
+
+    def check_workers(self, now: float = None):
+        """Restart workers that died. Housekeeping task."""
+        if self._stopping:
+            return
+        with self._process_lock:
+            for index, process in enumerate(self._processes):
+                if process is not None and not process.is_alive():
+                    print(f"!!! Shard {index} worker exited (code {process.exitcode}), restarting")
+                    try:
+                        self._spawn(index)
+                        self.restarts[index] += 1
+                    except Exception as e:
+                        print(f"!!! ERROR restarting shard {index}: {type(e).__name__}: {e}")
+                        traceback.print_exc()
+
+    def log_stats(self, now: float = None):
+        """Print per-shard stats every SHARD_CONFIG['stats_interval'] seconds. Housekeeping task."""
+        if now is None:
+            now = time.monotonic()
+        if now - self._last_log < SHARD_CONFIG['stats_interval']:
+            return
+        self._last_log = now
+        for shard in self.get_stats()['shards']:
+            print(f"Shard {shard['shard']}: {shard['rate']:.1f} msgs/s, processed {shard['processed']}, "
+                  f"backlog {shard['backlog']}, restarts {shard['restarts']}")
+
+    def get_stats(self) -> dict:
+        """Per-shard routed/processed counts, backlog, restarts and msgs/s since the last call."""
+        now = time.monotonic()
+        processed = list(self._processed)
+        last_time, last_processed = self._last_sample
+        elapsed = max(now - last_time, 1e-9)
+        self._last_sample = (now, processed)
+        return {
+            'shards': [
+                {
+                    'shard': index,
+                    'routed': self.routed[index],
+                    'processed': processed[index],
+                    'backlog': self.routed[index] - processed[index],
+                    'restarts': self.restarts[index],
+                    'rate': round((processed[index] - last_processed[index]) / elapsed, 1),
+                }
+                for index in range(self.shards)
+            ],
+        }
+
+    def _send(self, index: int):
+        # Caller holds the lock
+        self._inboxes[index].put(self._pending[index])
+        self._pending[index] = []
+
+    def _replace_inbox(self, index: int):
+        # Moves the queued batches to a new queue, leaving behind the stop marker
+        # the terminated worker never read. It may have been killed holding the
+        # old queue's lock, so give up on the old queue if a get times out.
+        old = self._inboxes[index]
+        inbox = _context.Queue()
+        with self._lock:
+            while True:
+                try:
+                    batch = old.get(timeout=0.5)
+                except queue.Empty:
+                    break
+                if batch is not None:
+                    inbox.put(batch)
+            self._inboxes[index] = inbox
+
+    def _spawn(self, index: int):
+        process = _context.Process(
+            target=_shard_main,
+            args=(index, self._inboxes[index], self._processed),
+            name=f'shard-{index}',
+            daemon=True,
+        )
+        process.start()
+        self._processes[index] = process
@@ -0,0 +1,126 @@
+"""
+State Cache - Remembers the last known state of every device.
+
+Devices republish their current state on reconnect, on retained-message replay
+and on periodic refresh. Comparing each message with the last known state lets
+the handler notify only on real transitions (pump off -> on, online -> offline).
+
+Devices that stop publishing are forgotten after ttl_seconds, and the least
+recently seen device is evicted when more than max_devices are tracked; a
+forgotten device's next message counts as a transition again.
+
+Usage:
+    from .state_cache import DeviceStateCache
+
+    cache = DeviceStateCache(max_devices=100000, ttl_seconds=86400)
+    if cache.is_transition('device123', 'pump', State.ON):
+        ...  # send pump_start
+"""
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from .config import STATE_CACHE_CONFIG
+from .payload_parser import State
+
+
+class _DeviceState:
+    """Last known states of one device."""
+
+    __slots__ = ('pump', 'status', 'last_seen')
+
+    def __init__(self, last_seen: float):
+        self.pump = None
+        self.status = None
+        self.last_seen = last_seen
+
+
+class DeviceStateCache:
+    """
+    Per-device last-known-state table with LRU and idle-time eviction.
+
+    Not thread-safe: used from the MQTT callback thread only.
+    """
+
+    KINDS = ('pump', 'status')
+
+    def __init__(self, max_devices: int = None, ttl_seconds: float = None):
+        self.max_devices = max_devices if max_devices is not None else STATE_CACHE_CONFIG['max_devices']
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else STATE_CACHE_CONFIG['ttl_seconds']
+        # Ordered from least to most recently seen
+        self._devices = OrderedDict()
+        self.transitions = dict.fromkeys(self.KINDS, 0)
+        self.suppressed = dict.fromkeys(self.KINDS, 0)
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._devices)
+
+    def get(self, device_id: str, kind: str) -> Optional[State]:
+        """Return the last known state of a device, or None if unknown."""
+        entry = self._devices.get(device_id)
+        return getattr(entry, kind) if entry is not None else None
+
+    def is_transition(self, device_id: str, kind: str, state: State, now: float = None) -> bool:
+        """
+        Record a device's reported state.
+
+        Args:
+            device_id: Device that reported the state
+            kind: 'pump' (pump_status topic) or 'status' (online/offline)
+            state: Reported State.ON or State.OFF
+            now: time.monotonic() of the report (default: now)
+
+        Returns:
+            True if the state differs from the last known one (or none is known)
+        """
+        if now is None:
+            now = time.monotonic()
+        self.evict_idle(now)
+
+        entry = self._devices.get(device_id)
+        if entry is None:
+            entry = self._devices[device_id] = _DeviceState(now)
+            if len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+                self.evictions += 1
+        else:
+            entry.last_seen = now
+            self._devices.move_to_end(device_id)
+
+        if getattr(entry, kind) is state:
+            self.suppressed[kind] += 1
+            return False
+        setattr(entry, kind, state)
+        self.transitions[kind] += 1
+        return True
+
+    def evict_idle(self, now: float = None) -> int:
+        """
+        Forget devices not seen for ttl_seconds.
+
+        Returns:
+            Number of devices evicted
+        """
+        if now is None:
+            now = time.monotonic()
+        deadline = now - self.ttl_seconds
+        evicted = 0
+        while self._devices:
+            entry = next(iter(self._devices.values()))
+            if entry.last_seen > deadline:
+                break
+            self._devices.popitem(last=False)
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def get_stats(self) -> dict:
+        """Snapshot of table size and transition/suppression counters per kind."""
+        return {
+            'devices': len(self._devices),
+            'max_devices': self.max_devices,
+            'evictions': self.evictions,
+            'transitions': dict(self.transitions),
+            'suppressed': dict(self.suppressed),
+        }
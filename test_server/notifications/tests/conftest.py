@@ -0,0 +1,11 @@
+"""
+Tests of the notification service.
+
+Usage:
+    python -m pytest test_server/notifications/tests
+"""
+import os
+import sys
+
+# The package is imported as test_server.notifications, from the repository root
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..')))
@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+from test_server.notifications import async_service, capture, fcm_service, metrics
+from test_server.notifications.async_service import AsyncDispatcher
+from test_server.notifications.dispatcher import SENT, NotificationEvent
+from test_server.notifications.outbox import Outbox
+from test_server.notifications.retry import CircuitBreaker
+from test_server.notifications.transport import FcmSendError, encode_message
+
+
+def test_v1_message_matches_firebase_admin_encoding():
+    event = NotificationEvent('pump_start', 'd1', {'level': 3}, 'Pump on')
+    message = fcm_service.build_message('pump_start', data={'level': 3}, device_id='d1', body='Pump on')
+    body = async_service.build_v1_message(event)
+    expected = encode_message(message)
+    # The data timestamp is rendered at build time
+    body['message']['data'].pop('timestamp')
+    expected['data'].pop('timestamp')
+    assert body == {'message': expected}
+
+
+def test_transient_failure_is_retried_in_order(monkeypatch):
+    monkeypatch.setitem(async_service.RETRY_CONFIG, 'base_delay', 0.01)
+    outcomes = [FcmSendError(503, 'unavailable')]
+    sent = []
+
+    async def send(event):
+        if outcomes:
+            raise outcomes.pop(0)
+        sent.append(event.notification_type)
+        return 'ok'
+
+    async def main():
+        dispatcher = AsyncDispatcher(send=send, retry=True, breaker=CircuitBreaker(threshold=5))
+        dispatcher.start()
+        dispatcher.submit('pump_start', device_id='d1')
+        dispatcher.submit('pump_stop', device_id='d1')
+        await dispatcher.stop(timeout=5)
+        return dispatcher.get_stats()
+
+    before = SENT.labels('pump_start').get()
+    stats = asyncio.run(main())
+    assert sent == ['pump_start', 'pump_stop']
+    assert (stats['sent'], stats['failed'], stats['retried']) == (2, 0, 1)
+    assert SENT.labels('pump_start').get() == before + 1
+
+
+def test_sent_events_are_acked_in_the_outbox(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox.db'), commit_interval=0)
+    outbox.open()
+
+    async def send(event):
+        return 'ok'
+
+    async def main():
+        dispatcher = AsyncDispatcher(send=send, outbox=outbox, retry=False)
+        dispatcher.start()
+        dispatcher.submit('pump_start', device_id='d1')
+        await dispatcher.stop(timeout=5)
+
+    try:
+        asyncio.run(main())
+        outbox.close()
+        outbox.open()
+        assert outbox.pending() == []
+    finally:
+        outbox.close()
+
+
+def test_run_serves_metrics_and_captures(tmp_path, monkeypatch):
+    path = str(tmp_path / 'run.bgcap')
+    monkeypatch.setitem(async_service.CAPTURE_CONFIG, 'path', path)
+    monkeypatch.setitem(async_service.METRICS_CONFIG, 'enabled', True)
+    monkeypatch.setitem(async_service.METRICS_CONFIG, 'port', 0)
+    monkeypatch.setitem(async_service.OUTBOX_CONFIG, 'enabled', False)
+    monkeypatch.setattr(async_service.mqtt_handler, '_dispatcher', None)
+    servers = []
+
+    async def send(event):
+        return 'ok'
+
+    async def messages():
+        for topic, payload in (('d1/status', b'online'), ('d1/pump_status', b'1')):
+            yield topic, payload, time.monotonic()
+        servers.append(metrics._server)
+
+    asyncio.run(async_service.run(send=send, messages=messages()))
+    assert servers[0] is not None and servers[0].port
+    assert metrics._server is None
+    assert capture.info(path)['records'] == 2
@@ -0,0 +1,41 @@
+import time
+from datetime import datetime
+
+from test_server.notifications import capture
+
+# (seconds since capture start, topic, payload value)
+MESSAGES = [
+    (0.0, 'd1/pump_status', '1'),
+    (1.0, 'd1/pump_status', '0'),
+    (2.0, 'd2/status', 'online'),
+    (3.0, 'd2/pump_status', '1'),
+]
+
+
+def _write_capture(path, started_at: float):
+    # Messages timestamped when they were recorded, started_at seconds since the epoch
+    writer = capture.CaptureWriter(str(path), compress=False)
+    writer.open()
+    for offset, topic, value in MESSAGES:
+        timestamp = datetime.fromtimestamp(started_at + offset).strftime('%Y-%m-%d %H:%M:%S')
+        payload = f'{{"payload": "{value}", "timestamp": "{timestamp}"}}'.encode()
+        writer.record(topic, payload, writer._started + offset)
+    writer.close()
+    with open(path, 'r+b') as f:
+        f.write(capture._HEADER.pack(capture.MAGIC, capture.VERSION, started_at))
+
+
+def test_replay_of_old_capture_is_not_stale(tmp_path):
+    path = tmp_path / 'old.bgcap'
+    _write_capture(path, time.time() - 3 * 3600)
+    report = capture.replay(str(path), speed=0)
+    assert report['messages'] == len(MESSAGES)
+    assert report['notifications'] == len(MESSAGES)
+
+
+def test_replays_give_the_same_notifications(tmp_path):
+    path = tmp_path / 'old.bgcap'
+    _write_capture(path, time.time() - 3 * 3600)
+    first = capture.replay(str(path), speed=0)
+    second = capture.replay(str(path), speed=0)
+    assert first['notifications'] == second['notifications'] == len(MESSAGES)
@@ -0,0 +1,20 @@
+from test_server.notifications.coalescer import Coalescer
+
+
+def test_offline_cancels_buffered_online():
+    coalescer = Coalescer(window_seconds=5, types=['device_online'])
+    assert coalescer.add('device_online', 'd1')
+    assert coalescer.add('device_online', 'd2')
+    # Not coalesced, but it undoes d1's buffered online: neither is sent
+    assert coalescer.add('device_offline', 'd1')
+    assert not coalescer.add('device_offline', 'd3')
+    batches = coalescer.flush_all()
+    assert [(b.notification_type, list(b.device_ids)) for b in batches] == [('device_online', ['d2'])]
+
+
+def test_opposite_pair_in_one_window_sends_nothing():
+    coalescer = Coalescer(window_seconds=5, types=['device_online', 'device_offline'])
+    assert coalescer.add('device_offline', 'd1')
+    assert coalescer.add('device_online', 'd1')
+    assert coalescer.flush_all() == []
+    assert coalescer.get_stats()['cancelled'] == 1
@@ -0,0 +1,56 @@
+import random
+
+from test_server.notifications.flap_damper import FlapDamper
+from test_server.notifications.payload_parser import State
+
+
+class _WalkingDamper(FlapDamper):
+    """Reference: the original poll(), checking every tracked device."""
+
+    def poll(self, now=None):
+        summaries = []
+        for device_id, entry in list(self._devices.items()):
+            if entry.damped:
+                if now - entry.last_change >= self.hold_down_seconds:
+                    summaries.append((device_id, entry.state, entry.suppressed,
+                                      now - entry.changes[0] if entry.changes else 0.0))
+                    entry.damped = False
+                    entry.suppressed = 0
+            elif now - entry.last_change >= self.window_seconds:
+                del self._devices[device_id]
+        return summaries
+
+
+def _summaries(damper, now):
+    return sorted((s.device_id, s.state, s.suppressed, s.damped_seconds) for s in damper.poll(now))
+
+
+def test_poll_matches_a_walk_over_all_devices():
+    rng = random.Random(7)
+    settings = dict(window_seconds=30, max_transitions=3, hold_down_seconds=10)
+    damper, reference = FlapDamper(**settings), _WalkingDamper(**settings)
+    now = 0.0
+    for step in range(20000):
+        now += rng.random() * 0.2
+        device_id = f'device{rng.randrange(40)}'
+        state = rng.choice((State.ON, State.OFF))
+        assert damper.allow(device_id, state, now) == reference.allow(device_id, state, now)
+        if step % 10 == 0:
+            assert _summaries(damper, now) == sorted(reference.poll(now))
+            assert list(damper._devices) == [d for d, _ in sorted(
+                reference._devices.items(), key=lambda item: item[1].last_change)]
+            assert damper.get_stats()['damped_devices'] == sum(
+                1 for entry in reference._devices.values() if entry.damped)
+
+
+def test_released_device_reports_its_settled_state():
+    damper = FlapDamper(window_seconds=300, max_transitions=2, hold_down_seconds=60)
+    for i, state in enumerate((State.ON, State.OFF, State.ON, State.OFF, State.ON)):
+        damper.allow('d1', state, float(i))
+    assert damper.poll(63.0) == []
+    [summary] = damper.poll(64.0)
+    assert (summary.device_id, summary.state, summary.suppressed) == ('d1', State.ON, 3)
+    assert not damper.is_damped('d1')
+    # Quiet for the whole window: forgotten
+    damper.poll(305.0)
+    assert damper.get_stats()['tracked_devices'] == 0
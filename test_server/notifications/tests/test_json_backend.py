@@ -0,0 +1,98 @@
+import pytest
+
+from test_server.notifications import json_backend
+from test_server.notifications.payload_parser import (
+    PAYLOAD_FIELDS,
+    TIMESTAMP_FIELDS,
+    TRIVIAL_PAYLOADS,
+    parse_message,
+)
+
+# One sample per entry of TIMESTAMP_FORMATS, plus unpadded and invalid ones
+TIMESTAMP_VALUES = [
+    '"2025-12-23 18:13:31"',
+    '"2025-12-23T18:13:31"',
+    '"2025-12-23T18:13:31Z"',
+    '"2025-12-23T18:13:31.123"',
+    '"2025-12-23T18:13:31.123Z"',
+    '"2025/12/23 18:13:31"',
+    '"23-12-2025 18:13:31"',
+    '"2025-1-2 3:04:05"',
+    '"2025-02-30 12:00:00"',
+    '"not a date"',
+    '1766513611',
+    '1766513611.25',
+    'null',
+    'true',
+]
+
+VALUES = ['"online"', '"OFF"', '1', '0', '1.0', '2.5', 'true', 'false', 'null', '"\\u00e9t\\u00e9"',
+          '[1, 2]', '{"nested": 1}', '123456789012345678901234567890', 'NaN', '-Infinity']
+
+EDGE_CASES = [
+    '', ' ', 'online', ' OFFLINE \n', 'null', '"On"', '[]', '{}', '{"x": 1}', 'NaN', '1e400',
+    '{"payload": "on"', '{"payload": "on"} trailing', "{'payload': 'on'}", ' online ',
+    ' {"payload": "on"}', '\x1f1\x1f', '{"payload": "\\ud800"}', '{"payload": 1, "payload": 0}',
+    '﻿{"payload": "on"}', 'Ünïcödé', '{"payload": "café"}',
+]
+
+
+def payload_corpus() -> list:
+    """Every payload shape parse_message supports, as str."""
+    corpus = list(TRIVIAL_PAYLOADS) + EDGE_CASES
+    for field in PAYLOAD_FIELDS:
+        for value in VALUES:
+            corpus.append(f'{{"{field}": {value}}}')
+    for field in TIMESTAMP_FIELDS:
+        for ts_value in TIMESTAMP_VALUES:
+            corpus.append(f'{{"payload": "online", "{field}": {ts_value}}}')
+    return corpus
+
+
+def _outcome(raw_payload) -> tuple:
+    try:
+        m = parse_message(raw_payload)
+    except Exception as e:
+        return ('raises', type(e).__name__)
+    # Compare dicts through repr so NaN values compare equal
+    return (m.value, m.timestamp, repr(m.data), m.is_json, m.payload_field,
+            m.timestamp_field, m.timestamp_format)
+
+
+CORPUS = payload_corpus()
+
+# A few bytes-only cases: invalid UTF-8 and non-breaking space edges
+RAW_BYTES = [b'\xff\xfe', b'{"payload": "\xff"}', ' online'.encode('utf-8')]
+
+
+@pytest.fixture
+def backend(request):
+    """Select the backend named by the test parameter, skipping it if not installed."""
+    if request.param != 'json':
+        pytest.importorskip(request.param)
+    original = json_backend.name
+    json_backend.select_backend('json')
+    # The standard library on str input is the reference
+    expected = [_outcome(raw) for raw in CORPUS]
+    expected_bytes = [_outcome(raw) for raw in RAW_BYTES]
+    json_backend.select_backend(request.param)
+    try:
+        yield expected, expected_bytes
+    finally:
+        json_backend.select_backend(original)
+
+
+@pytest.mark.parametrize('backend', ['orjson', 'ujson', 'json'], indirect=True)
+def test_backend_matches_stdlib(backend):
+    expected, expected_bytes = backend
+    mismatches = []
+    for raw, want in zip(CORPUS, expected):
+        for variant in (raw, raw.encode('utf-8')):
+            got = _outcome(variant)
+            if got != want:
+                mismatches.append((variant, got, want))
+    for raw, want in zip(RAW_BYTES, expected_bytes):
+        got = _outcome(raw)
+        if got != want:
+            mismatches.append((raw, got, want))
+    assert mismatches == []
@@ -0,0 +1,141 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from test_server.notifications import ordering_stress
+from test_server.notifications.keyed_executor import KeyedExecutor
+
+
+def _recording_executor(**kwargs):
+    handled = []
+    executor = KeyedExecutor(handler=handled.append, workers=1, **kwargs)
+    return executor, handled
+
+
+@pytest.mark.parametrize('devices', [8, 200])
+def test_per_device_order_under_stress(devices):
+    result = ordering_stress.run(devices, events=20000, workers=16, producers=4, max_sleep=0.0002)
+    assert result['out_of_order'] == 0
+    assert result['overlaps'] == 0
+    assert result['sent'] == result['accepted'] == 20000
+
+
+def test_items_of_a_key_run_in_submission_order():
+    executor, handled = _recording_executor()
+    for i in range(5):
+        executor.submit('a', ('a', i))
+        executor.submit('b', ('b', i))
+    executor.start()
+    executor.stop()
+    assert [i for key, i in handled if key == 'a'] == list(range(5))
+    assert [i for key, i in handled if key == 'b'] == list(range(5))
+    # Keys take turns
+    assert [key for key, _ in handled[:4]] == ['a', 'b', 'a', 'b']
+
+
+def test_queue_bounds_reject_items():
+    executor, _ = _recording_executor(max_pending=3, max_per_key=2)
+    assert executor.submit('a', 1)
+    assert executor.submit('a', 2)
+    assert not executor.submit('a', 3)
+    assert executor.submit('b', 1)
+    assert not executor.submit('c', 1)
+    stats = executor.get_stats()
+    assert (stats['pending'], stats['rejected_key'], stats['rejected_full']) == (3, 1, 1)
+
+
+def test_max_pending_is_per_lane():
+    executor, _ = _recording_executor(max_pending=1, lanes={'critical': 8, 'default': 1})
+    assert executor.submit('a', 1)
+    assert not executor.submit('b', 1)
+    assert executor.submit('b', 2, lane='critical')
+
+
+def test_idle_keys_are_forgotten():
+    executor, handled = _recording_executor()
+    for key in ('a', 'b', 'c'):
+        executor.submit(key, key)
+    assert executor.active_keys() == 3
+    executor.start()
+    executor.stop()
+    assert handled == ['a', 'b', 'c']
+    assert executor.active_keys() == 0
+    assert executor.get_stats()['evicted_keys'] == 3
+
+
+def test_key_stays_busy_until_its_future_completes():
+    futures = []
+    handled = []
+
+    def handler(item):
+        handled.append(item)
+        future = Future()
+        futures.append(future)
+        return future
+
+    executor = KeyedExecutor(handler=handler, workers=2)
+    executor.submit('a', 1)
+    executor.submit('a', 2)
+    executor.start()
+    deadline = time.monotonic() + 5
+    while not futures and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    assert handled == [1]
+    assert executor.active_keys() == 1
+    futures[0].set_result(None)
+    while len(futures) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    futures[1].set_result(None)
+    executor.stop()
+    assert handled == [1, 2]
+    assert executor.active_keys() == 0
+
+
+def test_critical_lane_is_served_first():
+    executor, handled = _recording_executor(lanes={'critical': 8, 'bulk': 1})
+    for i in range(4):
+        executor.submit(f'bulk{i}', 'bulk', lane='bulk')
+    executor.submit('urgent', 'critical', lane='critical')
+    executor.start()
+    executor.stop()
+    assert handled[0] == 'critical'
+
+
+def test_urgent_item_promotes_the_items_ahead_of_it():
+    executor, handled = _recording_executor(lanes={'critical': 8, 'bulk': 1})
+    for i in range(3):
+        executor.submit(f'other{i}', f'other{i}', lane='bulk')
+    executor.submit('a', 'a-bulk', lane='bulk')
+    executor.submit('a', 'a-critical', lane='critical')
+    executor.start()
+    executor.stop()
+    # The key moved to the critical lane but its bulk item still runs first
+    assert handled[:2] == ['a-bulk', 'a-critical']
+    assert executor.get_stats()['promoted'] == 1
+
+
+def test_aged_lane_is_served_out_of_turn():
+    gate = threading.Event()
+    handled = []
+
+    def handler(item):
+        if item == 'block':
+            gate.wait(5)
+        handled.append(item)
+
+    executor = KeyedExecutor(handler=handler, workers=1, lanes={'critical': 1000, 'bulk': 1},
+                             max_wait=0.05)
+    executor.submit('blocker', 'block', lane='critical')
+    executor.start()
+    executor.submit('slow', 'bulk', lane='bulk')
+    for i in range(3):
+        executor.submit(f'fast{i}', 'critical', lane='critical')
+    time.sleep(0.1)
+    gate.set()
+    executor.stop()
+    # The bulk key waited past max_wait, so it goes before the critical backlog
+    assert handled[:2] == ['block', 'bulk']
+    assert executor.get_stats()['lanes']['bulk']['aged'] == 1
@@ -0,0 +1,63 @@
+from test_server.notifications import mqtt_handler
+from test_server.notifications.flap_damper import FlapDamper
+from test_server.notifications.rate_limiter import RateLimiter
+from test_server.notifications.state_cache import DeviceStateCache
+
+
+class _Recorder:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, notification_type, device_id=None, **kwargs):
+        self.submitted.append(notification_type)
+        return True
+
+    def record_latency(self, stage, seconds):
+        pass
+
+
+def test_critical_types_are_not_rate_limited(monkeypatch):
+    dispatcher = _Recorder()
+    monkeypatch.setattr(mqtt_handler, '_dispatcher', dispatcher)
+    monkeypatch.setattr(mqtt_handler, 'rate_limiter', RateLimiter(device_rate=0.001, device_burst=1))
+    assert mqtt_handler.submit_notification('pump_start', device_id='d1', now=0.0)
+    assert not mqtt_handler.submit_notification('pump_stop', device_id='d1', now=0.0)
+    assert mqtt_handler.submit_notification('device_offline', device_id='d1', now=0.0)
+    assert mqtt_handler.submit_notification('device_offline', device_id='d1', now=0.0)
+    assert dispatcher.submitted == ['pump_start', 'device_offline', 'device_offline']
+
+
+def test_repeats_and_flapping_are_counted_as_suppressed(monkeypatch):
+    monkeypatch.setattr(mqtt_handler, '_dispatcher', _Recorder())
+    monkeypatch.setattr(mqtt_handler, 'coalescer', None)
+    monkeypatch.setattr(mqtt_handler, 'rate_limiter', None)
+    monkeypatch.setattr(mqtt_handler, 'state_cache', DeviceStateCache())
+    monkeypatch.setattr(mqtt_handler, 'flap_damper', FlapDamper(window_seconds=300, max_transitions=2,
+                                                                 hold_down_seconds=120))
+    suppressed = mqtt_handler.SUPPRESSED
+    before = {kind: suppressed.labels(kind).get() for kind in ('pump', 'status', 'flap')}
+    mqtt_handler.handle_message('d1/pump_status', b'1')
+    mqtt_handler.handle_message('d1/pump_status', b'1')
+    for payload in (b'online', b'online', b'offline', b'online', b'offline'):
+        mqtt_handler.handle_message('d1/status', payload)
+    after = {kind: suppressed.labels(kind).get() - before[kind] for kind in before}
+    assert after == {'pump': 1, 'status': 1, 'flap': 2}
+
+
+def test_online_is_sent_at_once_unless_coalescing_is_configured(monkeypatch):
+    dispatcher = _Recorder()
+    monkeypatch.setattr(mqtt_handler, '_dispatcher', dispatcher)
+    for name in ('state_cache', 'flap_damper', 'coalescer', 'rate_limiter'):
+        monkeypatch.setattr(mqtt_handler, name, getattr(mqtt_handler, name))
+    monkeypatch.setitem(mqtt_handler.COALESCE_CONFIG, 'window_seconds', 0)
+    mqtt_handler.reset_filters()
+    assert mqtt_handler.coalescer is None
+    mqtt_handler.handle_message('d1/status', b'online')
+    assert dispatcher.submitted == ['device_online']
+
+    monkeypatch.setitem(mqtt_handler.COALESCE_CONFIG, 'window_seconds', 5)
+    mqtt_handler.reset_filters()
+    mqtt_handler.handle_message('d2/status', b'online')
+    assert dispatcher.submitted == ['device_online']
+    mqtt_handler.flush_coalesced(flush_all=True)
+    assert dispatcher.submitted == ['device_online', 'device_online']
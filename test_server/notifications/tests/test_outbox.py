@@ -0,0 +1,55 @@
+import sqlite3
+
+from test_server.notifications import outbox as outbox_module
+from test_server.notifications.dispatcher import Dispatcher, NotificationEvent
+from test_server.notifications.outbox import Outbox
+
+
+class _FlakyConnection:
+    """sqlite3 connection whose first executemany fails, like a full disk."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.failures = 1
+
+    def executemany(self, sql, rows):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError('database or disk is full')
+        return self._conn.executemany(sql, rows)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def test_dropped_event_is_replayed_on_next_start(tmp_path):
+    path = str(tmp_path / 'outbox.db')
+    outbox = Outbox(path, commit_interval=0)
+    outbox.open()
+    # Not started: the second event of the lane does not fit and is dropped
+    dispatcher = Dispatcher(workers=1, queue_size=1, outbox=outbox, lanes={'default': 1})
+    assert dispatcher.submit('pump_start', device_id='d1')
+    assert not dispatcher.submit('pump_start', device_id='d2')
+    outbox.close()
+
+    outbox = Outbox(path, commit_interval=0)
+    outbox.open()
+    try:
+        assert [event.device_id for event in outbox.pending()] == ['d1', 'd2']
+    finally:
+        outbox.close()
+
+
+def test_failed_commit_is_not_durable_until_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr(outbox_module, 'COMMIT_RETRY_DELAY', 0.2)
+    outbox = Outbox(str(tmp_path / 'outbox.db'), commit_interval=0)
+    outbox.open()
+    try:
+        outbox._conn = _FlakyConnection(outbox._conn)
+        outbox_id = outbox.append(NotificationEvent('pump_start', 'd1'))
+        assert not outbox.wait_durable(outbox_id, timeout=0.1)
+        assert outbox.wait_durable(outbox_id, timeout=2)
+        assert outbox.count() == 1
+        assert outbox.get_stats()['failed_commits'] == 1
+    finally:
+        outbox.close()
@@ -0,0 +1,44 @@
+import json
+import random
+
+from test_server.notifications import payload_parser
+from test_server.notifications.payload_parser import PAYLOAD_FIELDS, TIMESTAMP_FIELDS, parse_message
+
+VALUES = ['ON', 'off', 1, 0, 1e20, True, None, 'online', {'nested': 1}]
+TIMESTAMPS = ['2025-12-23 18:13:31', '2025-12-23T18:13:31Z', '23-12-2025 18:13:31',
+              '2025-12-23T18:13:31.123Z', 1766513611, 'not a time', None]
+
+
+def _fields(message):
+    return (message.value, message.timestamp, message.payload_field, message.timestamp_field)
+
+
+def _random_payload(rng):
+    data = {}
+    for field in rng.sample(PAYLOAD_FIELDS, rng.randint(0, 3)):
+        data[field] = rng.choice(VALUES)
+    for field in rng.sample(TIMESTAMP_FIELDS, rng.randint(0, 2)):
+        data[field] = rng.choice(TIMESTAMPS)
+    return json.dumps(data)
+
+
+def test_format_cache_does_not_change_results():
+    payload_parser.format_cache.clear()
+    rng = random.Random(4)
+    try:
+        for i in range(20000):
+            payload = _random_payload(rng)
+            cached = parse_message(payload, device_id=f'device{i % 7}')
+            assert _fields(cached) == _fields(parse_message(payload)), payload
+        assert sum(payload_parser.format_cache.hits.values()) > 0
+    finally:
+        payload_parser.format_cache.clear()
+
+
+def test_higher_priority_field_wins_over_remembered_one():
+    payload_parser.format_cache.clear()
+    try:
+        parse_message('{"state": "ON"}', device_id='d1')
+        assert parse_message('{"state": "OFF", "status": 1e20}', device_id='d1').value == '100000000000000000000'
+    finally:
+        payload_parser.format_cache.clear()
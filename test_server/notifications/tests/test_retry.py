@@ -0,0 +1,41 @@
+import time
+
+from test_server.notifications.retry import CircuitBreaker, RetryScheduler
+from test_server.notifications.dispatcher import NotificationEvent
+from test_server.notifications.transport import FcmSendError
+
+
+def test_permanent_error_on_probe_closes_breaker():
+    outcomes = [FcmSendError(503, 'unavailable'), FcmSendError(400, 'invalid argument')]
+
+    def send(event):
+        if outcomes:
+            raise outcomes.pop(0)
+        return 'projects/test/messages/1'
+
+    breaker = CircuitBreaker(threshold=1, open_seconds=0.05)
+    retry = RetryScheduler(send=send, max_attempts=1, base_delay=0.01, drain_rate=1000, breaker=breaker)
+    retry.start()
+    try:
+        # Opens the breaker
+        assert retry.send(NotificationEvent('pump_start', 'd1')).exception(timeout=2) is not None
+        assert breaker.state == CircuitBreaker.OPEN
+        time.sleep(0.06)
+        # The half-open probe fails permanently: FCM answered, so the breaker closes
+        probe = retry.send(NotificationEvent('pump_start', 'd2'))
+        assert isinstance(probe.exception(timeout=2), FcmSendError)
+        assert breaker.state == CircuitBreaker.CLOSED
+        healthy = retry.send(NotificationEvent('pump_start', 'd3'))
+        assert healthy.result(timeout=2) == 'projects/test/messages/1'
+    finally:
+        retry.stop()
+
+
+def test_breaker_allows_again_after_probe_outcome():
+    breaker = CircuitBreaker(threshold=1, open_seconds=0)
+    breaker.record_failure(now=0)
+    assert breaker.allow(now=1)
+    # Only one probe at a time
+    assert not breaker.allow(now=1)
+    breaker.record_success()
+    assert breaker.allow(now=1)
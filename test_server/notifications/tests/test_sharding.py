@@ -0,0 +1,119 @@
+import socket
+import time
+import urllib.request
+
+from test_server.notifications import sharding
+from test_server.notifications.dispatcher import NotificationEvent
+from test_server.notifications.outbox import Outbox
+
+
+def _stuck_worker(index, inbox, processed):
+    # Never reads its queue, so it never sees the stop marker
+    time.sleep(60)
+
+
+def test_restart_terminates_a_worker_that_does_not_stop(monkeypatch):
+    supervisor = sharding.ShardSupervisor(shards=1, batch_size=100, max_delay=60)
+    process = sharding._context.Process(target=_stuck_worker, args=(0, supervisor._inboxes[0], None),
+                                        daemon=True)
+    process.start()
+    supervisor._processes[0] = process
+    spawned = []
+    monkeypatch.setattr(supervisor, '_spawn', spawned.append)
+
+    supervisor.route('d1/status', b'online')
+    supervisor.restart(0, timeout=0.2)
+
+    assert not process.is_alive()
+    assert spawned == [0]
+    # The new worker gets the queued batch, not the old worker's stop marker
+    inbox = supervisor._inboxes[0]
+    assert [topic for topic, _, _ in inbox.get(timeout=5)] == ['d1/status']
+    assert inbox.empty()
+
+
+def _free_port_base(count: int) -> int:
+    # First of count consecutive ports that are free right now
+    for base in range(20000, 60000, 97):
+        sockets = []
+        try:
+            for port in range(base, base + count):
+                sock = socket.socket()
+                sockets.append(sock)
+                sock.bind(('127.0.0.1', port))
+            return base
+        except OSError:
+            continue
+        finally:
+            for sock in sockets:
+                sock.close()
+    raise RuntimeError('no free ports')
+
+
+def _received(port: int) -> float:
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+        text = response.read().decode()
+    return sum(float(line.rsplit(' ', 1)[1]) for line in text.splitlines()
+               if line.startswith('notify_messages_received_total{'))
+
+
+def test_each_shard_serves_its_own_metrics(monkeypatch):
+    port = _free_port_base(3)
+    # Read by the spawned workers when they import the config
+    monkeypatch.setenv('NOTIFY_METRICS_PORT', str(port))
+    monkeypatch.setenv('NOTIFY_TRANSPORT', 'dry_run')
+    supervisor = sharding.ShardSupervisor(shards=2, batch_size=100, max_delay=60)
+    supervisor.start()
+    try:
+        devices = [f'device{i}' for i in range(20)]
+        for device in devices:
+            supervisor.route(f'{device}/status', b'online')
+        supervisor.flush(force=True)
+        deadline = time.monotonic() + 60
+        while sum(supervisor._processed) < len(devices) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        per_shard = [_received(port + 1 + index) for index in range(2)]
+        expected = [sum(1 for d in devices if sharding.shard_for(d, 2) == index) for index in range(2)]
+        assert per_shard == expected
+    finally:
+        supervisor.stop()
+
+
+def _write_outbox(path, device_ids):
+    outbox = Outbox(str(path), commit_interval=0)
+    outbox.open()
+    for device_id in device_ids:
+        outbox.append(NotificationEvent('pump_start', device_id))
+    outbox.wait_durable(outbox.appended)
+    outbox.close()
+
+
+def _pending(path):
+    outbox = Outbox(str(path), commit_interval=0)
+    outbox.open()
+    try:
+        return [event.device_id for event in outbox.pending()]
+    finally:
+        outbox.close()
+
+
+def test_events_in_orphaned_outboxes_move_to_their_shard(tmp_path):
+    path = str(tmp_path / 'outbox.db')
+    devices = [f'device{i}' for i in range(12)]
+    # Left behind by a run with 4 shards, and one before sharding
+    for index in range(4):
+        _write_outbox(f'{path}.shard{index}', [d for d in devices if sharding.shard_for(d, 4) == index])
+    _write_outbox(path, ['unsharded'])
+
+    moved = sharding.adopt_orphaned_outboxes(path, 2)
+
+    assert moved == 1 + sum(1 for d in devices if sharding.shard_for(d, 4) >= 2)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['outbox.db.shard0', 'outbox.db.shard1']
+    for index in range(2):
+        assert sorted(_pending(f'{path}.shard{index}')) == sorted(
+            d for d in devices + ['unsharded'] if sharding.shard_for(d, 2) == index)
+
+    # Back to unsharded: everything lands in the one file
+    assert sharding.adopt_orphaned_outboxes(path, 0) == len(devices) + 1
+    assert sorted(_pending(path)) == sorted(devices + ['unsharded'])
+    assert [p.name for p in tmp_path.iterdir()] == ['outbox.db']
@@ -0,0 +1,321 @@
+"""
+Transport - Pluggable delivery of built FCM messages.
+
+fcm_service builds messaging.Message objects and hands them to a transport:
+
+- FcmTransport: firebase_admin against real FCM (the default)
+- DryRunTransport: sends nothing; messages are encoded (so invalid ones still
+  fail) and counted, after an optional simulated latency
+- HttpTransport: FCM HTTP v1 requests to any endpoint, e.g. the local
+  stand-in in fcm_stub.py, so the whole notification path can be load-tested
+  offline
+
+The transport is picked with NOTIFY_TRANSPORT (fcm, dry_run or http); see
+TRANSPORT_CONFIG.
+
+Usage:
+    from . import fcm_service
+    from .transport import DryRunTransport
+
+    fcm_service.set_transport(DryRunTransport())
+    fcm_service.send_to_topic('pump_start', device_id='device123')
+
+    NOTIFY_TRANSPORT=http FCM_ENDPOINT=http://127.0.0.1:8089 \\
+        python -m test_server.notifications.mqtt_handler
+"""
+import http.client
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from firebase_admin import messaging
+
+from .config import FIREBASE_CREDENTIALS_PATH, TRANSPORT_CONFIG
+
+FCM_SCOPES = ['https://www.googleapis.com/auth/firebase.messaging']
+
+
+class FcmSendError(Exception):
+    """FCM rejected a send; carries the HTTP status and any Retry-After delay."""
+
+    def __init__(self, status: int, message: str, retry_after: float = None):
+        super().__init__(f"FCM HTTP {status}: {message}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def encode_message(message: messaging.Message) -> dict:
+    """FCM v1 JSON of a message, as firebase_admin would send it."""
+    # firebase_admin does not expose its encoder publicly: requirements.txt caps
+    # its version, and test_v1_message_matches_firebase_admin_encoding guards
+    # the output when the cap is raised
+    return messaging._MessagingService.encode_message(message)
+
+
+def expand_multicast(message: messaging.MulticastMessage) -> list:
+    """One messaging.Message per token of a multicast message."""
+    return [
+        messaging.Message(
+            data=message.data,
+            notification=message.notification,
+            android=message.android,
+            webpush=message.webpush,
+            apns=message.apns,
+            fcm_options=message.fcm_options,
+            token=token,
+        )
+        for token in message.tokens
+    ]
+
+
+class Transport:
+    """
+    Delivers built messages. Subclasses implement send(); send_each() and
+    send_multicast() default to one send() per message.
+    """
+
+    name = 'transport'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+
+    def send(self, message: messaging.Message) -> str:
+        """
+        Send one message.
+
+        Returns:
+            str: Message ID, e.g. 'projects/<id>/messages/<n>'
+        """
+        raise NotImplementedError
+
+    def send_each(self, messages: list) -> messaging.BatchResponse:
+        """Send several messages; responses[i] is the result of messages[i]."""
+        return messaging.BatchResponse([self._send_response(message) for message in messages])
+
+    def send_multicast(self, message: messaging.MulticastMessage) -> messaging.BatchResponse:
+        """Send a message to each of its tokens."""
+        return self.send_each(expand_multicast(message))
+
+    def close(self):
+        """Release connections and threads."""
+
+    def get_stats(self) -> dict:
+        """Snapshot of sent and failed message counts."""
+        with self._lock:
+            return {'transport': self.name, 'sent': self.sent, 'failed': self.failed}
+
+    def _send_response(self, message: messaging.Message) -> messaging.SendResponse:
+        try:
+            return messaging.SendResponse({'name': self.send(message)}, None)
+        except Exception as e:
+            return messaging.SendResponse(None, e)
+
+    def _count(self, sent: int = 0, failed: int = 0):
+        with self._lock:
+            self.sent += sent
+            self.failed += failed
+
+
+class FcmTransport(Transport):
+    """Real FCM through firebase_admin (credentials from firebase-admin-key.json)."""
+
+    name = 'fcm'
+
+    def send(self, message: messaging.Message) -> str:
+        _firebase_app()
+        try:
+            response = messaging.send(message)
+        except Exception:
+            self._count(failed=1)
+            raise
+        self._count(sent=1)
+        return response
+
+    def send_each(self, messages: list) -> messaging.BatchResponse:
+        _firebase_app()
+        response = messaging.send_each(messages)
+        self._count(response.success_count, response.failure_count)
+        return response
+
+    def send_multicast(self, message: messaging.MulticastMessage) -> messaging.BatchResponse:
+        _firebase_app()
+        response = messaging.send_each_for_multicast(message)
+        self._count(response.success_count, response.failure_count)
+        return response
+
+
+class DryRunTransport(Transport):
+    """Accepts every valid message without sending it anywhere."""
+
+    name = 'dry_run'
+
+    def __init__(self, latency: float = None, project_id: str = 'dry-run'):
+        super().__init__()
+        self.latency = latency if latency is not None else TRANSPORT_CONFIG['dry_run_latency']
+        self.project_id = project_id
+        self._ids = itertools.count(1)
+
+    def send(self, message: messaging.Message) -> str:
+        message_id = self._accept(message)
+        if self.latency:
+            time.sleep(self.latency)
+        return message_id
+
+    def send_each(self, messages: list) -> messaging.BatchResponse:
+        responses = []
+        for message in messages:
+            try:
+                responses.append(messaging.SendResponse({'name': self._accept(message)}, None))
+            except Exception as e:
+                responses.append(messaging.SendResponse(None, e))
+        # One simulated round-trip for the whole batch, like a single send_each call
+        if self.latency:
+            time.sleep(self.latency)
+        return messaging.BatchResponse(responses)
+
+    def _accept(self, message: messaging.Message) -> str:
+        try:
+            encode_message(message)
+        except Exception:
+            self._count(failed=1)
+            raise
+        self._count(sent=1)
+        return f"projects/{self.project_id}/messages/{next(self._ids)}"
+
+
+class HttpTransport(Transport):
+    """
+    FCM HTTP v1 client over keep-alive HTTP/1.1 connections, one per thread.
+
+    Requests carry an OAuth2 token only if credentials are given, so the
+    local stand-in needs none. Errors are raised as FcmSendError with the
+    HTTP status (and Retry-After), which retry.py knows how to handle.
+    """
+
+    name = 'http'
+
+    def __init__(self, endpoint: str = None, project_id: str = None, timeout: float = None,
+                 workers: int = None, credentials=None):
+        super().__init__()
+        self.endpoint = (endpoint or TRANSPORT_CONFIG['endpoint']).rstrip('/')
+        self.timeout = timeout if timeout is not None else TRANSPORT_CONFIG['timeout']
+        self.workers = workers if workers is not None else TRANSPORT_CONFIG['workers']
+        self._credentials = credentials
+        self.project_id = (project_id or TRANSPORT_CONFIG['project_id']
+                           or getattr(credentials, 'project_id', None) or 'beegreen-local')
+        url = urlsplit(self.endpoint)
+        self._https = url.scheme == 'https'
+        self._netloc = url.netloc
+        self._path = f"{url.path}/v1/projects/{self.project_id}/messages:send"
+        self._local = threading.local()
+        self._connections = []
+        self._token_lock = threading.Lock()
+        self._pool = None
+
+    def send(self, message: messaging.Message) -> str:
+        """
+        Send a message with one messages:send request.
+
+        Raises:
+            FcmSendError: The endpoint answered with a non-2xx status
+        """
+        # bytes, so http.client sends headers and body in one segment (no Nagle stall)
+        body = json.dumps({'message': encode_message(message)}, separators=(',', ':')).encode()
+        headers = {'Content-Type': 'application/json'}
+        if self._credentials is not None:
+            headers['Authorization'] = f"Bearer {self._access_token()}"
+        conn = self._connection()
+        try:
+            conn.request('POST', self._path, body=body, headers=headers)
+            response = conn.getresponse()
+            payload = response.read()
+        except Exception:
+            # The connection may be half-closed; the next send opens a new one
+            conn.close()
+            self._local.conn = None
+            self._count(failed=1)
+            raise
+        if response.status >= 300:
+            self._count(failed=1)
+            retry_after = response.getheader('Retry-After')
+            raise FcmSendError(
+                response.status,
+                payload[:200].decode('utf-8', 'replace'),
+                float(retry_after) if retry_after and retry_after.isdigit() else None,
+            )
+        self._count(sent=1)
+        return json.loads(payload).get('name')
+
+    def send_each(self, messages: list) -> messaging.BatchResponse:
+        # Concurrent requests, like firebase_admin's send_each
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='fcm-http')
+        return messaging.BatchResponse(list(self._pool.map(self._send_response, messages)))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            connection_class = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+            conn = self._local.conn = connection_class(self._netloc, timeout=self.timeout)
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _access_token(self) -> str:
+        credentials = self._credentials
+        if not credentials.valid:
+            with self._token_lock:
+                if not credentials.valid:
+                    from google.auth.transport.requests import Request
+                    credentials.refresh(Request())
+        return credentials.token
+
+
+TRANSPORTS = {
+    'fcm': FcmTransport,
+    'dry_run': DryRunTransport,
+    'http': HttpTransport,
+}
+
+
+def create_transport(name: str = None) -> Transport:
+    """
+    Create the transport named in TRANSPORT_CONFIG (or the given one).
+
+    The http transport authenticates with firebase-admin-key.json when it
+    exists, and sends without a token otherwise.
+
+    Raises:
+        ValueError: Unknown transport name
+    """
+    name = name or TRANSPORT_CONFIG['transport']
+    if name not in TRANSPORTS:
+        raise ValueError(f"Unknown transport: {name} (expected one of {', '.join(TRANSPORTS)})")
+    if name == 'http' and os.path.exists(FIREBASE_CREDENTIALS_PATH):
+        from google.oauth2 import service_account
+        credentials = service_account.Credentials.from_service_account_file(
+            FIREBASE_CREDENTIALS_PATH, scopes=FCM_SCOPES)
+        return HttpTransport(credentials=credentials)
+    return TRANSPORTS[name]()
+
+
+def _firebase_app():
+    from . import fcm_service
+    return fcm_service._get_firebase_app()